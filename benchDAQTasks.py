@@ -0,0 +1,57 @@
+from pymeasure.adapters import DAQmxAdapter
+import PyDAQmx as daqmx
+import os
+import sys
+import time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibration_check'))
+from daqTasks import daqTaskPool
+
+# Per-call latency of the magnet voltage write/read: one task per call (the old calibDAQ.py
+# pattern) against the persistent daqTaskPool. Run with the magnet disconnected or at 0 V.
+
+num_calls = 200
+volts = 0.0
+
+daq = DAQmxAdapter('Dev2', ['ao0', 'ai1'])
+write_str = '/' + daq.resource_name + '/' + daq.channels[0]
+read_str = '/' + daq.resource_name + '/' + daq.channels[1]
+
+def per_call_write(volts):
+	task = daqmx.Task()
+	task.CreateAOVoltageChan(write_str.encode(),"",-10.0,10.0,daqmx.DAQmx_Val_Volts,None)
+	task.StartTask()
+	task.WriteAnalogScalarF64(1,10.0,volts,None)
+	task.StopTask()
+	task.ClearTask()
+
+def per_call_read():
+	task = daqmx.Task()
+	task.CreateAIVoltageChan(read_str.encode(),"",daqmx.DAQmx_Val_Cfg_Default,-10.0,10.0,daqmx.DAQmx_Val_Volts,None)
+	task.StartTask()
+	read_volts = daqmx.float64()
+	task.ReadAnalogScalarF64(10.0,read_volts,None)
+	task.StopTask()
+	task.ClearTask()
+	return read_volts.value
+
+def time_calls(func, *args):
+	times = np.zeros(num_calls)
+	for i in range(num_calls):
+		start = time.perf_counter()
+		func(*args)
+		times[i] = time.perf_counter() - start
+	return times*1e3
+
+results = {}
+results['per-call write'] = time_calls(per_call_write, volts)
+results['per-call read'] = time_calls(per_call_read)
+with daqTaskPool(daq) as tasks:
+	results['pooled write'] = time_calls(tasks.write, volts)
+	results['pooled read'] = time_calls(tasks.read)
+
+print('%-16s %10s %10s %10s' % ('', 'mean (ms)', 'median', 'max'))
+for name, times in results.items():
+	print('%-16s %10.3f %10.3f %10.3f' % (name, times.mean(), np.median(times), times.max()))
+print('write speedup: %.1fx' % (results['per-call write'].mean()/results['pooled write'].mean()))
+print('read speedup: %.1fx' % (results['per-call read'].mean()/results['pooled read'].mean()))
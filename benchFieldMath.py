@@ -0,0 +1,43 @@
+import glob
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibration_check'))
+from fieldMath import derive
+
+# Derived field columns (Bmag, act_phi, act_theta) for every calibration check point in
+# the archive: the per-row code of the procedures against one vectorized fieldMath pass.
+
+root = os.path.dirname(os.path.realpath(__file__))
+files = [f for f in glob.glob(os.path.join(root, '2019-*', '*.csv')) if 'calib' in os.path.basename(f).lower()]
+runs = []
+for f in files:
+	data = pd.read_csv(f, comment='#')
+	if 'Xfield_avg' in data:
+		runs.append(data[['Xfield_avg', 'Yfield_avg', 'Zfield_avg']])
+archive = pd.concat(runs, ignore_index=True)
+print("%d points from %d runs" % (len(archive), len(runs)))
+
+def per_row(data):
+	rows = []
+	for x, y, z in data.values:
+		xfields, yfields, zfields = np.array([x]), np.array([y]), np.array([z])
+		rows.append((np.sqrt(np.mean(xfields)**2 + np.mean(yfields)**2 + np.mean(zfields)**2),
+			np.arctan2(np.mean(xfields),np.mean(yfields))*180/np.pi,
+			np.arctan2(np.mean(zfields), np.sqrt(np.mean(yfields)**2 + np.mean(xfields)**2))*180/np.pi))
+	return np.array(rows)
+
+start = time.perf_counter()
+old = per_row(archive)
+old_time = time.perf_counter() - start
+
+start = time.perf_counter()
+new = derive(archive)
+new_time = time.perf_counter() - start
+
+difference = np.max(np.abs(old - new[['Bmag', 'act_phi', 'act_theta']].values))
+print("per-row:    %8.1f ms" % (old_time*1e3))
+print("vectorized: %8.1f ms (%.0fx)" % (new_time*1e3, old_time/new_time))
+print("max difference: %.3g" % difference)
@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import time
+os.environ['ICARUS_INSTRUMENTS'] = 'simulated'
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibration_check'))
+import simulatedInstruments
+from pymeasure.experiment import Results, Worker
+from calibrationCheckGUI import icarusCalibCheckProcedure
+from calibrationCheckFieldSweepGUI import icarusCalibCheckFieldSweepProcedure
+from phaseTimer import phase_summary, scan_points, timing_filename
+from instrumentSession import ramp_order
+
+# End to end runs of the two calibration check procedures on the simulated instruments,
+# reporting the time per point spent in each phase the procedures time (move command,
+# in_motion wait, error and position queries, voltage reads, delay sleeps, probe reads
+# and the results emit). Pass setting=value arguments to change the simulation, e.g.
+#   python benchProcedures.py stage_speed=5 gpib_latency=0.02
+# and buffered=1 / pipelined=1 / scan_order=serpentine to change the procedures.
+# The field sweep is also run as a queue of field steps sharing one instrument session.
+
+root = os.path.dirname(os.path.realpath(__file__))
+calib_name = os.path.join(root, 'icarusCalibCsv', 'icarus')
+
+settings = {}
+options = {'buffered': False, 'pipelined': False, 'scan_order': 'raster', 'num_averages': 3, 'delay': 0.1}
+for arg in sys.argv[1:]:
+	key, value = arg.split('=', 1)
+	if key in options:
+		options[key] = value if key == 'scan_order' else type(options[key])(float(value))
+	else:
+		settings[key] = float(value)
+
+scan = {'mag_field': 0.05, 'phi_start': 0., 'phi_end': 90., 'phi_step': 45.,
+	'theta_start': 5., 'theta_end': 15., 'theta_step': 5.}
+
+def run(procedure_class, configure=True, **parameters):
+	if configure:
+		simulatedInstruments.configure(**settings)
+	procedure = procedure_class()
+	for key, value in dict(scan, **options).items():
+		setattr(procedure, key, value)
+	for key, value in parameters.items():
+		setattr(procedure, key, value)
+	filename = os.path.join(tempfile.mkdtemp(), procedure_class.__name__ + '.csv')
+	worker = Worker(Results(procedure, filename))
+	start = time.perf_counter()
+	worker.start()
+	worker.join(timeout=None)
+	wall = time.perf_counter() - start
+	timing = procedure.timer.to_dataframe()
+	procedure.timer.save(timing_filename(filename))
+	points = len(scan_points(timing))
+	print('%s: %d points in %.1f s (%.0f ms/point), results in %s' % (procedure_class.__name__, points, wall, wall/max(points, 1)*1e3, filename))
+	print('Startup %.2f s, untimed %.2f s' % (timing.total.iloc[0], wall - timing.total.sum()))
+	print(phase_summary(timing).round(1).to_string())
+	print('')
+	return timing
+
+print('Simulation: %s' % dict(simulatedInstruments.SIMULATION_DEFAULTS, **settings))
+print('Procedures: %s\n' % options)
+run(icarusCalibCheckProcedure, mag_calib_name=calib_name)
+run(icarusCalibCheckFieldSweepProcedure, calib_file=calib_name)
+
+fields = ramp_order([0.1, 0.05])
+simulatedInstruments.configure(**settings)
+start = time.perf_counter()
+for i, field in enumerate(fields):
+	run(icarusCalibCheckFieldSweepProcedure, configure=False, calib_file=calib_name, mag_field=field,
+		shared_session=True, sweep_index=i, first=i == 0, last=i == len(fields) - 1)
+print('Field sweep queue of %d steps in %.1f s' % (len(fields), time.perf_counter() - start))
@@ -1,39 +1,43 @@
-from pymeasure.adapters import DAQmxAdapter
-from daedalus.custom_instruments import daedalusProjField, Keithley220
-import PyDAQmx as daqmx
-from daedalus.custom_instruments import senis3AxHallProbe
+import os
+import sys
 import time
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibration_check'))
+from instruments import DAQmxAdapter, daqRampTask
+from voltageCorrection import (ramp_waveform, characterize, format_characterization, save_correction,
+	voltageCorrection, VOLT_CORRECTION_FILE)
+
+# Characterization of the magnet voltage path, ao0 command -> ai1 readback: one hardware-
+# timed ramp across the whole range with the readback sampled on the AO clock, fitted
+# for offset, gain, nonlinearity and settling (see voltageCorrection). The act_V(V)
+# table is written to calibration_check/daq_volt_correction.csv, then the ramp is run
+# again through the correction to check what is left. The magnet follows the ramp.
+# Pass setting=value arguments to change the ramp, e.g.
+#   python calibDAQ.py sample_rate=10000 ramp_samples=20000
+# and ICARUS_INSTRUMENTS=simulated to run it on the simulated voltage path.
+
+options = {'v_min': -10., 'v_max': 10., 'sample_rate': 5000., 'ramp_samples': 5000, 'hold_samples': 2500,
+	'table_step': 0.05, 'tolerance': 1e-3, 'verify': 1, 'filename': VOLT_CORRECTION_FILE}
+for arg in sys.argv[1:]:
+	key, value = arg.split('=', 1)
+	options[key] = value if key == 'filename' else type(options[key])(float(value))
 
 daq = DAQmxAdapter('Dev2', ['ao0', 'ai1'])
-
-write_str = '/' + daq.resource_name + '/' + daq.channels[0]
-read_str = '/' + daq.resource_name + '/' + daq.channels[1]
-
-voltValues = np.arange(-10.0, 10.0, 1)
-
-offsetList = []
-
-for volts in voltValues:
-	task = daqmx.Task()
-	task.CreateAOVoltageChan(write_str.encode(),"",-10.0,10.0,daqmx.DAQmx_Val_Volts,None)
-	task.StartTask()
-	task.WriteAnalogScalarF64(1,10.0,volts,None)
-	task.StopTask()
-	task.ClearTask()
-
-	time.sleep(1)
-
-	task = daqmx.Task()
-	task.CreateAIVoltageChan(read_str.encode(),"",daqmx.DAQmx_Val_Cfg_Default,-10.0,10.0,daqmx.DAQmx_Val_Volts,None)
-	task.StartTask()
-	        # write field
-	read_volts = daqmx.float64()
-	task.ReadAnalogScalarF64(10.0,read_volts,None) # args: timeout, ctypes thing result is read to, "reserved" (always None)
-	task.StopTask()
-	task.ClearTask()
-	offset = read_volts-volts
-	print(offset)
-	offsetList.append(offset)
-
-print(np.array(offsetList).mean())
\ No newline at end of file
+ramp = daqRampTask(daq, options['sample_rate'])
+waveform, segments = ramp_waveform(options['v_min'], options['v_max'], options['ramp_samples'], options['hold_samples'])
+
+start = time.perf_counter()
+readback = ramp.run(waveform)
+print('%d point ramp in %.1f s' % (waveform.size, time.perf_counter() - start))
+result = characterize(waveform, readback, segments, options['sample_rate'], options['table_step'], options['tolerance'])
+print(format_characterization(result))
+print('Largest V - act_V: %.4g V' % np.max(np.abs(result.table.act_V - result.table.set_V)))
+save_correction(result, options['filename'], source='%d samples at %g Hz' % (waveform.size, options['sample_rate']))
+print('Saved correction table to %s' % options['filename'])
+
+if options['verify']:
+	correction = voltageCorrection(options['filename'])
+	readback = ramp.run(correction.command(waveform))
+	check = characterize(waveform, readback, segments, options['sample_rate'], options['table_step'], options['tolerance'])
+	print('Corrected: %s' % format_characterization(check))
+	print('Largest V - act_V: %.4g V' % np.max(np.abs(check.table.act_V - check.table.set_V)))
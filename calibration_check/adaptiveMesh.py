@@ -0,0 +1,130 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+from scanTrajectory import scanPoint, grid_axis
+
+
+class meshCell(object):
+    """ A rectangular cell of the refinement quadtree, with corners on the finest lattice """
+
+    def __init__(self, cell_id, parent_id, depth, i0, i1, j0, j1):
+        self.cell_id = cell_id
+        self.parent_id = parent_id
+        self.depth = depth
+        self.i0, self.i1, self.j0, self.j1 = i0, i1, j0, j1
+        self.gradient = np.nan
+        self.residual = np.nan
+        self.refined = False
+
+    @property
+    def corners(self):
+        return [(self.i0, self.j0), (self.i1, self.j0), (self.i0, self.j1), (self.i1, self.j1)]
+
+    def children_points(self):
+        """ Lattice points added when the cell is split: edge midpoints and centre """
+        im, jm = (self.i0 + self.i1)//2, (self.j0 + self.j1)//2
+        return [(im, self.j0), (im, self.j1), (self.i0, jm), (self.i1, jm), (im, jm)]
+
+
+class adaptiveMesh(object):
+    """
+    Quadtree adaptive refinement of a 2D scan.
+
+    The coarse pass measures the fast x slow grid at the given steps. Every cell whose
+    corners are measured is then scored on the largest field magnitude gradient along
+    its edges and the largest |Bmag_percent_dev| at its corners; cells above either
+    threshold are split in four, adding their edge midpoints and centre. Splitting
+    stops at max_depth halvings or once max_points have been scheduled, always taking
+    the worst cells first.
+
+    Points are addressed on the finest lattice (the coarse step / 2**max_depth), which
+    also gives the phi_index/theta_index recorded with each point.
+    """
+
+    def __init__(self, fast_start, fast_end, fast_step, slow_start, slow_end, slow_step,
+                 gradient_threshold, residual_threshold, max_points, max_depth=4):
+        self.fast_start, self.slow_start = fast_start, slow_start
+        self.max_depth = max_depth
+        self.scale = 2**max_depth
+        self.fast_unit = fast_step/self.scale
+        self.slow_unit = slow_step/self.scale
+        self.n_fast = grid_axis(fast_start, fast_end, fast_step).size
+        self.n_slow = grid_axis(slow_start, slow_end, slow_step).size
+        self.gradient_threshold = gradient_threshold
+        self.residual_threshold = residual_threshold
+        self.max_points = max_points
+        self.values = {}
+        self.scheduled = set()
+        self.cells = []
+        for j in range(self.n_slow - 1):
+            for i in range(self.n_fast - 1):
+                self._add_cell(None, 0, i*self.scale, (i + 1)*self.scale, j*self.scale, (j + 1)*self.scale)
+
+    def _add_cell(self, parent_id, depth, i0, i1, j0, j1):
+        cell = meshCell(len(self.cells), parent_id, depth, i0, i1, j0, j1)
+        self.cells.append(cell)
+        return cell
+
+    def point(self, i, j):
+        return scanPoint(self.fast_start + i*self.fast_unit, self.slow_start + j*self.slow_unit, i, j)
+
+    def _schedule(self, keys):
+        keys = [k for k in keys if k not in self.scheduled]
+        self.scheduled.update(keys)
+        keys.sort(key=lambda k: (k[1], k[0]))
+        return [self.point(i, j) for i, j in keys]
+
+    def coarse_points(self):
+        keys = [(i*self.scale, j*self.scale) for j in range(self.n_slow) for i in range(self.n_fast)]
+        return self._schedule(keys[:self.max_points])
+
+    def record(self, point, Bmag, percent_dev):
+        self.values[(point.i_fast, point.i_slow)] = (Bmag, percent_dev)
+
+    def _score(self, cell):
+        (b00, r00), (b10, r10), (b01, r01), (b11, r11) = [self.values[c] for c in cell.corners]
+        df = (cell.i1 - cell.i0)*self.fast_unit
+        ds = (cell.j1 - cell.j0)*self.slow_unit
+        cell.gradient = max(abs(b10 - b00)/df, abs(b11 - b01)/df, abs(b01 - b00)/ds, abs(b11 - b10)/ds)
+        cell.residual = max(abs(r00), abs(r10), abs(r01), abs(r11))
+        return max(cell.gradient/self.gradient_threshold, cell.residual/self.residual_threshold)
+
+    def refine(self):
+        """ Splits the cells that exceed a threshold and returns the new points to measure """
+        candidates = []
+        for cell in self.cells:
+            if cell.refined or not np.isnan(cell.gradient):
+                continue
+            if not all(c in self.values for c in cell.corners):
+                continue
+            score = self._score(cell)
+            if score > 1 and cell.depth < self.max_depth:
+                candidates.append((score, cell))
+        candidates.sort(key=lambda c: -c[0])
+
+        keys = []
+        for score, cell in candidates:
+            new = [k for k in cell.children_points() if k not in self.scheduled and k not in keys]
+            if len(self.scheduled) + len(keys) + len(new) > self.max_points:
+                log.info("Refinement point budget of %d reached" % self.max_points)
+                break
+            keys.extend(new)
+            cell.refined = True
+            im, jm = (cell.i0 + cell.i1)//2, (cell.j0 + cell.j1)//2
+            for i0, i1 in ((cell.i0, im), (im, cell.i1)):
+                for j0, j1 in ((cell.j0, jm), (jm, cell.j1)):
+                    self._add_cell(cell.cell_id, cell.depth + 1, i0, i1, j0, j1)
+        log.info("Refining %d cells with %d new points" % (sum(c.refined for s, c in candidates), len(keys)))
+        return self._schedule(keys)
+
+    def save_tree(self, filename):
+        """ Writes one row per quadtree cell, parent_id -1 marking the coarse cells """
+        rows = [(c.cell_id, -1 if c.parent_id is None else c.parent_id, c.depth,
+                 self.fast_start + c.i0*self.fast_unit, self.fast_start + c.i1*self.fast_unit,
+                 self.slow_start + c.j0*self.slow_unit, self.slow_start + c.j1*self.slow_unit,
+                 c.gradient, c.residual, c.refined) for c in self.cells]
+        header = "cell_id,parent_id,depth,phi_min,phi_max,theta_min,theta_max,gradient,residual,refined"
+        np.savetxt(filename, np.array(rows, dtype=float), delimiter=",", header=header, comments='',
+                   fmt=['%d', '%d', '%d', '%.6g', '%.6g', '%.6g', '%.6g', '%.6g', '%.6g', '%d'])
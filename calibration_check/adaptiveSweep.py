@@ -0,0 +1,136 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from calibFit import batch_chebfit
+
+# A polynomial fitted while a sweep runs: y against x over the rows where the column
+# `where` lies in [low, high], e.g. R against theta for R > 0.
+fitSpec = namedtuple('fitSpec', ['name', 'x', 'y', 'deg', 'where', 'low', 'high'])
+
+
+class adaptiveSweep(object):
+    """
+    Multi-pass 1D sweep that refits its calibration polynomials as it goes and stops
+    once they have converged.
+
+    The first pass measures the whole range at coarse_step, always including the
+    key_points (e.g. R = 0) and the end points. Each later pass measures the midpoints
+    of the intervals that still need them: intervals inside a dense region, and
+    intervals where a monitored column bends by more than its tolerance between the
+    end points (h^2 |y''| / 8, the linear interpolation error). No interval is split
+    below min_step. Passes alternate direction so the stage never flies back.
+
+    After every pass the fits are redone in one batched solve and compared with the
+    previous pass on a check grid; the sweep is done once every fit moved by less than
+    tolerance (relative to the fitted range of y), or nothing is left to refine.
+    """
+
+    def __init__(self, start, stop, coarse_step, min_step, fits, monitors, tolerance=1e-3,
+                 dense_regions=(), key_points=(), max_passes=12):
+        self.start, self.stop = min(start, stop), max(start, stop)
+        self.coarse_step = coarse_step
+        self.min_step = min_step
+        self.fits = fits
+        self.monitors = monitors
+        self.tolerance = tolerance
+        self.dense_regions = dense_regions
+        self.key_points = [p for p in key_points if self.start <= p <= self.stop]
+        self.max_passes = max_passes
+        self.rows = []
+        self.passes = 0
+        self.coefficients = {}
+        self.change = np.inf
+        self.done = False
+        self.forward = start <= stop
+
+    def resolution(self, x):
+        return np.round(np.asarray(x)/self.min_step)*self.min_step
+
+    def measured(self):
+        return pd.DataFrame(self.rows)
+
+    def next_pass(self):
+        """ The sweep positions of the next pass, in measuring order """
+        if self.passes == 0:
+            n = int(np.ceil((self.stop - self.start)/self.coarse_step))
+            points = np.concatenate((self.start + self.coarse_step*np.arange(n), [self.stop], self.key_points))
+        else:
+            points = self.refinement_points()
+        points = np.unique(self.resolution(points))
+        if self.rows:
+            points = np.setdiff1d(points, self.resolution(self.measured()['sweep'].values))
+        if not self.forward:
+            points = points[::-1]
+        self.forward = not self.forward
+        return list(points)
+
+    def in_dense_region(self, a, b):
+        return np.any([(a < high) & (b > low) for low, high in self.dense_regions], axis=0) \
+            if self.dense_regions else np.zeros(np.shape(a), dtype=bool)
+
+    def refinement_points(self):
+        data = self.measured().sort_values('sweep')
+        x = data['sweep'].values
+        if x.size < 3:
+            return np.array([])
+        h = np.diff(x)
+        refine = self.in_dense_region(x[:-1], x[1:])
+        for column, tolerance in self.monitors.items():
+            y = data[column].values
+            # second divided difference at each interior point, shared by its two intervals
+            d2 = 2*np.abs(np.diff(np.diff(y)/h))/(h[1:] + h[:-1])
+            curvature = np.maximum(np.append(d2, 0), np.insert(d2, 0, 0))
+            refine |= h**2*curvature/8 > tolerance
+        refine &= h >= 2*self.min_step
+        return (x[:-1] + h/2)[refine]
+
+    def add(self, sweep, row):
+        """ Records the measured row at sweep position sweep """
+        row = dict(row)
+        row['sweep'] = sweep
+        self.rows.append(row)
+
+    def refit(self):
+        """ Refits every polynomial, updating done, and returns the largest relative change """
+        self.passes += 1
+        data = self.measured()
+        xs, ys = [], []
+        for fit in self.fits:
+            rows = data[(data[fit.where] >= fit.low) & (data[fit.where] <= fit.high)]
+            xs.append(rows[fit.x].values)
+            ys.append(rows[fit.y].values)
+        if any(len(x) <= fit.deg for x, fit in zip(xs, self.fits)):
+            log.info("Pass %d: too few points to fit yet" % self.passes)
+            return self.change
+        change = []
+        for deg in sorted(set(f.deg for f in self.fits)):
+            index = [i for i, f in enumerate(self.fits) if f.deg == deg]
+            coeffs = batch_chebfit([xs[i] for i in index], [ys[i] for i in index], deg)
+            for i, c in zip(index, coeffs):
+                grid = np.linspace(xs[i].min(), xs[i].max(), 200)
+                scale = np.ptp(ys[i]) or 1.
+                previous = self.coefficients.get(self.fits[i].name)
+                if previous is None:
+                    change.append(np.inf)
+                else:
+                    change.append(np.max(np.abs(np.polyval(c, grid) - np.polyval(previous, grid)))/scale)
+                self.coefficients[self.fits[i].name] = c
+        self.change = max(change)
+        log.info("Pass %d: %d points, largest fit change %.3g" % (self.passes, len(data), self.change))
+        if self.change < self.tolerance:
+            log.info("Fits converged within %g after %d points" % (self.tolerance, len(data)))
+            self.done = True
+        elif self.passes >= self.max_passes:
+            self.done = True
+        return self.change
+
+    def finish_pass(self, planned):
+        """ Refits after a pass, ending the sweep if the pass had nothing left to measure """
+        self.refit()
+        if not planned and self.passes > 1:
+            log.info("Nothing left to refine after %d points" % len(self.rows))
+            self.done = True
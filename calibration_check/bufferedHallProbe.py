@@ -0,0 +1,115 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+import PyDAQmx as daqmx
+from ctypes import byref
+
+MIN_SCALE_VOLTS = 1e-3 # V, smallest probe voltage a tesla scale is matched at
+
+
+class bufferedHallProbe(object):
+    """
+    Hardware-timed, multi-channel finite acquisition of the Senis 3 axis Hall probe.
+
+    One DAQmx task holds all three probe channels on a shared sample clock, so every
+    call to acquire() returns an (N, 3) block of simultaneous X, Y, Z samples instead
+    of 3*N software timed scalar reads. The task is configured once and reused for
+    every grid point; it is not explicitly committed so the AI subsystem stays free for
+    the magnet voltage readback between blocks.
+
+    The probe driver only exposes fields in tesla, so the volts to tesla factor of each
+    axis is matched against the scalar readings with calibrate_scale() before use.
+    """
+
+    def __init__(self, adapter, sample_rate=1000., num_samples=100, volt_range=10.0):
+        self.resource_name = adapter.resource_name
+        self.channels = adapter.channels
+        self.sample_rate = sample_rate
+        self.num_samples = num_samples
+        self.volt_range = volt_range
+        self.scale = np.ones(len(self.channels))
+        self.matched = np.zeros(len(self.channels), dtype=bool)
+        self.task = None
+        self._configure()
+
+    def _configure(self):
+        chan_str = ','.join('/' + self.resource_name + '/' + c for c in self.channels)
+        self.task = daqmx.Task()
+        self.task.CreateAIVoltageChan(chan_str.encode(), "", daqmx.DAQmx_Val_Cfg_Default,
+                                      -self.volt_range, self.volt_range, daqmx.DAQmx_Val_Volts, None)
+        self.task.CfgSampClkTiming("", self.sample_rate, daqmx.DAQmx_Val_Rising,
+                                   daqmx.DAQmx_Val_FiniteSamps, self.num_samples)
+        self._buffer = np.zeros((self.num_samples, len(self.channels)), dtype=np.float64)
+        log.info("Configured buffered Hall probe read: %d samples at %g Hz on %s"
+                 % (self.num_samples, self.sample_rate, chan_str))
+
+    def set_timing(self, sample_rate, num_samples):
+        """ Reconfigures the sample clock, only touching the task when something changed """
+        num_samples = max(int(num_samples), 1)
+        if sample_rate == self.sample_rate and num_samples == self.num_samples:
+            return
+        self.close()
+        self.sample_rate = sample_rate
+        self.num_samples = num_samples
+        self._configure()
+
+    @property
+    def window(self):
+        """ Length of one acquisition in seconds """
+        return self.num_samples / self.sample_rate
+
+    def acquire_volts(self):
+        """ Returns an (num_samples, 3) array of raw probe voltages """
+        read = daqmx.int32()
+        timeout = 10.0 + 2*self.window
+        self.task.StartTask()
+        self.task.ReadAnalogF64(self.num_samples, timeout, daqmx.DAQmx_Val_GroupByScanNumber,
+                                self._buffer, self._buffer.size, byref(read), None)
+        self.task.StopTask()
+        if read.value != self.num_samples:
+            log.warning("Buffered Hall probe read returned %d of %d samples" % (read.value, self.num_samples))
+        return self._buffer[:read.value].copy()
+
+    def acquire(self):
+        """ Returns an (num_samples, 3) array of X, Y, Z fields in tesla """
+        return self.acquire_volts()*self.scale
+
+    def calibrate_scale(self, hall_probe, num_reads=5, min_volts=MIN_SCALE_VOLTS):
+        """
+        Matches the volts to tesla factor of each axis to the scalar probe driver, using
+        the average of num_reads scalar reads and one buffered block at a fixed field.
+        The driver's tesla reading is proportional to the probe voltage (the zero is
+        subtracted afterwards), so one ratio per axis is enough.
+
+        Only axes reading at least min_volts are matched; at e.g. phi = 0, theta = 0 the
+        others see next to no field. They keep their last matched factor, or take the
+        mean factor of the matched axes (the three sensors have the same nominal
+        sensitivity) if they were never matched.
+        """
+        scalar = np.zeros(3)
+        for j in range(num_reads):
+            scalar += (hall_probe.x_field, hall_probe.y_field, hall_probe.z_field)
+        scalar /= num_reads
+        volts = self.acquire_volts().mean(axis=0)
+        signal = np.abs(volts) >= min_volts
+        if not signal.any():
+            if not self.matched.any():
+                raise ValueError("Hall probe voltages %s too small to match the tesla scale" % volts)
+            log.warning("Hall probe voltages %s too small to match the tesla scale, keeping %s" % (volts, self.scale))
+            return self.scale
+        self.scale[signal] = scalar[signal]/volts[signal]
+        self.matched |= signal
+        if not self.matched.all():
+            self.scale[~self.matched] = self.scale[self.matched].mean()
+            log.warning("No signal on Hall probe axes %s, using the mean scale of the others"
+                        % ', '.join(np.array(['X', 'Y', 'Z'])[~self.matched]))
+        log.info("Buffered Hall probe scale (T/V): %s" % self.scale)
+        return self.scale
+
+    def close(self):
+        if self.task is not None:
+            self.task.StopTask()
+            self.task.ClearTask()
+            self.task = None
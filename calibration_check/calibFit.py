@@ -0,0 +1,171 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+import numpy as np
+import pandas as pd
+from numpy.polynomial import chebyshev, Chebyshev, Polynomial
+from resultsStore import load_results
+from fieldMath import bmag, field_phi, radial_theta, field_ratio
+from calibrationBundle import pack_calibration
+
+# Batched regeneration of the per-voltage Icarus calibration files in icarusCalibCsv,
+# replacing the radialPolar/generateFieldRatioCsv/parse notebook loop.
+#
+# Every segment (vp/vn x R>0/R<0, for every voltage) is fitted in a Chebyshev basis on
+# its own x range mapped to [-1, 1], which keeps the degree 10 fits well conditioned,
+# and all segments of one kind are solved together with one stacked QR decomposition.
+# The fits are then converted back to power-basis coefficients, highest power first,
+# so the files are drop-in for np.poly1d exactly as before.
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+RADIAL_POLAR_FILE = os.path.join(ROOT, '2019-06-30', '%g%s_daedalus_radialPolar_calib_A000.0_2019-06-30_1.csv')
+VOLT_CENTER_FILE = os.path.join(ROOT, '2019-06-29', 'phi0_daedalus_voltCenter_calib_2019-06-29_2.csv')
+OUTPUT_DIR = os.path.join(ROOT, 'icarusCalibCsv')
+
+FIELD_RATIO_DEGREE = 10
+BMAG_DEGREE = 10
+RADIAL_POLAR_DEGREE = 6
+VOLT_CORRECTION_DEGREE = 10
+VOLT_CENTER_DEGREE = 5
+
+
+def batch_chebfit(xs, ys, deg):
+    """
+    Least-squares fits of ys[i] against xs[i] for every segment i in one batched solve.
+    Segments may have different lengths; shorter ones are padded with zero-weight rows.
+    Returns the power-basis coefficients (segments x deg+1, highest power first).
+    """
+    n = max(len(x) for x in xs)
+    A = np.zeros((len(xs), n, deg + 1))
+    b = np.zeros((len(xs), n))
+    domains = []
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        x = np.asarray(x, dtype=float)
+        domain = (x.min(), x.max())
+        domains.append(domain)
+        A[i, :len(x)] = chebyshev.chebvander((2*x - domain[0] - domain[1])/(domain[1] - domain[0]), deg)
+        b[i, :len(x)] = y
+    Q, R = np.linalg.qr(A)
+    c = np.linalg.solve(R, np.einsum('snk,sn->sk', Q, b)[..., None])[..., 0]
+    return np.array([Chebyshev(ci, domain=d).convert(kind=Polynomial).coef[::-1]
+                     for ci, d in zip(c, domains)])
+
+
+def fit_residuals(coeffs, xs, ys):
+    """ RMS and max absolute residual of every fitted segment, as evaluated by np.polyval """
+    rms = np.zeros(len(xs))
+    peak = np.zeros(len(xs))
+    for i, (p, x, y) in enumerate(zip(coeffs, xs, ys)):
+        r = np.polyval(p, x) - y
+        rms[i] = np.sqrt(np.mean(r**2))
+        peak[i] = np.max(np.abs(r))
+    return rms, peak
+
+
+def radial_polar_scan(filename, sign):
+    """
+    Loads a radialPolar run and derives phi, theta and Bmag as the notebooks did. sign is
+    +1 for the vn scans and -1 for the vp scans (theta is measured from -Yfield for vp).
+    """
+    scan = load_results(filename)
+    scan['phi'] = field_phi(scan.Xfield.values, scan.Yfield.values)
+    scan['theta'] = radial_theta(scan.Yfield.values, scan.Zfield.values, sign)
+    scan['Bmag'] = bmag(0., scan.Yfield.values, scan.Zfield.values) # Y-Z plane magnitude, as fitted
+    scan['fieldRatio'] = field_ratio(scan.Bmag.values, scan.R.values)
+    return scan
+
+
+def volt_center_coefficients(filename=VOLT_CENTER_FILE):
+    """ Voltage as a polynomial of the centre Yfield, [vn, vp] as in the notebooks """
+    cen_v = load_results(filename)
+    vn = cen_v[cen_v.Yfield > 0]
+    vp = cen_v[cen_v.Yfield < 0]
+    return batch_chebfit([vn.Yfield.values, vp.Yfield.values], [vn.V.values, vp.V.values], VOLT_CENTER_DEGREE)
+
+
+class batchCalibrationFit(object):
+    """
+    Fits the field ratio, radial polar and voltage correction calibrations of every
+    voltage at once:
+
+        fit = batchCalibrationFit(range(1, 11))
+        fit.save()          # icarus_%gV_*_calib.csv and icarus_fit_residuals.csv
+        fit.save(bundle='./calibrations/icarus.calib') # and the bundle of the whole calibration
+    """
+
+    def __init__(self, volts, radial_polar_file=RADIAL_POLAR_FILE, volt_center_file=VOLT_CENTER_FILE):
+        self.volts = list(volts)
+        self.sources = [radial_polar_file % (v, s) for v in self.volts for s in ('vn', 'vp')] + [volt_center_file]
+        self.scans = {}
+        for v in self.volts:
+            self.scans[v] = {'vn': radial_polar_scan(radial_polar_file % (v, 'vn'), 1),
+                             'vp': radial_polar_scan(radial_polar_file % (v, 'vp'), -1)}
+        self.cen_vn, self.cen_vp = volt_center_coefficients(volt_center_file)
+        self.residuals = []
+        self.fit()
+
+    def segments(self, order, x, y):
+        """ x, y columns of each (scan, R side) segment in order, for every voltage in turn """
+        xs, ys, labels = [], [], []
+        for v in self.volts:
+            for scan, side in order:
+                s = self.scans[v][scan]
+                s = s[s.R > 0] if side == 'rp' else s[s.R < 0]
+                xs.append(s[x].values)
+                ys.append(s[y].values)
+                labels.append((v, '%s_%s' % (scan, side)))
+        return xs, ys, labels
+
+    def _fit(self, kind, order, x, y, deg):
+        xs, ys, labels = self.segments(order, x, y)
+        return self._solve(kind, xs, ys, labels, deg).reshape(len(self.volts), len(order), deg + 1)
+
+    def _solve(self, kind, xs, ys, labels, deg):
+        coeffs = batch_chebfit(xs, ys, deg)
+        rms, peak = fit_residuals(coeffs, xs, ys)
+        for (v, segment), r, p in zip(labels, rms, peak):
+            self.residuals.append((v, kind, segment, r, p))
+        return coeffs
+
+    def fit(self):
+        rn_rp = [('vn', 'rp'), ('vn', 'rn'), ('vp', 'rp'), ('vp', 'rn')]
+        self.field_ratio = self._fit('fieldratio', rn_rp, 'R', 'fieldRatio', FIELD_RATIO_DEGREE)
+        self.radial_polar = self._fit('radial_polar', [('vn', 'rp'), ('vn', 'rn')], 'theta', 'R', RADIAL_POLAR_DEGREE)
+        bmag_coeffs = self._fit('bmag', rn_rp, 'R', 'Bmag', BMAG_DEGREE)
+
+        # Voltage scale factor for a radial point to get the same field as the centre
+        Rpts_p = np.arange(0, 15, 0.1)
+        Rpts_n = np.arange(-15, 0, 0.1)
+        xs, ys, labels = [], [], []
+        for i, v in enumerate(self.volts):
+            vn_rp, vn_rn, vp_rp, vp_rn = bmag_coeffs[i]
+            V0 = np.polyval(self.cen_vn, np.polyval(vn_rp, 0.0)) # Voltage used for radial scan
+            xs += [Rpts_p, Rpts_p, Rpts_n, Rpts_n]
+            ys += [V0/np.polyval(self.cen_vn, np.polyval(vn_rp, Rpts_p)),
+                   -V0/np.polyval(self.cen_vp, -np.polyval(vp_rp, Rpts_p)),
+                   V0/np.polyval(self.cen_vn, np.polyval(vn_rn, Rpts_n)),
+                   -V0/np.polyval(self.cen_vp, -np.polyval(vp_rn, Rpts_n))]
+            labels += [(v, 'vn_rp'), (v, 'vp_rp'), (v, 'vn_rn'), (v, 'vp_rn')]
+        self.volt_correction = self._solve('volt_correction', xs, ys, labels,
+                                           VOLT_CORRECTION_DEGREE).reshape(len(self.volts), 4, -1)
+
+    def save(self, directory=OUTPUT_DIR, bundle=None):
+        for i, v in enumerate(self.volts):
+            np.savetxt(os.path.join(directory, "icarus_%gV_fieldratio_calib.csv" % v), self.field_ratio[i], delimiter=",")
+            np.savetxt(os.path.join(directory, "icarus_%gV_radial_polar_calib.csv" % v), self.radial_polar[i], delimiter=",")
+            np.savetxt(os.path.join(directory, "icarus_%gV_volt_correction_calib.csv" % v), self.volt_correction[i], delimiter=",")
+        residuals = pd.DataFrame(self.residuals, columns=['volts', 'calibration', 'segment', 'rms', 'max'])
+        residuals.to_csv(os.path.join(directory, 'icarus_fit_residuals.csv'), index=False)
+        log.info("Saved calibrations for %s V to %s" % (', '.join('%g' % v for v in self.volts), directory))
+        if bundle is not None:
+            log.info("Packed the calibration into %s" % pack_calibration(os.path.join(directory, 'icarus'), bundle, self.sources))
+        return residuals
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    volts = [float(v) for v in sys.argv[1:]] or range(1, 11)
+    batchCalibrationFit(volts).save()
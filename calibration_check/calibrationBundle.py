@@ -0,0 +1,311 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import struct
+import tempfile
+from time import strftime
+import numpy as np
+from fieldMath import PROBE_ZERO_FILE
+from runCatalog import FILENAME_REGEX
+from scanCheckpoint import file_hash
+
+# One file holding a whole magnet calibration, in place of the loose coefficient files
+# of a calibration name (icarusCalibCsv/icarus_*_calib.csv: the global radial_polar,
+# fieldratio, volt_center and center files and the per-voltage fieldratio, radial_polar
+# and volt_correction ones), with the probe zero, the run files the calibration was
+# fitted from and the SHA1 of every array.
+#
+# Layout (little endian):
+#   8 bytes   MAGIC
+#   uint32    FORMAT_VERSION
+#   uint32    reserved
+#   uint64    manifest length
+#   manifest  JSON: entries (key, volts, shape, offset, sha1), sources, checksum, ...
+#   data      float64 arrays, each starting on an ALIGNMENT byte boundary
+#
+# calibrationBundle memory-maps the file, checks the checksums and builds the
+# polynomial evaluators once. A station's calibration is <calibrations>/<hostname> +
+# BUNDLE_SUFFIX: install_bundle() replaces it with one os.replace, so a procedure always
+# sees one complete calibration. The magnet driver still loads coefficient files by
+# name, so resolve_calibration() unpacks a bundle once into a directory keyed on its
+# checksum and returns that calibration name with the bundled probe zero; names without
+# a bundle are unchanged. calibrationTable evaluates the bundle's polynomials directly.
+
+MAGIC = b'ICARUSCB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+ALIGNMENT = 64
+BUNDLE_SUFFIX = '.calib'
+PROBE_ZERO_KEY = 'probe_zero'
+NOT_POLYNOMIALS = (PROBE_ZERO_KEY, 'center') # probe zero and stage centre
+KEY_REGEX = re.compile(r"^(?:(?P<volts>[-+]?\d*\.?\d+)V_)?(?P<kind>\w+)$")
+
+
+def array_hash(array):
+    return hashlib.sha1(np.ascontiguousarray(array, dtype='<f8').tobytes()).hexdigest()
+
+
+def bundle_checksum(entries):
+    """ SHA1 over the keys and array hashes of the entries, the identity of a calibration """
+    sha = hashlib.sha1()
+    for entry in entries:
+        sha.update(('%s:%s;' % (entry['key'], entry['sha1'])).encode())
+    return sha.hexdigest()
+
+
+def calibration_files(calib_name):
+    """ Coefficient files of a calibration name by key, e.g. '10V_fieldratio' or 'center' """
+    files = {}
+    for filename in sorted(glob.glob(glob.escape(calib_name) + '_*_calib.csv')):
+        files[filename[len(calib_name) + 1:-len('_calib.csv')]] = filename
+    return files
+
+
+def source_record(filename):
+    """ Provenance of a run file: its name, date and SHA1 """
+    match = FILENAME_REGEX.search(os.path.basename(filename))
+    return {'file': os.path.basename(filename), 'date': match.group('date') if match else '',
+            'sha1': file_hash(filename)}
+
+
+def write_bundle(filename, arrays, sources=(), name='', label=''):
+    """ Writes the arrays (by key) to a bundle file, replacing it in one step; returns the checksum """
+    entries = []
+    offset = 0
+    for key in sorted(arrays):
+        array = np.ascontiguousarray(arrays[key], dtype='<f8')
+        match = KEY_REGEX.match(key)
+        volts = match.group('volts') if match else None
+        entries.append({'key': key, 'kind': match.group('kind') if match else key,
+                        'volts': None if volts is None else float(volts), 'shape': list(array.shape),
+                        'offset': offset, 'sha1': array_hash(array)})
+        offset += -(-array.nbytes//ALIGNMENT)*ALIGNMENT
+    manifest = {'name': name, 'label': label, 'created': strftime('%Y-%m-%d %H:%M:%S'),
+                'host': socket.gethostname(), 'entries': entries, 'sources': list(sources),
+                'checksum': bundle_checksum(entries)}
+    text = json.dumps(manifest, indent=1).encode()
+    start = -(-(HEADER.size + len(text))//ALIGNMENT)*ALIGNMENT
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(text)))
+        f.write(text)
+        for entry in entries:
+            f.seek(start + entry['offset'])
+            f.write(np.ascontiguousarray(arrays[entry['key']], dtype='<f8').tobytes())
+        f.truncate(start + offset)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, filename)
+    log.info("Wrote calibration bundle %s (%d arrays, %s)" % (filename, len(entries), manifest['checksum'][:12]))
+    return manifest['checksum']
+
+
+def pack_calibration(calib_name, filename=None, sources=(), probe_zero_file=None, label=''):
+    """ Packs the coefficient files of a calibration name (and the probe zero) into a bundle """
+    files = calibration_files(calib_name)
+    if not files:
+        raise IOError("No calibration files match %s_*_calib.csv" % calib_name)
+    arrays = dict((key, np.loadtxt(f, delimiter=',')) for key, f in files.items())
+    arrays[PROBE_ZERO_KEY] = np.loadtxt(probe_zero_file or PROBE_ZERO_FILE, delimiter=',').reshape(3)
+    filename = filename or calib_name + BUNDLE_SUFFIX
+    write_bundle(filename, arrays, [source_record(s) for s in sources], os.path.basename(calib_name), label)
+    return filename
+
+
+class polynomialSet(object):
+    """ Rows of power-basis coefficients (highest power first) evaluated together by Horner's rule """
+
+    def __init__(self, coefficients):
+        self.coefficients = np.atleast_2d(coefficients)
+
+    def __call__(self, x, row=None):
+        """ Every row (or just row) at x, with the rows along the first axis """
+        c = self.coefficients if row is None else self.coefficients[row:row + 1]
+        x = np.asarray(x, dtype=float)
+        result = np.zeros((len(c),) + x.shape)
+        for k in range(c.shape[1]):
+            result = result*x + c[:, k].reshape((-1,) + (1,)*x.ndim)
+        return result if row is None else result[0]
+
+
+class calibrationBundle(object):
+    """
+    A calibration bundle, memory-mapped:
+
+        bundle = calibrationBundle('./calibrations/icarus.calib')
+        bundle['10V_fieldratio']                   # coefficient array
+        bundle.polynomials['fieldratio'](R, 0)     # vn R>0 field ratio
+        bundle.probe_zero, bundle.sources, bundle.checksum
+    """
+
+    def __init__(self, filename, verify=True):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a calibration bundle" % filename)
+            magic, version, reserved, length = HEADER.unpack(header)
+            if version > FORMAT_VERSION:
+                raise ValueError("%s is bundle format %d, this code reads up to %d" % (filename, version, FORMAT_VERSION))
+            manifest = f.read(length)
+        if len(manifest) < length:
+            raise ValueError("Calibration bundle %s is truncated" % filename)
+        self.manifest = json.loads(manifest.decode())
+        start = -(-(HEADER.size + length)//ALIGNMENT)*ALIGNMENT
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        end = max([start + e['offset'] + 8*int(np.prod(e['shape'])) for e in self.manifest['entries']] or [0])
+        if self.data.size < end:
+            raise ValueError("Calibration bundle %s is truncated" % filename)
+        self.arrays = {}
+        for entry in self.manifest['entries']:
+            self.arrays[entry['key']] = np.ndarray(entry['shape'], dtype='<f8', buffer=self.data,
+                                                   offset=start + entry['offset'])
+        if verify:
+            self.verify()
+        self.polynomials = dict((key, polynomialSet(array)) for key, array in self.arrays.items()
+                                if key not in NOT_POLYNOMIALS)
+
+    def verify(self):
+        """ Raises ValueError if an array or the set of arrays does not match its checksum """
+        bad = [e['key'] for e in self.manifest['entries'] if array_hash(self.arrays[e['key']]) != e['sha1']]
+        if bad:
+            raise ValueError("Calibration bundle %s is corrupt: %s" % (self.filename, ', '.join(bad)))
+        if bundle_checksum(self.manifest['entries']) != self.checksum:
+            raise ValueError("Calibration bundle %s does not match its checksum" % self.filename)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def keys(self):
+        return sorted(self.arrays)
+
+    @property
+    def checksum(self):
+        return self.manifest['checksum']
+
+    @property
+    def sources(self):
+        return self.manifest['sources']
+
+    @property
+    def probe_zero(self):
+        return self.arrays.get(PROBE_ZERO_KEY)
+
+    def volts(self, kind):
+        """ The voltages with a calibration of the kind, e.g. 'fieldratio' """
+        return sorted(e['volts'] for e in self.manifest['entries'] if e['kind'] == kind and e['volts'] is not None)
+
+    def unpack(self, directory=None):
+        """
+        Writes the coefficient files into a directory named after the checksum, once, and
+        returns the calibration name to load them by.
+        """
+        name = self.manifest['name'] or os.path.splitext(os.path.basename(self.filename))[0]
+        parent = os.path.dirname(os.path.abspath(self.filename)) if directory is None else directory
+        target = os.path.join(parent, '.%s_bundle_%s' % (name, self.checksum[:12]))
+        if not os.path.isdir(target):
+            tmp = tempfile.mkdtemp(dir=parent, prefix='.unpack_')
+            os.chmod(tmp, 0o755)
+            for key, array in self.arrays.items():
+                if key == PROBE_ZERO_KEY:
+                    np.savetxt(os.path.join(tmp, 'probe_zero_calib.csv'), array.reshape(1, -1), delimiter=',')
+                else:
+                    np.savetxt(os.path.join(tmp, '%s_%s_calib.csv' % (name, key)), array, delimiter=',')
+            try:
+                os.rename(tmp, target)
+            except OSError: # unpacked meanwhile by another process
+                shutil.rmtree(tmp, ignore_errors=True)
+            log.info("Unpacked calibration bundle %s to %s" % (self.filename, target))
+        return os.path.join(target, name)
+
+
+def bundle_filename(calib_name):
+    """ The bundle a calibration name refers to, or None if it names loose files """
+    if calib_name.endswith(BUNDLE_SUFFIX) and os.path.exists(calib_name):
+        return calib_name
+    if os.path.exists(calib_name + BUNDLE_SUFFIX):
+        return calib_name + BUNDLE_SUFFIX
+    return None
+
+
+_bundles = {}
+
+
+def open_bundle(calib_name):
+    """ The calibrationBundle of a calibration name, checked once per file version, or None for loose files """
+    filename = bundle_filename(calib_name)
+    if filename is None:
+        return None
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    if key not in _bundles:
+        bundle = calibrationBundle(filename)
+        log.info("Using calibration bundle %s (%s, %s)" % (filename, bundle.manifest.get('label') or 'no label',
+                                                             bundle.checksum[:12]))
+        _bundles[key] = bundle
+    return _bundles[key]
+
+
+def resolve_calibration(calib_name):
+    """
+    The calibration name to load coefficient files by and the probe zero calibrated with
+    them: calib_name itself and None, or the unpacked files of its bundle and the bundled
+    zero. Bundles are checked and unpacked once per file version.
+    """
+    bundle = open_bundle(calib_name)
+    if bundle is None:
+        return calib_name, None
+    return bundle.unpack(), bundle.probe_zero
+
+
+def install_bundle(filename, station=None, directory='./calibrations'):
+    """ Makes a bundle the calibration of a station (default this host) in one atomic replace """
+    bundle = calibrationBundle(filename)
+    station = (station or socket.gethostname()).lower()
+    target = os.path.join(directory, station + BUNDLE_SUFFIX)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    shutil.copyfile(filename, tmp)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, target)
+    log.info("Installed calibration %s as %s" % (bundle.checksum[:12], target))
+    return target
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Pack, inspect and install magnet calibration bundles")
+    commands = parser.add_subparsers(dest='command')
+    pack = commands.add_parser('pack', help="pack the <name>_*_calib.csv files of a calibration name")
+    pack.add_argument('calib_name')
+    pack.add_argument('--output', default=None)
+    pack.add_argument('--label', default='')
+    pack.add_argument('--probe-zero', default=None)
+    pack.add_argument('sources', nargs='*', help="run files the calibration was fitted from")
+    info = commands.add_parser('info', help="print the manifest of a bundle")
+    info.add_argument('bundle')
+    install = commands.add_parser('install', help="make a bundle a station's calibration")
+    install.add_argument('bundle')
+    install.add_argument('--station', default=None)
+    install.add_argument('--directory', default='./calibrations')
+    args = parser.parse_args()
+    if args.command == 'pack':
+        print(pack_calibration(args.calib_name, args.output, args.sources, args.probe_zero, args.label))
+    elif args.command == 'info':
+        bundle = calibrationBundle(args.bundle)
+        manifest = dict(bundle.manifest, entries=len(bundle.manifest['entries']))
+        print(json.dumps(manifest, indent=1))
+        print(', '.join(bundle.keys()))
+    elif args.command == 'install':
+        print(install_bundle(args.bundle, args.station, args.directory))
+    else:
+        parser.print_help()
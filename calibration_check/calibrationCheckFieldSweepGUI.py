@@ -6,18 +6,27 @@ log.addHandler(logging.NullHandler())
 
 import numpy as np
 import socket
-from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter, BooleanParameter, ListParameter
 from pymeasure.log import console_log
 from pymeasure.experiment import Procedure
-from pymeasure.adapters import DAQmxAdapter
-from daedalus.custom_instruments import daedalusProjField, senis3AxHallProbe
+from instrumentSession import get_session, close_session, park_session, set_queue_lookup, next_procedure, ramp_order
+from rasterScheduler import rasterScheduler
+from runningStats import runningStats
+from fieldMath import zeroed
+from calibrationTable import calibrationTable
+from resultsStore import save_results
+from scanTrajectory import ORDERINGS, grid_axis, make_trajectory, compare_orderings
+from adaptiveMesh import adaptiveMesh
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
 
 from pymeasure.display.windows import ManagedWindow
+from livePlot import livePlotWindow
 from pymeasure.experiment import Results, unique_filename
 import sys
 from pymeasure.log import console_log
 from pymeasure.display.Qt import QtCore, QtGui, fromUi
-from itertools import product
+from itertools import product, count
 
 
 class icarusCalibCheckFieldSweepProcedure(Procedure):
@@ -30,6 +39,18 @@ class icarusCalibCheckFieldSweepProcedure(Procedure):
     mag_field = FloatParameter("Magnetic field strength", units="T", default=0.05)
     num_averages = IntegerParameter("Number of Averages", default=1)
     delay = FloatParameter("Delay between averages", units="s", default=.1)
+    buffered = BooleanParameter("Hardware-timed buffered acquisition", default=False)
+    sample_rate = FloatParameter("Buffered sample rate", units="Hz", default=1000.)
+    averaging_window = FloatParameter("Buffered averaging window", units="s", default=0.1)
+    pipelined = BooleanParameter("Overlap motion with acquisition", default=False)
+    scan_order = ListParameter("Scan ordering", choices=list(ORDERINGS), default='raster')
+    columnar = BooleanParameter("Also save columnar (.npz) results", default=False)
+    adaptive = BooleanParameter("Adaptive refinement", default=False)
+    refine_gradient = FloatParameter("Refinement gradient threshold", units="T/deg", default=0.001)
+    refine_residual = FloatParameter("Refinement residual threshold", units="%", default=1.)
+    max_points = IntegerParameter("Adaptive point budget", default=500)
+    max_depth = IntegerParameter("Maximum refinement depth", default=3)
+    tree_file = Parameter("Refinement tree file", default='')
     phi_start = FloatParameter("Phi Start Position", units="mm", default=10.)
     phi_end = FloatParameter("Phi End Position", units="mm", default=13.)
     phi_step = FloatParameter("Phi Scan Step Size", units="mm", default=0.1)
@@ -38,30 +59,61 @@ class icarusCalibCheckFieldSweepProcedure(Procedure):
     theta_step = FloatParameter("Theta Scan Step Size", units="mm", default=0.1)
     calib_file = Parameter("Magnet Calibration Filename", default='./calibrations')
     station_name = Parameter("Probe Station Name", default='')
+    shared_session = BooleanParameter("Keep instruments open across the field sweep", default=False)
 
     first = True
     last = True
+    sweep_id = None
+    sweep_index = 0
 
     DATA_COLUMNS = ["phi","theta","X", "Y", "act_phi", "act_theta", "Xfield_avg","Yfield_avg","Zfield_avg","Xfield_std",
-                    "Yfield_std","Zfield_std", "Bmag", "Bmag_deviation", "Bmag_percent_dev", "V", "act_V"  ]
+                    "Yfield_std","Zfield_std", "Bmag", "Bmag_deviation", "Bmag_percent_dev", "V", "act_V", "phi_index", "theta_index"  ]
 
     def startup(self):
         log.info("Using calibration file: " + self.calib_file + " on station: " + self.station_name)
-        log.info("Connecting and configuring the instruments")
-        self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
-        self.magnet = daedalusProjField(DAQmxAdapter('Dev2', ['ao0', 'ai1']),"GPIB::10")
-        for err in self.magnet.errors:
-        	log.warning('%s' % err)
-        self.magnet.load_calibration_params(self.calib_file)
-        self.x_zero, self.y_zero, self.z_zero = 0.0437063, 0.0434812, 0.0437816 #zero point of Hall probe calibrated using LakeShore Gaussmeter
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        self.session = get_session()
+        with self.timer('connect'):
+            connected = self.session.connect()
+        self.hall_probe = self.session.hall_probe
+        self.magnet = self.session.magnet
+        self.volt_tasks = self.session.volt_tasks
+        with self.timer('calibration'):
+            self.session.load_calibration(self.calib_file)
+            self.validate_scan(self.calib_file)
+        self.x_zero, self.y_zero, self.z_zero = self.session.probe_zero #zero point of Hall probe calibrated using LakeShore Gaussmeter
         log.info("Setting magnet field to %.2f T"%self.mag_field)
-        log.info("Setting magnet position to Phi: {0}, Theta: {1}".format(self.phi_start, self.theta_start))
-        self.magnet.set_vector_field(self.mag_field, self.phi_start, self.theta_start)
-        while self.magnet.in_motion:
-            sleep(0.05)
-        sleep(.1)
-        for err in self.magnet.errors:
-            log.warning('%s'%err)
+        if self.shared_session and not self.first and not connected:
+            # the magnet ramps straight to this field with the first move of the scan
+            log.info("Continuing field sweep from the previous field step")
+        else:
+            log.info("Setting magnet position to Phi: {0}, Theta: {1}".format(self.phi_start, self.theta_start))
+            with self.timer('move'):
+                self.magnet.set_vector_field(self.mag_field, self.phi_start, self.theta_start)
+            with self.timer('in_motion'):
+                while self.magnet.in_motion:
+                    sleep(0.05)
+                sleep(.1)
+            with self.timer('errors'):
+                for err in self.magnet.errors:
+                    log.warning('%s'%err)
+        if self.buffered:
+            num_samples = max(int(round(self.sample_rate*self.averaging_window)), 1)
+            log.info("Using buffered acquisition of %d samples at %g Hz"%(num_samples, self.sample_rate))
+            with self.timer('buffer_setup'):
+                self.probe_buffer = self.session.buffer(self.sample_rate, num_samples)
+
+    def validate_scan(self, calib_name):
+        """ Checks the whole planned scan against the calibration before anything moves """
+        try:
+            table = calibrationTable(calib_name)
+        except (IOError, OSError, ValueError) as e:
+            log.warning("Could not build calibration tables from %s: %s" % (calib_name, e))
+            return
+        phis, thetas = np.meshgrid(grid_axis(self.phi_start, self.phi_end, self.phi_step),
+                                   grid_axis(self.theta_start, self.theta_end, self.theta_step))
+        table.validate(self.mag_field, phis, thetas)
 
     def get_Bx_zeroed(self):
         return (self.hall_probe.x_field - self.x_zero)
@@ -72,75 +124,137 @@ class icarusCalibCheckFieldSweepProcedure(Procedure):
     def get_Bz_zeroed(self):
         return -1*(self.hall_probe.z_field - self.z_zero)
 
-    def execute(self):
-        phis = np.arange(self.phi_start, self.phi_end + self.phi_step, self.phi_step)
-        thetas = np.arange(self.theta_start, self.theta_end + self.theta_step, self.theta_step)
-
-        num_progress = float(phis.size * thetas.size) * self.num_averages
-        progress_iterator = 0
-        self.emit('progress',int(100*progress_iterator/num_progress))
-
-        for theta in thetas:
-            for phi in phis:
-                log.info("moving magnet to Phi: %g deg, Theta: %g deg"%(phi, theta))
-                self.magnet.set_vector_field(self.mag_field, phi, theta)
-                # wait for all motion to finish
+    def get_B_block_zeroed(self):
+        """ Returns one hardware-timed (N, 3) block of zeroed X, Y, Z fields """
+        fields = self.probe_buffer.acquire()
+        return np.column_stack(zeroed(fields[:, 0], fields[:, 1], fields[:, 2], (self.x_zero, self.y_zero, self.z_zero)))
+
+    def move_to(self, point):
+        log.info("moving magnet to Phi: %g deg, Theta: %g deg"%(point.fast, point.slow))
+        with self.timer('move', key=point):
+            self.magnet.set_vector_field(self.mag_field, point.fast, point.slow)
+
+    def sample_point(self):
+        """ Reads the magnet voltage and the averaged Hall probe fields at the current position """
+        with self.timer('set_volts'):
+            set_v = self.magnet.set_volts
+        with self.timer('read_volts'):
+            v = self.volt_tasks.read()
+        fields = runningStats()
+        if self.buffered:
+            with self.timer('probe'):
+                fields.add_block(self.get_B_block_zeroed())
+            self.progress_iterator += 1
+            self.emit('progress',int(100*self.progress_iterator/self.num_progress))
+        else:
+            for j in range(self.num_averages):
+                with self.timer('delay'):
+                    sleep(self.delay)
+                log.info("Recording average %d of %d"%(j+1,self.num_averages))
+                self.progress_iterator += 1
+                self.emit('progress',int(100*self.progress_iterator/self.num_progress))
+                with self.timer('probe'):
+                    fields.add((self.get_Bx_zeroed(), self.get_By_zeroed(), self.get_Bz_zeroed()))
+        return set_v, v, fields
+
+    def emit_point(self, point, x, y, sample):
+        set_v, v, fields = sample
+        row = fields.field_row()
+        Bmag = row["Bmag"]
+        if self.adaptive:
+            self.mesh.record(point, Bmag, (Bmag - self.mag_field)/Bmag*100)
+
+        row.update({
+        "phi": point.fast,
+        "theta": point.slow,
+        "phi_index": point.i_fast,
+        "theta_index": point.i_slow,
+        "X":x,
+        "Y":y,
+        "Bmag_deviation": Bmag - self.mag_field, 
+        "Bmag_percent_dev": (Bmag - self.mag_field)/Bmag*100,
+        "V" : set_v,  
+        "act_V" : v
+        })
+        with self.timer('emit', key=point):
+            self.emit("results", row)
+
+    def scan(self, points):
+        """ Measures the points in the given order until done or stopped """
+        if self.pipelined:
+            scheduler = rasterScheduler(self.magnet, self.move_to, self.sample_point, self.emit_point, self.should_stop,
+                                        timer=self.timer)
+            scheduler.run(points)
+            return
+
+        for point in points:
+            self.timer.next_point(point)
+            self.move_to(point)
+            # wait for all motion to finish
+            with self.timer('in_motion'):
                 while self.magnet.in_motion:
                     sleep(0.05)
+            with self.timer('errors'):
                 errors = self.magnet.errors
-                for err in errors:
-                    log.warning('%s'%err)
+            for err in errors:
+                log.warning('%s'%err)
 
+            with self.timer('position'):
                 x = self.magnet.motion_inst.x.position
                 y = self.magnet.motion_inst.y.position
-                v = self.magnet.getVolts()
+            self.emit_point(point, x, y, self.sample_point())
+            if self.should_stop():
+                log.warning("Caught stop flag in procedure")
+                break
 
-                xfields = np.array([])
-                yfields = np.array([])
-                zfields = np.array([])
-                for j in range(self.num_averages):
-                    sleep(self.delay)
-                    log.info("Recording average %d of %d"%(j+1,self.num_averages))
-                    progress_iterator += 1
-                    self.emit('progress',int(100*progress_iterator/num_progress))
-                    xfields = np.append(xfields,self.get_Bx_zeroed())
-                    yfields = np.append(yfields,self.get_By_zeroed())
-                    zfields = np.append(zfields,self.get_Bz_zeroed())
-                
-                Bmag = np.sqrt(np.mean(xfields)**2 + np.mean(yfields)**2 + np.mean(zfields)**2)
-
-                self.emit("results", {
-                "phi": phi,
-                "theta": theta,
-                "X":x,
-                "Y":y,
-                "act_phi": np.arctan2(np.mean(xfields),np.mean(yfields))*180/np.pi,
-                "act_theta": np.arctan2(np.mean(zfields), np.sqrt(np.mean(yfields)**2 + np.mean(xfields)**2))*180/np.pi,
-                "Xfield_avg": np.mean(xfields),
-                "Xfield_std": np.std(xfields),
-                "Yfield_avg": np.mean(yfields),
-                "Yfield_std": np.std(yfields),
-                "Zfield_avg": np.mean(zfields),
-                "Zfield_std": np.std(zfields),
-                "Bmag": Bmag,
-                "Bmag_deviation": Bmag - self.mag_field, 
-                "Bmag_percent_dev": (Bmag - self.mag_field)/Bmag*100,
-                "V" : self.magnet.set_volts,  
-                "act_V" : v
-                })
-                if self.should_stop():
-                    log.warning("Caught stop flag in procedure")
-                    break # out of x steps
-            else: # to catch nested loops
-                continue
-            break # out of y steps
+    def execute(self):
+        phis = np.arange(self.phi_start, self.phi_end + self.phi_step, self.phi_step)
+        thetas = np.arange(self.theta_start, self.theta_end + self.theta_step, self.theta_step)
 
+        reads_per_point = 1 if self.buffered else self.num_averages
+        num_points = self.max_points if self.adaptive else phis.size * thetas.size
+        self.num_progress = float(num_points) * reads_per_point
+        self.progress_iterator = 0
+        self.emit('progress',int(100*self.progress_iterator/self.num_progress))
+
+        if self.adaptive:
+            self.mesh = adaptiveMesh(self.phi_start, self.phi_end, self.phi_step,
+                                     self.theta_start, self.theta_end, self.theta_step,
+                                     self.refine_gradient, self.refine_residual, self.max_points, self.max_depth)
+            points = self.mesh.coarse_points()
+            while len(points) > 0 and not self.should_stop():
+                log.info("Scanning %d adaptive points"%len(points))
+                self.scan(points)
+                points = self.mesh.refine()
+            if self.tree_file:
+                self.mesh.save_tree(self.tree_file)
+            return
+
+        trajectory = make_trajectory(phis, thetas, self.scan_order)
+        if self.shared_session and self.sweep_index % 2:
+            trajectory = trajectory[::-1] # start where the previous field step ended
+        log.info("Scanning %d points in %s order"%(len(trajectory), self.scan_order))
+        self.scan(trajectory)
+
+    def continues_sweep(self):
+        """ True if the procedure queued next is the following field step of this sweep """
+        following = next_procedure()
+        return (isinstance(following, icarusCalibCheckFieldSweepProcedure) and following.shared_session
+                and following.sweep_id == self.sweep_id and following.sweep_index == self.sweep_index + 1)
 
     def shutdown(self):
+        self.timer.next_point('shutdown')
+        self.live.flush()
+        if (self.shared_session and not self.last and not self.should_stop() and self.status != Procedure.FAILED
+                and self.continues_sweep()):
+            log.info("Done with image scan. Keeping instruments open for the next field step")
+            park_session()
+            return
         log.info("Done with image scan. Shutting down instruments")
-        self.magnet.voltage = 0.
+        with self.timer('shutdown'):
+            close_session()
 
-class icarusCalibCheckFieldSweepGUI(ManagedWindow):
+class icarusCalibCheckFieldSweepGUI(livePlotWindow, ManagedWindow):
         SWEEP_PARAM_NAMES = ['field']
         NUM_SWEEP_PARAMS = len(SWEEP_PARAM_NAMES)
 
@@ -160,6 +274,14 @@ class icarusCalibCheckFieldSweepGUI(ManagedWindow):
                 #z_axis='Xfield_avg'
             )
             self.setWindowTitle('Icarus Calib Check FieldSweep GUI')
+            self.sweep_ids = count()
+            set_queue_lookup(self.next_queued_procedure)
+
+        def next_queued_procedure(self):
+            """ The procedure the manager runs next, or None if the queue is empty """
+            if self.manager.experiments.has_next():
+                return self.manager.experiments.next().procedure
+            return None
 
         def identifySystem(self):
                 hostname = socket.gethostname()
@@ -182,6 +304,16 @@ class icarusCalibCheckFieldSweepGUI(ManagedWindow):
             procedure.mag_field = self.inputs.mag_field.value()
             procedure.num_averages = self.inputs.num_averages.value()
             procedure.delay = self.inputs.delay.value()
+            procedure.buffered = self.inputs.buffered.isChecked()
+            procedure.sample_rate = self.inputs.sample_rate.value()
+            procedure.averaging_window = self.inputs.averaging_window.value()
+            procedure.pipelined = self.inputs.pipelined.isChecked()
+            procedure.scan_order = self.inputs.scan_order.currentText()
+            procedure.columnar = self.inputs.columnar.isChecked()
+            procedure.adaptive = self.inputs.adaptive.isChecked()
+            procedure.refine_gradient = self.inputs.refine_gradient.value()
+            procedure.refine_residual = self.inputs.refine_residual.value()
+            procedure.max_points = self.inputs.max_points.value()
             procedure.calib_file = self.inputs.calib_file.text()
             procedure.station_name = self.identifySystem()
 
@@ -199,14 +331,40 @@ class icarusCalibCheckFieldSweepGUI(ManagedWindow):
                 Makes a series of procedures varying fields
                 """
                 procedures = []
-                for field in fields:
+                fields = ramp_order(fields)
+                sweep_id = next(self.sweep_ids)
+                for i, field in enumerate(fields):
                     procedure = self.make_procedure()
                     procedure.mag_field = field
-                    procedure.first = False
-                    procedure.last = False
+                    procedure.shared_session = True
+                    procedure.sweep_id = sweep_id
+                    procedure.sweep_index = i
+                    procedure.first = i == 0
+                    procedure.last = i == len(fields) - 1
                     procedures.append(procedure)
                 return procedures
 
+        def log_travel_estimates(self, procedure):
+            """ Logs the estimated motion time of every scan ordering before queueing """
+            phis = grid_axis(procedure.phi_start, procedure.phi_end, procedure.phi_step)
+            thetas = grid_axis(procedure.theta_start, procedure.theta_end, procedure.theta_step)
+            for ordering, seconds in compare_orderings(phis, thetas).items():
+                log.info("Estimated travel time in %s order: %.0f s"%(ordering, seconds))
+
+        def finished(self, experiment):
+            """ Writes the phase timings and the columnar copy of the results once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+            if experiment.procedure.columnar:
+                log.info("Saved columnar results to %s" % save_results(experiment.results))
+            if not self.manager.experiments.has_next():
+                close_session() # the queue has run out
+
+        def abort_returned(self, experiment):
+            """ Ramps the magnet down and releases the instruments when the queue is aborted """
+            super().abort_returned(experiment)
+            close_session()
+
         def queue(self):
                 do_sweep = self.inputs.do_sweeps.isChecked()
                 direc = self.inputs.save_dir.text()
@@ -220,6 +378,7 @@ class icarusCalibCheckFieldSweepGUI(ManagedWindow):
 
                 else:
                     procedures = [self.make_procedure()]
+                self.log_travel_estimates(procedures[0])
 
                 for procedure in procedures:
                     # ensure *some* sample name exists so Results.load() works
@@ -232,6 +391,9 @@ class icarusCalibCheckFieldSweepGUI(ManagedWindow):
                     filename = unique_filename(direc,dated_folder=True,suffix=suf,
                                                prefix=pre)
 
+                    if procedure.adaptive:
+                        procedure.tree_file = os.path.splitext(filename)[0] + '_tree.csv'
+
                     # Queue experiment
                     results = Results(procedure,filename)
                     experiment = self.new_experiment(results)
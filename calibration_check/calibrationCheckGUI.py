@@ -5,13 +5,23 @@ log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 import numpy as np
-from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter, BooleanParameter, ListParameter
 from pymeasure.log import console_log
 from pymeasure.experiment import Procedure
-from pymeasure.adapters import DAQmxAdapter
-from daedalus.custom_instruments import daedalusProjField, senis3AxHallProbe
+from instruments import DAQmxAdapter, senis3AxHallProbe, bufferedHallProbe, connect_magnet
+from rasterScheduler import rasterScheduler
+from runningStats import runningStats
+from fieldMath import load_probe_zero, zeroed
+from calibrationTable import calibrationTable, calibration_hash
+from calibrationBundle import resolve_calibration
+from resultsStore import save_results
+from scanTrajectory import ORDERINGS, grid_axis, make_trajectory, compare_orderings
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
+from scanCheckpoint import scanCheckpoint, RUNNING, FINISHED, ABORTED, FAILED
 
 from pymeasure.display.windows import ManagedImageWindow
+from livePlot import livePlotWindow
 from pymeasure.experiment import Results, unique_filename
 import sys
 from pymeasure.log import console_log
@@ -28,6 +38,12 @@ class icarusCalibCheckProcedure(Procedure):
     mag_field = FloatParameter("Magnetic field strength", units="T", default=0.1)
     num_averages = IntegerParameter("Number of Averages", default=1)
     delay = FloatParameter("Delay between averages", units="s", default=.1)
+    buffered = BooleanParameter("Hardware-timed buffered acquisition", default=False)
+    sample_rate = FloatParameter("Buffered sample rate", units="Hz", default=1000.)
+    averaging_window = FloatParameter("Buffered averaging window", units="s", default=0.1)
+    pipelined = BooleanParameter("Overlap motion with acquisition", default=False)
+    scan_order = ListParameter("Scan ordering", choices=list(ORDERINGS), default='raster')
+    columnar = BooleanParameter("Also save columnar (.npz) results", default=False)
 
     mag_calib_name = Parameter("Magnet Calibration Filename", default='./calibrations/icarus')
 
@@ -39,24 +55,74 @@ class icarusCalibCheckProcedure(Procedure):
     theta_step = FloatParameter("Theta Scan Step Size", units="mm", default=0.1)
 
     DATA_COLUMNS = ["phi","theta","X", "Y", "act_phi", "act_theta", "Xfield_avg","Yfield_avg","Zfield_avg","Xfield_std",
-                    "Yfield_std","Zfield_std", "Bmag", "V", "act_V"  ]
+                    "Yfield_std","Zfield_std", "Bmag", "V", "act_V", "phi_index", "theta_index"  ]
 
     def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        self.checkpoint = None
         log.info("Connecting and configuring the instruments")
-        self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
-        self.magnet = daedalusProjField(DAQmxAdapter('Dev2', ['ao0', 'ai1']),"GPIB::10")
-        for err in self.magnet.errors:
-        	log.warning('%s' % err)
-        self.magnet.load_calibration_params(self.mag_calib_name)
-        self.x_zero, self.y_zero, self.z_zero = 0.0437063, 0.0434812, 0.0437816 #zero point of Hall probe calibrated using LakeShore Gaussmeter
+        with self.timer('connect'):
+            self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+            self.magnet = connect_magnet()
+            self.volt_tasks = self.magnet.tasks
+        with self.timer('calibration'):
+            calib_name, zero = resolve_calibration(self.mag_calib_name)
+            self.magnet.load_calibration_params(calib_name)
+            self.validate_scan(self.mag_calib_name)
+        self.setup_checkpoint()
+        self.x_zero, self.y_zero, self.z_zero = load_probe_zero() if zero is None else zero #zero point of Hall probe calibrated using LakeShore Gaussmeter
         log.info("Setting magnet field to %.2f T"%self.mag_field)
         log.info("Setting magnet position to Phi: {0}, Theta: {1}".format(self.phi_start, self.theta_start))
-        self.magnet.set_vector_field(self.mag_field, self.phi_start, self.theta_start)
-        while self.magnet.in_motion:
-            sleep(0.05)
-        sleep(.1)
-        for err in self.magnet.errors:
-            log.warning('%s'%err)
+        with self.timer('move'):
+            self.magnet.set_vector_field(self.mag_field, self.phi_start, self.theta_start)
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+            sleep(.1)
+        with self.timer('errors'):
+            for err in self.magnet.errors:
+                log.warning('%s'%err)
+        if self.buffered:
+            num_samples = max(int(round(self.sample_rate*self.averaging_window)), 1)
+            log.info("Using buffered acquisition of %d samples at %g Hz"%(num_samples, self.sample_rate))
+            with self.timer('buffer_setup'):
+                self.probe_buffer = bufferedHallProbe(self.hall_probe.adapter, self.sample_rate, num_samples)
+                self.probe_buffer.calibrate_scale(self.hall_probe)
+
+    def validate_scan(self, calib_name):
+        """ Checks the whole planned scan against the calibration before anything moves """
+        try:
+            table = calibrationTable(calib_name)
+        except (IOError, OSError, ValueError) as e:
+            log.warning("Could not build calibration tables from %s: %s" % (calib_name, e))
+            return
+        phis, thetas = np.meshgrid(grid_axis(self.phi_start, self.phi_end, self.phi_step),
+                                   grid_axis(self.theta_start, self.theta_end, self.theta_step))
+        table.validate(self.mag_field, phis, thetas)
+
+    def setup_checkpoint(self):
+        """ Checkpoints the run next to its results, resuming it if the results file already has rows """
+        self.done = set()
+        if self.live.data_filename is None:
+            return
+        self.checkpoint = scanCheckpoint(self.live.data_filename, self,
+                                         {'calibration': calibration_hash(self.mag_calib_name)})
+        rows = self.checkpoint.resume(lambda rows: [[int(i), int(j)] for i, j in zip(rows.phi_index, rows.theta_index)])
+        if rows is not None:
+            for row in rows.to_dict('records'):
+                self.live.buffer.append(row) # plot the points measured before
+        self.done = set(tuple(index) for index in self.checkpoint.completed)
+        self.checkpoint.save()
+
+    def save_checkpoint(self, status=RUNNING):
+        self.live.flush() # every checkpointed point is in the results file
+        self.checkpoint.save(status)
+
+    def checkpoint_status(self):
+        if len(self.checkpoint.completed) >= getattr(self, 'num_points', np.inf):
+            return FINISHED
+        return ABORTED if self.should_stop() else FAILED
 
     def get_Bx_zeroed(self):
         return (self.hall_probe.x_field - self.x_zero)
@@ -67,72 +133,119 @@ class icarusCalibCheckProcedure(Procedure):
     def get_Bz_zeroed(self):
         return -1*(self.hall_probe.z_field - self.z_zero)
 
+    def get_B_block_zeroed(self):
+        """ Returns one hardware-timed (N, 3) block of zeroed X, Y, Z fields """
+        fields = self.probe_buffer.acquire()
+        return np.column_stack(zeroed(fields[:, 0], fields[:, 1], fields[:, 2], (self.x_zero, self.y_zero, self.z_zero)))
+
+    def move_to(self, point):
+        log.info("moving magnet to Phi: %g deg, Theta: %g deg"%(point.fast, point.slow))
+        with self.timer('move', key=point):
+            self.magnet.set_vector_field(self.mag_field, point.fast, point.slow)
+
+    def sample_point(self):
+        """ Reads the magnet voltage and the averaged Hall probe fields at the current position """
+        with self.timer('set_volts'):
+            set_v = self.magnet.setvolts
+        with self.timer('read_volts'):
+            v = self.volt_tasks.read()
+        fields = runningStats()
+        if self.buffered:
+            with self.timer('probe'):
+                fields.add_block(self.get_B_block_zeroed())
+            self.progress_iterator += 1
+            self.emit('progress',int(100*self.progress_iterator/self.num_progress))
+        else:
+            for j in range(self.num_averages):
+                with self.timer('delay'):
+                    sleep(self.delay)
+                log.info("Recording average %d of %d"%(j+1,self.num_averages))
+                self.progress_iterator += 1
+                self.emit('progress',int(100*self.progress_iterator/self.num_progress))
+                with self.timer('probe'):
+                    fields.add((self.get_Bx_zeroed(), self.get_By_zeroed(), self.get_Bz_zeroed()))
+        return set_v, v, fields
+
+    def emit_point(self, point, x, y, sample):
+        set_v, v, fields = sample
+        row = fields.field_row()
+        row.update({
+        "phi": point.fast,
+        "theta": point.slow,
+        "phi_index": point.i_fast,
+        "theta_index": point.i_slow,
+        "X":x,
+        "Y":y,
+        "V" : set_v,  
+        "act_V" : v
+        })
+        with self.timer('emit', key=point):
+            self.emit("results", row)
+        state = {'mag_field': self.mag_field, 'phi': point.fast, 'theta': point.slow,
+                 'X': float(x), 'Y': float(y), 'V': float(set_v)}
+        if self.checkpoint is not None and self.checkpoint.add([point.i_fast, point.i_slow], state):
+            with self.timer('checkpoint', key=point):
+                self.save_checkpoint()
+
     def execute(self):
         phis = np.arange(self.phi_start, self.phi_end + self.phi_step, self.phi_step)
         thetas = np.arange(self.theta_start, self.theta_end + self.theta_step, self.theta_step)
 
-        num_progress = float(phis.size * thetas.size) * self.num_averages
-        progress_iterator = 0
-        self.emit('progress',int(100*progress_iterator/num_progress))
+        reads_per_point = 1 if self.buffered else self.num_averages
+        self.num_points = phis.size * thetas.size
+        self.num_progress = float(self.num_points) * reads_per_point
+        self.progress_iterator = len(self.done) * reads_per_point
+        self.emit('progress',int(100*self.progress_iterator/self.num_progress))
 
-        for theta in thetas:
-            for phi in phis:
-                log.info("moving magnet to Phi: %g deg, Theta: %g deg"%(phi, theta))
-                self.magnet.set_vector_field(self.mag_field, phi, theta)
-                # wait for all motion to finish
+        trajectory = make_trajectory(phis, thetas, self.scan_order)
+        if self.done:
+            trajectory = [p for p in trajectory if (p.i_fast, p.i_slow) not in self.done]
+            log.info("Resuming with %d of %d points already measured"%(self.num_points - len(trajectory), self.num_points))
+        log.info("Scanning %d points in %s order"%(len(trajectory), self.scan_order))
+
+        if self.pipelined:
+            scheduler = rasterScheduler(self.magnet, self.move_to, self.sample_point, self.emit_point, self.should_stop,
+                                        timer=self.timer)
+            scheduler.run(trajectory)
+            return
+
+        for point in trajectory:
+            self.timer.next_point(point)
+            self.move_to(point)
+            # wait for all motion to finish
+            with self.timer('in_motion'):
                 while self.magnet.in_motion:
                     sleep(0.05)
+            with self.timer('errors'):
                 errors = self.magnet.errors
-                for err in errors:
-                    log.warning('%s'%err)
+            for err in errors:
+                log.warning('%s'%err)
 
+            with self.timer('position'):
                 x = self.magnet.motion_inst.x.position
                 y = self.magnet.motion_inst.y.position
-                v = self.magnet.getVolts()
-
-                xfields = np.array([])
-                yfields = np.array([])
-                zfields = np.array([])
-                for j in range(self.num_averages):
-                    sleep(self.delay)
-                    log.info("Recording average %d of %d"%(j+1,self.num_averages))
-                    progress_iterator += 1
-                    self.emit('progress',int(100*progress_iterator/num_progress))
-                    xfields = np.append(xfields,self.get_Bx_zeroed())
-                    yfields = np.append(yfields,self.get_By_zeroed())
-                    zfields = np.append(zfields,self.get_Bz_zeroed())
-                self.emit("results", {
-                "phi": phi,
-                "theta": theta,
-                "X":x,
-                "Y":y,
-                "act_phi": np.arctan2(np.mean(xfields),np.mean(yfields))*180/np.pi,
-                "act_theta": np.arctan2(np.mean(zfields), np.sqrt(np.mean(yfields)**2 + np.mean(xfields)**2))*180/np.pi,
-                "Xfield_avg": np.mean(xfields),
-                "Xfield_std": np.std(xfields),
-                "Yfield_avg": np.mean(yfields),
-                "Yfield_std": np.std(yfields),
-                "Zfield_avg": np.mean(zfields),
-                "Zfield_std": np.std(zfields),
-                "Bmag": np.sqrt(np.mean(xfields)**2 + np.mean(yfields)**2 + np.mean(zfields)**2),
-                "V" : self.magnet.setvolts,  
-                "act_V" : v
-                })
-                if self.should_stop():
-                    log.warning("Caught stop flag in procedure")
-                    break # out of x steps
-            else: # to catch nested loops
-                continue
-            break # out of y steps
+            self.emit_point(point, x, y, self.sample_point())
+            if self.should_stop():
+                log.warning("Caught stop flag in procedure")
+                break
 
 
     def shutdown(self):
         log.info("Done with image scan. Shutting down instruments")
-        self.magnet.volts = 0.
-        self.magnet.phi = 0.
+        self.timer.next_point('shutdown')
+        if self.checkpoint is not None:
+            self.save_checkpoint(self.checkpoint_status())
+        else:
+            self.live.flush()
+        with self.timer('shutdown'):
+            self.magnet.volts = 0.
+            self.magnet.phi = 0.
+            if self.buffered:
+                self.probe_buffer.close()
+            self.volt_tasks.close()
 
 
-class icarusCalibCheckGUI(ManagedImageWindow):
+class icarusCalibCheckGUI(livePlotWindow, ManagedImageWindow):
         def __init__(self):
             super().__init__(
                 procedure_class=icarusCalibCheckProcedure,
@@ -167,6 +280,12 @@ class icarusCalibCheckGUI(ManagedImageWindow):
             procedure.mag_field = self.inputs.mag_field.value()
             procedure.num_averages = self.inputs.num_averages.value()
             procedure.delay = self.inputs.delay.value()
+            procedure.buffered = self.inputs.buffered.isChecked()
+            procedure.sample_rate = self.inputs.sample_rate.value()
+            procedure.averaging_window = self.inputs.averaging_window.value()
+            procedure.pipelined = self.inputs.pipelined.isChecked()
+            procedure.scan_order = self.inputs.scan_order.currentText()
+            procedure.columnar = self.inputs.columnar.isChecked()
 
             procedure.phi_start = self.inputs.phi_start.value()
             procedure.phi_end = self.inputs.phi_end.value()
@@ -177,7 +296,24 @@ class icarusCalibCheckGUI(ManagedImageWindow):
 
             return procedure
 
+        def log_travel_estimates(self, procedure):
+            """ Logs the estimated motion time of every scan ordering before queueing """
+            phis = grid_axis(procedure.phi_start, procedure.phi_end, procedure.phi_step)
+            thetas = grid_axis(procedure.theta_start, procedure.theta_end, procedure.theta_step)
+            for ordering, seconds in compare_orderings(phis, thetas).items():
+                log.info("Estimated travel time in %s order: %.0f s"%(ordering, seconds))
+
+        def finished(self, experiment):
+            """ Writes the phase timings and the columnar copy of the results once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+            if experiment.procedure.columnar:
+                log.info("Saved columnar results to %s" % save_results(experiment.results))
+
         def queue(self):
+            if self.inputs.resume_file.text():
+                self.resume(self.inputs.resume_file.text())
+                return
             fname = unique_filename(
                 self.inputs.save_dir.text(),
                 dated_folder=True,
@@ -185,10 +321,20 @@ class icarusCalibCheckGUI(ManagedImageWindow):
                 suffix=''
             )
             procedure = self.make_procedure()
+            self.log_travel_estimates(procedure)
             results = Results(procedure, fname)
             experiment = self.new_experiment(results)
             self.manager.queue(experiment)
 
+        def resume(self, fname):
+            """ Queues an earlier run again, appending to its results file from its checkpoint """
+            results = Results.load(fname, icarusCalibCheckProcedure)
+            results.procedure.status = Procedure.QUEUED
+            log.info("Resuming %s" % fname)
+            experiment = self.new_experiment(results)
+            self.manager.queue(experiment)
+            self.inputs.resume_file.setText('')
+
 if __name__ == "__main__":
     app = QtGui.QApplication(sys.argv)
     window = icarusCalibCheckGUI()
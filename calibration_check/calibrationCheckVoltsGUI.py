@@ -8,10 +8,14 @@ import numpy as np
 from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter
 from pymeasure.log import console_log
 from pymeasure.experiment import Procedure
-from pymeasure.adapters import DAQmxAdapter
-from daedalus.custom_instruments import daedalusProjField, senis3AxHallProbe
+from instruments import DAQmxAdapter, senis3AxHallProbe, connect_magnet
+from runningStats import runningStats
+from phaseTimer import phaseTimer, save_timing
+from calibrationBundle import resolve_calibration
+from liveResults import forward_results
 
 from pymeasure.display.windows import ManagedImageWindow
+from livePlot import livePlotWindow
 from pymeasure.experiment import Results, unique_filename
 import sys
 from pymeasure.log import console_log
@@ -42,22 +46,28 @@ class icarusCalibCheckProcedure(Procedure):
                     "Yfield_std","Zfield_std", "Bmag", "V", "act_V"  ]
 
     def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
         log.info("Connecting and configuring the instruments")
-        self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
-        self.magnet = daedalusProjField(DAQmxAdapter('Dev2', ['ao0', 'ai1']),"GPIB::10")
-        for err in self.magnet.errors:
-        	log.warning('%s' % err)
-        self.magnet.load_calibration_params(self.mag_calib_name)
+        with self.timer('connect'):
+            self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+            self.magnet = connect_magnet()
+            self.volt_tasks = self.magnet.tasks
+        with self.timer('calibration'):
+            self.magnet.load_calibration_params(resolve_calibration(self.mag_calib_name)[0])
 
         log.info("Setting magnet field to %.2f V"%self.mag_field)
         log.info("Setting magnet position to Phi: {0}, Theta: {1}".format(self.phi_start, self.theta_start))
         # self.magnet.set_vector_field(self.mag_field, self.phi_start, self.theta_start)
-        self.magnet.setVolts(self.mag_field)
-        while self.magnet.in_motion:
-            sleep(0.05)
-        sleep(.1)
-        for err in self.magnet.errors:
-            log.warning('%s'%err)
+        with self.timer('set_volts'):
+            self.magnet.setVolts(self.mag_field)
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+            sleep(.1)
+        with self.timer('errors'):
+            for err in self.magnet.errors:
+                log.warning('%s'%err)
 
     def get_Bz(self):
         return -1*self.hall_probe.z_field
@@ -73,49 +83,51 @@ class icarusCalibCheckProcedure(Procedure):
         for theta in thetas:
             for phi in phis:
                 log.info("moving magnet to Phi: %g deg, Theta: %g deg"%(phi, theta))
-                if not np.isclose(self.magnet._phi, phi, atol=1e-4):
-                    self.magnet.motion_inst.phi.position = phi # see phi setter function
-                    self.magnet._phi = phi
+                self.timer.next_point((phi, theta))
+                with self.timer('move'):
+                    if not np.isclose(self.magnet._phi, phi, atol=1e-4):
+                        self.magnet.motion_inst.phi.position = phi # see phi setter function
+                        self.magnet._phi = phi
                 # self.magnet.set_vector_field(self.mag_field, phi, theta)
                 # wait for all motion to finish
-                while self.magnet.in_motion:
-                    sleep(0.05)
-                errors = self.magnet.errors
+                with self.timer('in_motion'):
+                    while self.magnet.in_motion:
+                        sleep(0.05)
+                with self.timer('errors'):
+                    errors = self.magnet.errors
                 for err in errors:
                     log.warning('%s'%err)
 
-                x = self.magnet.motion_inst.x.position
-                y = self.magnet.motion_inst.y.position
-                v = self.magnet.getVolts()
+                with self.timer('position'):
+                    x = self.magnet.motion_inst.x.position
+                    y = self.magnet.motion_inst.y.position
+                with self.timer('read_volts'):
+                    v = self.volt_tasks.read()
 
-                xfields = np.array([])
-                yfields = np.array([])
-                zfields = np.array([])
+                fields = runningStats()
                 for j in range(self.num_averages):
-                    sleep(self.delay)
+                    with self.timer('delay'):
+                        sleep(self.delay)
                     log.info("Recording average %d of %d"%(j+1,self.num_averages))
                     progress_iterator += 1
                     self.emit('progress',int(100*progress_iterator/num_progress))
-                    xfields = np.append(xfields,self.hall_probe.x_field)
-                    yfields = np.append(yfields,self.hall_probe.y_field)
-                    zfields = np.append(zfields,self.get_Bz())
-                self.emit("results", {
+                    with self.timer('probe'):
+                        fields.add((self.hall_probe.x_field, self.hall_probe.y_field, self.get_Bz()))
+                with self.timer('set_volts'):
+                    set_v = self.magnet.volts
+                row = fields.field_row()
+                x_avg, y_avg, z_avg = fields.mean
+                row.update({
+                "act_phi": np.arctan(x_avg/y_avg)*180/np.pi, # as recorded by the archived Volts checks
                 "phi": phi,
                 "theta": theta,
                 "X":x,
                 "Y":y,
-                "act_phi": np.arctan(np.mean(xfields)/np.mean(yfields))*180/np.pi,
-                "act_theta": np.arctan(np.mean(zfields)/np.sqrt(np.mean(yfields)**2 + np.mean(xfields)**2))*180/np.pi,
-                "Xfield_avg": np.mean(xfields),
-                "Xfield_std": np.std(xfields),
-                "Yfield_avg": np.mean(yfields),
-                "Yfield_std": np.std(yfields),
-                "Zfield_avg": np.mean(zfields),
-                "Zfield_std": np.std(zfields),
-                "Bmag": np.sqrt(np.mean(xfields)**2 + np.mean(yfields)**2 + np.mean(zfields)**2),
-                "V" : self.magnet.volts,  
+                "V" : set_v,  
                 "act_V" : v
                 })
+                with self.timer('emit'):
+                    self.emit("results", row)
                 if self.should_stop():
                     log.warning("Caught stop flag in procedure")
                     break # out of x steps
@@ -126,9 +138,13 @@ class icarusCalibCheckProcedure(Procedure):
 
     def shutdown(self):
         log.info("Done with image scan. Shutting down instruments")
-        self.magnet.voltage = 0.
+        self.timer.next_point('shutdown')
+        self.live.flush()
+        with self.timer('shutdown'):
+            self.magnet.voltage = 0.
+            self.volt_tasks.close()
 
-class icarusCalibCheckGUI(ManagedImageWindow):
+class icarusCalibCheckGUI(livePlotWindow, ManagedImageWindow):
         def __init__(self):
             super().__init__(
                 procedure_class=icarusCalibCheckProcedure,
@@ -173,6 +189,11 @@ class icarusCalibCheckGUI(ManagedImageWindow):
 
             return procedure
 
+        def finished(self, experiment):
+            """ Writes the phase timings once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+
         def queue(self):
             fname = unique_filename(
                 self.inputs.save_dir.text(),
@@ -0,0 +1,227 @@
+import logging
+from time import sleep
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+import pandas as pd
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter
+from pymeasure.experiment import Procedure
+from instrumentSession import get_session, close_session
+from runningStats import runningStats
+from calibrationTable import calibrationTable
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
+from driftCheck import (check_points, tour_order, point_errors, drift_estimate, drift_status, reference_check,
+                        log_check, recalibration_due, format_estimate, DRIFT_QUANTITIES, RECALIBRATE, INCONCLUSIVE)
+
+from pymeasure.display.windows import ManagedWindow
+from livePlot import livePlotWindow
+from pymeasure.experiment import Results, unique_filename
+import sys
+from pymeasure.display.Qt import QtGui
+
+
+class icarusCalibHealthCheckProcedure(Procedure):
+    """
+    Spot check of the magnet calibration at a few space-filling (B, phi, theta) points.
+
+    The points are measured in batches until the drift of |B|, phi and theta from the
+    reference check is decided either way (see driftCheck), or max_points have been
+    measured. The result is appended to the health log of the calibration; a full
+    recalibration is only asked for when a drift is beyond its threshold.
+    """
+
+    # control parameters
+    name = Parameter("Calibration Name", default='')
+    calib_file = Parameter("Magnet Calibration Filename", default='./calibrations/icarus')
+    reference_file = Parameter("Reference check results file", default='')
+    field_min = FloatParameter("Minimum field", units="T", default=0.02)
+    field_max = FloatParameter("Maximum field", units="T", default=0.15)
+    phi_min = FloatParameter("Minimum phi", units="deg", default=0.)
+    phi_max = FloatParameter("Maximum phi", units="deg", default=90.)
+    theta_min = FloatParameter("Minimum theta", units="deg", default=-60.)
+    theta_max = FloatParameter("Maximum theta", units="deg", default=60.)
+    num_points = IntegerParameter("Number of check points", default=16)
+    batch_points = IntegerParameter("Extra points per batch while undecided", default=8)
+    max_points = IntegerParameter("Maximum number of check points", default=48)
+    confidence = FloatParameter("Confidence level", default=0.95)
+    field_threshold = FloatParameter("Field drift threshold", units="%", default=1.)
+    angle_threshold = FloatParameter("Angle drift threshold", units="deg", default=1.)
+    num_averages = IntegerParameter("Number of Averages", default=3)
+    delay = FloatParameter("Delay between averages", units="s", default=.1)
+
+    DATA_COLUMNS = ["point", "B", "phi", "theta", "X", "Y", "act_phi", "act_theta", "Xfield_avg", "Yfield_avg", "Zfield_avg",
+                    "Xfield_std", "Yfield_std", "Zfield_std", "Bmag", "V", "act_V"] + DRIFT_QUANTITIES
+
+    def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        self.estimate = None
+        self.verdict = None
+        self.session = get_session()
+        with self.timer('connect'):
+            self.session.connect()
+        self.hall_probe = self.session.hall_probe
+        self.magnet = self.session.magnet
+        self.volt_tasks = self.session.volt_tasks
+        with self.timer('calibration'):
+            self.session.load_calibration(self.calib_file)
+            self.table = calibrationTable(self.calib_file)
+        if recalibration_due(self.calib_file):
+            log.warning("The last health check of %s asked for a recalibration" % self.calib_file)
+        self.x_zero, self.y_zero, self.z_zero = self.session.probe_zero #zero point of Hall probe calibrated using LakeShore Gaussmeter
+        self.points = check_points(self.max_points, (self.field_min, self.field_max), (self.phi_min, self.phi_max),
+                                   (self.theta_min, self.theta_max), self.table)
+        self.reference = self.reference_file or reference_check(self.calib_file)
+        self.reference_errors = None
+        if self.reference:
+            self.reference_errors = self.load_reference(self.reference)
+            log.info("Comparing with the check in %s (%d common points)" % (self.reference, len(self.reference_errors)))
+        else:
+            log.info("No reference check of %s, comparing with the targets" % self.calib_file)
+
+    def load_reference(self, filename):
+        """ Errors of the reference check at the points it shares with this one """
+        rows = pd.read_csv(filename, comment='#')
+        rows = rows.merge(self.points, on='point', suffixes=('', '_target'))
+        same = np.all([np.isclose(rows[c], rows[c + '_target']) for c in ('B', 'phi', 'theta')], axis=0)
+        return point_errors(rows[same])
+
+    def sample_point(self):
+        """ Reads the magnet voltage and the averaged Hall probe fields at the current position """
+        with self.timer('set_volts'):
+            set_v = self.magnet.set_volts
+        with self.timer('read_volts'):
+            v = self.volt_tasks.read()
+        fields = runningStats()
+        for j in range(self.num_averages):
+            with self.timer('delay'):
+                sleep(self.delay)
+            with self.timer('probe'):
+                fields.add((self.hall_probe.x_field - self.x_zero, self.hall_probe.y_field - self.y_zero,
+                            -1*(self.hall_probe.z_field - self.z_zero)))
+        return set_v, v, fields
+
+    def measure(self, point):
+        log.info("Checking B: %.4f T, Phi: %g deg, Theta: %g deg"%(point.B, point.phi, point.theta))
+        with self.timer('move'):
+            self.magnet.set_vector_field(point.B, point.phi, point.theta)
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+        with self.timer('errors'):
+            errors = self.magnet.errors
+        for err in errors:
+            log.warning('%s'%err)
+        with self.timer('position'):
+            x = self.magnet.motion_inst.x.position
+            y = self.magnet.motion_inst.y.position
+        set_v, v, fields = self.sample_point()
+        row = fields.field_row()
+        row.update({"point": point.point, "B": point.B, "phi": point.phi, "theta": point.theta,
+                    "X": x, "Y": y, "V": set_v, "act_V": v})
+        row.update(point_errors(pd.DataFrame([row])).iloc[0][DRIFT_QUANTITIES].to_dict())
+        with self.timer('emit'):
+            self.emit("results", row)
+        return row
+
+    def evaluate(self, rows):
+        thresholds = {'Bmag_percent_dev': self.field_threshold,
+                      'phi_error': self.angle_threshold, 'theta_error': self.angle_threshold}
+        estimate = drift_estimate(point_errors(pd.DataFrame(rows)), self.reference_errors, self.confidence)
+        return drift_status(estimate, thresholds)
+
+    def execute(self):
+        rows = []
+        size = self.num_points
+        while len(rows) < min(size, len(self.points)):
+            batch = tour_order(self.points.iloc[len(rows):size])
+            log.info("Measuring %d check points"%len(batch))
+            for point in batch.itertuples():
+                self.timer.next_point(point.point)
+                rows.append(self.measure(point))
+                self.emit('progress', int(100*len(rows)/float(self.max_points)))
+                if self.should_stop():
+                    log.warning("Caught stop flag in procedure")
+                    return
+            self.estimate, self.verdict = self.evaluate(rows)
+            log.info("Drift after %d points: %s" % (len(rows), format_estimate(self.estimate)))
+            if self.verdict != INCONCLUSIVE:
+                break
+            size += self.batch_points
+        self.emit('progress', 100)
+        if self.verdict == RECALIBRATE:
+            log.error("Calibration %s has drifted beyond its thresholds, recalibrate" % self.calib_file)
+        else:
+            log.info("Calibration %s health check: %s" % (self.calib_file, self.verdict))
+        if self.live.data_filename is not None:
+            self.live.flush()
+            log_check(self.calib_file, self.live.data_filename, self.reference, self.estimate, self.verdict)
+
+    def shutdown(self):
+        log.info("Done with health check. Shutting down instruments")
+        self.timer.next_point('shutdown')
+        self.live.flush()
+        with self.timer('shutdown'):
+            close_session()
+
+
+class icarusCalibHealthCheckGUI(livePlotWindow, ManagedWindow):
+        def __init__(self):
+            super().__init__(
+                procedure_class=icarusCalibHealthCheckProcedure,
+                inputs=[
+                    'name',
+                    'calib_file',
+                    'reference_file',
+                    'field_min',
+                    'field_max',
+                    'phi_min',
+                    'phi_max',
+                    'theta_min',
+                    'theta_max',
+                    'num_points',
+                    'batch_points',
+                    'max_points',
+                    'confidence',
+                    'field_threshold',
+                    'angle_threshold',
+                    'num_averages',
+                    'delay'
+                    ],
+                displays=[
+                    'calib_file',
+                    'num_points',
+                    'field_threshold',
+                    'angle_threshold'
+                    ],
+                x_axis='point',
+                y_axis='Bmag_percent_dev',
+                directory_input=True
+            )
+            self.setWindowTitle('Icarus Calibration Health Check GUI')
+            self.directory = r'C:\Users\TopMob\icarus_calib'
+
+        def queue(self):
+            procedure = self.make_procedure()
+            fname = unique_filename(
+                self.directory,
+                dated_folder=True,
+                prefix=procedure.name + '_healthCheck_',
+                suffix=''
+            )
+            results = Results(procedure, fname)
+            experiment = self.new_experiment(results)
+            self.manager.queue(experiment)
+
+        def finished(self, experiment):
+            """ Writes the phase timings once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+
+if __name__ == "__main__":
+    app = QtGui.QApplication(sys.argv)
+    window = icarusCalibHealthCheckGUI()
+    window.show()
+    sys.exit(app.exec_())
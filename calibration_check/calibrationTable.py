@@ -0,0 +1,169 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import hashlib
+import os
+from collections import namedtuple
+import numpy as np
+from calibrationBundle import resolve_calibration, open_bundle, polynomialSet
+
+# Precomputed inverse of the projected field magnet calibration.
+#
+# load_calibration_params reads three coefficient files for a calibration name such as
+# './calibrations/icarus':
+#   <name>_radial_polar_calib.csv  R(theta) for theta > 0 and theta < 0
+#   <name>_fieldratio_calib.csv    B(R)/B(0) for vn R>0, vn R<0, vp R>0, vp R<0
+#   <name>_volt_center_calib.csv   V(B at the centre) for Yfield > 0 (vn) and < 0 (vp)
+# A target (B, phi, theta) is reached at radius R(theta) and magnet voltage
+# V(B/fieldRatio(R)), the magnet rotation giving phi. The tables sample those
+# polynomials densely once; whole scans are then inverted with np.interp, and the
+# tables are cached next to the calibration files, keyed on their contents. A name with a
+# calibration bundle (see calibrationBundle) samples the bundle's polynomials and keys
+# the cache on the files unpacked from it.
+
+CALIBRATION_FILES = ('radial_polar', 'fieldratio', 'volt_center')
+RADIAL_LIMIT = 15. # mm, travel of the radial stage
+VOLT_LIMIT = 10. # V, magnet supply range
+FIELD_LIMIT = 1. # T, largest centre field tabulated
+
+fieldTargets = namedtuple('fieldTargets', ['volts', 'R', 'phi', 'centre_field', 'valid'])
+
+
+def calibration_filenames(calib_name):
+    calib_name = resolve_calibration(calib_name)[0]
+    return [calib_name + '_%s_calib.csv' % kind for kind in CALIBRATION_FILES]
+
+
+def calibration_polynomials(calib_name):
+    """ The radial_polar, fieldratio and volt_center polynomialSets, from the bundle if there is one """
+    bundle = open_bundle(calib_name)
+    if bundle is not None:
+        return [bundle.polynomials[kind] for kind in CALIBRATION_FILES]
+    return [polynomialSet(np.loadtxt(f, delimiter=',')) for f in calibration_filenames(calib_name)]
+
+
+def calibration_hash(calib_name, *settings):
+    """ SHA1 of the coefficient files and table settings, the key of the cached tables """
+    sha = hashlib.sha1()
+    for filename in calibration_filenames(calib_name):
+        with open(filename, 'rb') as f:
+            sha.update(f.read())
+    sha.update(repr(settings).encode())
+    return sha.hexdigest()
+
+
+def interpolation_error(grid, values, func):
+    """ Largest difference between linear interpolation of the table and func, at the midpoints """
+    mid = 0.5*(grid[1:] + grid[:-1])
+    finite = np.isfinite(values[1:]) & np.isfinite(values[:-1])
+    if not finite.any():
+        return np.nan
+    return float(np.max(np.abs(0.5*(values[1:] + values[:-1]) - func(mid))[finite]))
+
+
+class calibrationTable(object):
+    """
+    Lookup tables inverting a magnet calibration for whole scans at once:
+
+        table = calibrationTable('./calibrations/icarus')
+        targets = table.invert(0.1, phis, thetas)
+        targets.volts[~targets.valid]   # points the magnet cannot reach
+
+    B is signed: B > 0 uses the vn (Yfield > 0) branch and B < 0 the vp branch. errors
+    holds the worst interpolation error of every table in its own units, and
+    volts_error the resulting bound on the magnet voltage.
+    """
+
+    def __init__(self, calib_name, theta_step=0.01, radial_step=0.001, field_step=1e-5, cache=True):
+        self.calib_name = calib_name
+        settings = (theta_step, radial_step, field_step, RADIAL_LIMIT, VOLT_LIMIT, FIELD_LIMIT)
+        self.key = calibration_hash(calib_name, *settings)
+        directory, name = os.path.split(calib_name)
+        self.cache_file = os.path.join(directory, '.%s_table_%s.npz' % (name, self.key[:12]))
+        if cache and os.path.exists(self.cache_file):
+            with np.load(self.cache_file) as tables:
+                self.tables = {k: tables[k] for k in tables.files}
+            log.info("Loaded calibration tables from %s" % self.cache_file)
+        else:
+            self.tables = self.build(theta_step, radial_step, field_step)
+            if cache:
+                np.savez(self.cache_file, **self.tables)
+                log.info("Saved calibration tables to %s" % self.cache_file)
+        self.errors = dict(zip(['R', 'fieldratio', 'volts'], self.tables['errors']))
+        self.volts_error = float(self.tables['volts_error'])
+
+    def build(self, theta_step, radial_step, field_step):
+        radial_polar, fieldratio, volt_center = calibration_polynomials(self.calib_name)
+
+        # one table per branch, so the step between them at theta = 0 is not interpolated across
+        theta = np.arange(0., 90. + theta_step/2, theta_step)
+        R = np.array([radial_polar(theta, 0), radial_polar(-theta, 1)])
+        R_error = 0.
+        for row, sign, branch in ((0, 1, R[0]), (1, -1, R[1])):
+            reachable = np.where(np.abs(branch) <= RADIAL_LIMIT, branch, np.nan)
+            R_error = max(R_error, interpolation_error(theta, reachable, lambda t: radial_polar(sign*t, row)))
+
+        # field ratio tables by |R|, [vn, vp] x [R > 0, R < 0]
+        radius = np.arange(0., RADIAL_LIMIT + radial_step/2, radial_step)
+        ratios = np.zeros((2, 2, radius.size))
+        ratio_error = 0.
+        for i in range(2):
+            for j, sign in enumerate((1, -1)):
+                row = 2*i + j
+                ratios[i, j] = fieldratio(sign*radius, row)
+                ratio_error = max(ratio_error, interpolation_error(radius, ratios[i, j], lambda r: fieldratio(sign*r, row)))
+
+        field = np.arange(0., FIELD_LIMIT + field_step/2, field_step)
+        volts = []
+        volts_error = 0.
+        for row, sign in ((0, 1), (1, -1)):
+            v_of_b = lambda b, row=row, sign=sign: volt_center(sign*b, row)
+            v = v_of_b(field)
+            # only the monotonic part of the fit from zero field up to the supply limit is invertible
+            end = np.argmax(np.abs(v) > VOLT_LIMIT) if np.any(np.abs(v) > VOLT_LIMIT) else v.size
+            turning = np.diff(v[:end])*np.sign(v[end - 1] - v[0]) < 0
+            if turning.any():
+                end = np.argmax(turning) + 1
+            v[end:] = np.nan
+            volts.append(v)
+            volts_error = max(volts_error, interpolation_error(field, v, v_of_b))
+
+        # slope of V(B) bounds how the field ratio error reaches the voltage
+        slope = np.nanmax(np.abs(np.gradient(np.array(volts), field_step, axis=1)))
+        errors = np.array([R_error, ratio_error, volts_error])
+        return {'theta': theta, 'R': R, 'radius': radius, 'ratio': ratios,
+                'field': field, 'volts': np.array(volts), 'errors': errors,
+                'volts_error': volts_error + slope*FIELD_LIMIT*ratio_error}
+
+    def radius(self, theta):
+        t = self.tables
+        return np.where(theta >= 0, np.interp(theta, t['theta'], t['R'][0], right=np.nan),
+                                    np.interp(-theta, t['theta'], t['R'][1], right=np.nan))
+
+    def invert(self, B, phi, theta):
+        """ Magnet voltage, radius and rotation for every (B, phi, theta) target, broadcast together """
+        B, phi, theta = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (B, phi, theta)])
+        t = self.tables
+        R = self.radius(theta)
+        vp = B < 0
+        ratio = np.full(R.shape, np.nan)
+        for i, polarity in enumerate((~vp, vp)):
+            for j, side in enumerate((R >= 0, R < 0)):
+                m = polarity & side
+                ratio[m] = np.interp(np.abs(R[m]), t['radius'], t['ratio'][i, j], right=np.nan)
+        centre = np.abs(B)/ratio
+        volts = np.where(vp, np.interp(centre, t['field'], t['volts'][1], right=np.nan),
+                             np.interp(centre, t['field'], t['volts'][0], right=np.nan))
+        valid = np.isfinite(volts) & (np.abs(R) <= RADIAL_LIMIT)
+        return fieldTargets(volts, R, phi.copy(), np.where(vp, -centre, centre), valid)
+
+    def validate(self, B, phi, theta):
+        """ Logs and returns the number of targets the magnet cannot reach """
+        targets = self.invert(B, phi, theta)
+        unreachable = int(np.sum(~targets.valid))
+        if unreachable:
+            log.warning("%d of %d scan points are outside the calibration (|R| > %g mm or |V| > %g V)"
+                        % (unreachable, targets.valid.size, RADIAL_LIMIT, VOLT_LIMIT))
+        log.info("Calibration table voltage error bound: %.2g V" % self.volts_error)
+        return unreachable
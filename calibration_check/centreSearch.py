@@ -0,0 +1,71 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+
+
+class searchStopped(Exception):
+    """ Raised by the probe function (or on running out of probes) to end a search early """
+    pass
+
+
+def nelder_mead(func, x0, step, xtol=0.005, ftol=np.inf, max_evals=60, resolution=1e-4):
+    """
+    Online Nelder-Mead minimisation of func over the stage plane.
+
+    Every call to func is a hardware probe, so evaluations are cached on the stage
+    resolution and the search stops as soon as the simplex is smaller than xtol or after
+    max_evals probes. A finite ftol also requires the objective spread over the simplex
+    to be below it; leave it unset for noisy probes, whose spread never vanishes.
+
+    func may raise searchStopped to end the search, e.g. on the procedure stop flag.
+    Returns the best point, its objective and the number of probes made.
+    """
+    cache = {}
+
+    def evaluate(x):
+        key = tuple(np.round(np.asarray(x)/resolution).astype(int))
+        if key not in cache:
+            if len(cache) >= max_evals:
+                raise searchStopped()
+            cache[key] = func(np.asarray(key)*resolution)
+        return cache[key]
+
+    x0 = np.asarray(x0, dtype=float)
+    simplex = [x0] + [x0 + step*e for e in np.eye(len(x0))]
+    try:
+        values = [evaluate(x) for x in simplex]
+        while True:
+            order = np.argsort(values)
+            simplex = [simplex[i] for i in order]
+            values = [values[i] for i in order]
+            size = max(np.max(np.abs(x - simplex[0])) for x in simplex[1:])
+            if size < xtol and values[-1] - values[0] <= ftol:
+                log.info("Centre search converged: simplex size %.4g" % size)
+                break
+            centroid = np.mean(simplex[:-1], axis=0)
+            reflected = centroid + (centroid - simplex[-1])
+            f_r = evaluate(reflected)
+            if f_r < values[0]:
+                expanded = centroid + 2*(centroid - simplex[-1])
+                f_e = evaluate(expanded)
+                simplex[-1], values[-1] = (expanded, f_e) if f_e < f_r else (reflected, f_r)
+            elif f_r < values[-2]:
+                simplex[-1], values[-1] = reflected, f_r
+            else:
+                contracted = centroid + 0.5*(simplex[-1] - centroid)
+                f_c = evaluate(contracted)
+                if f_c < values[-1]:
+                    simplex[-1], values[-1] = contracted, f_c
+                else:
+                    for i in range(1, len(simplex)):
+                        simplex[i] = simplex[0] + 0.5*(simplex[i] - simplex[0])
+                        values[i] = evaluate(simplex[i])
+    except searchStopped:
+        log.warning("Centre search stopped after %d probes" % len(cache))
+
+    if len(cache) == 0:
+        return x0, np.nan, 0
+    best = min(cache, key=cache.get)
+    return np.asarray(best)*resolution, cache[best], len(cache)
@@ -0,0 +1,135 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from contextlib import contextmanager
+import numpy as np
+import PyDAQmx as daqmx
+from ctypes import byref
+
+
+class daqTaskPool(object):
+    """
+    Keeps the magnet AO write and AI readback DAQmx tasks configured for the whole
+    procedure, instead of creating, starting, stopping and clearing a task around
+    every WriteAnalogScalarF64 / ReadAnalogScalarF64 call.
+
+    The AO task is committed once and left running, so a write only updates the output;
+    output_released() stops and unreserves it while another task writes the channel.
+    The AI task is not committed by default: a committed AI task keeps the card's AI
+    resources reserved until close(), and the Hall probe reads on the same card could
+    not start their own AI tasks. Pass commit_read=True only if nothing else reads the
+    card, to save DAQmx committing and uncommitting the read task on every read.
+
+    instruments.pooledMagnet routes the magnet driver's voltage writes and reads through
+    the pool.
+
+    With a correction (a voltageCorrection from the calibDAQ ramp characterization),
+    write() outputs the command that makes the readback equal the requested voltage.
+    """
+
+    def __init__(self, adapter, ao=True, ai=True, commit_read=False, volt_range=10.0, timeout=10.0, correction=None):
+        self.resource_name = adapter.resource_name
+        self.write_str = '/' + self.resource_name + '/' + adapter.channels[0]
+        self.read_str = '/' + self.resource_name + '/' + adapter.channels[1]
+        self.timeout = timeout
+        self.correction = correction
+        self.ao_task = None
+        self.ai_task = None
+        self._read_volts = daqmx.float64()
+        if ao:
+            self.ao_task = daqmx.Task()
+            self.ao_task.CreateAOVoltageChan(self.write_str.encode(), "", -volt_range, volt_range, daqmx.DAQmx_Val_Volts, None)
+            self.ao_task.TaskControl(daqmx.DAQmx_Val_Task_Commit)
+            self.ao_task.StartTask()
+        if ai:
+            self.ai_task = daqmx.Task()
+            self.ai_task.CreateAIVoltageChan(self.read_str.encode(), "", daqmx.DAQmx_Val_Cfg_Default, -volt_range, volt_range, daqmx.DAQmx_Val_Volts, None)
+            if commit_read:
+                self.ai_task.TaskControl(daqmx.DAQmx_Val_Task_Commit)
+        log.info("Opened persistent DAQmx tasks: AO %s, AI %s"%(self.write_str if ao else None, self.read_str if ai else None))
+
+    def write(self, volts):
+        if self.correction is not None:
+            volts = float(self.correction.command(volts))
+        self.ao_task.WriteAnalogScalarF64(0, self.timeout, volts, None)
+
+    @contextmanager
+    def output_released(self):
+        """ Stops and unreserves the AO task for the duration, so another task can write the channel """
+        if self.ao_task is None:
+            yield
+            return
+        self.ao_task.StopTask()
+        self.ao_task.TaskControl(daqmx.DAQmx_Val_Task_Unreserve)
+        try:
+            yield
+        finally:
+            self.ao_task.TaskControl(daqmx.DAQmx_Val_Task_Commit)
+            self.ao_task.StartTask()
+
+    def read(self):
+        self.ai_task.ReadAnalogScalarF64(self.timeout, self._read_volts, None)
+        return self._read_volts.value
+
+    def close(self):
+        for task in (self.ao_task, self.ai_task):
+            if task is not None:
+                task.StopTask()
+                task.ClearTask()
+        self.ao_task = None
+        self.ai_task = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class daqRampTask(object):
+    """
+    Hardware-timed AO waveform with a synchronous AI readback, for characterizing the
+    magnet voltage path: the AI task is clocked by the AO sample clock, so sample k of
+    the readback is taken on the k-th AO update (and sees the output of update k - 1
+    settling). Both tasks are created for one run() and cleared after it, leaving the
+    output at the last value of the waveform.
+    """
+
+    def __init__(self, adapter, sample_rate=5000., volt_range=10.0, timeout=10.0):
+        self.resource_name = adapter.resource_name
+        self.write_str = '/' + self.resource_name + '/' + adapter.channels[0]
+        self.read_str = '/' + self.resource_name + '/' + adapter.channels[1]
+        self.clock_str = '/' + self.resource_name + '/ao/SampleClock'
+        self.sample_rate = sample_rate
+        self.volt_range = volt_range
+        self.timeout = timeout
+
+    def run(self, waveform):
+        """ Outputs the waveform at sample_rate and returns the readback of every sample """
+        waveform = np.ascontiguousarray(np.clip(waveform, -self.volt_range, self.volt_range), dtype=np.float64)
+        n = waveform.size
+        readback = np.zeros(n, dtype=np.float64)
+        ao_task = daqmx.Task()
+        ai_task = daqmx.Task()
+        try:
+            ao_task.CreateAOVoltageChan(self.write_str.encode(), "", -self.volt_range, self.volt_range, daqmx.DAQmx_Val_Volts, None)
+            ao_task.CfgSampClkTiming("", self.sample_rate, daqmx.DAQmx_Val_Rising, daqmx.DAQmx_Val_FiniteSamps, n)
+            ai_task.CreateAIVoltageChan(self.read_str.encode(), "", daqmx.DAQmx_Val_Cfg_Default, -self.volt_range, self.volt_range, daqmx.DAQmx_Val_Volts, None)
+            ai_task.CfgSampClkTiming(self.clock_str.encode(), self.sample_rate, daqmx.DAQmx_Val_Rising, daqmx.DAQmx_Val_FiniteSamps, n)
+            written = daqmx.int32()
+            ao_task.WriteAnalogF64(n, False, self.timeout, daqmx.DAQmx_Val_GroupByChannel, waveform, byref(written), None)
+            ai_task.StartTask() # armed, waits for the AO sample clock
+            ao_task.StartTask()
+            read = daqmx.int32()
+            ai_task.ReadAnalogF64(n, self.timeout + n/self.sample_rate, daqmx.DAQmx_Val_GroupByChannel,
+                                  readback, n, byref(read), None)
+            ao_task.WaitUntilTaskDone(self.timeout)
+        finally:
+            for task in (ai_task, ao_task):
+                task.StopTask()
+                task.ClearTask()
+        if read.value != n:
+            log.warning("Ramp readback returned %d of %d samples" % (read.value, n))
+        log.info("Ran a %d sample ramp at %g Hz on %s -> %s" % (n, self.sample_rate, self.write_str, self.read_str))
+        return readback[:read.value]
@@ -0,0 +1,201 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+import warnings
+from time import strftime
+import numpy as np
+import pandas as pd
+from fieldMath import percent_deviation
+from calibrationTable import calibration_hash
+
+# Drift of a magnet calibration from a few spot checks instead of a full calibration
+# check (see calibrationHealthCheckGUI).
+#
+# The check points are the first points of a Halton sequence over the (B, phi, theta)
+# box, so any number of them covers the box evenly, a later batch fills the gaps of the
+# earlier ones, and every check of a calibration measures the same points in the same
+# order. The error of a point is the measured field against the target: |B| in percent
+# (as Bmag_percent_dev of the calibration checks), phi and theta in degrees.
+#
+# Against a reference check of the same calibration (by default the first ok one in the
+# health log, taken right after calibrating) the drift is the change of each error
+# point by point; without one it is the error itself. A check that asked for
+# recalibration is never a reference. The mean drift of each quantity comes with a
+# percentile bootstrap confidence interval. A quantity is ok when the whole interval
+# lies within its threshold, has drifted when the whole interval lies beyond it, and
+# is inconclusive otherwise - the procedure then measures more points.
+# Each check is appended to <calibration>_health_log.csv.
+
+DRIFT_QUANTITIES = ['Bmag_percent_dev', 'phi_error', 'theta_error']
+OK, RECALIBRATE, INCONCLUSIVE = 'ok', 'recalibrate', 'inconclusive'
+PHI_THETA_LIMIT = 80. # deg, phi is not defined for a field along Z
+MIN_POINTS = 3
+PRIMES = [2, 3, 5, 7, 11, 13]
+
+
+def halton(n, dims, start=1):
+    """ Points start to start + n - 1 of the Halton sequence in [0, 1)^dims """
+    index = np.arange(start, start + n)
+    points = np.zeros((n, dims))
+    for d in range(dims):
+        base = PRIMES[d]
+        i = index.copy()
+        f = 1./base
+        while np.any(i > 0):
+            points[:, d] += f*(i % base)
+            i //= base
+            f /= base
+    return points
+
+
+def check_points(n, field_range, phi_range, theta_range, table=None, start=1):
+    """
+    The first n check points from index start on, as a DataFrame of point, B, phi and
+    theta. Points the calibration table cannot reach are skipped (their indices are
+    not reused), so the list only depends on the box and the calibration.
+    """
+    lows, highs = np.array([field_range, phi_range, theta_range], dtype=float).T
+    batch = max(n, 16)
+    found = []
+    count = 0
+    index = start
+    while count < n:
+        if count == 0 and index - start >= 100*batch:
+            raise ValueError("No reachable check points in B %s, phi %s, theta %s" % (field_range, phi_range, theta_range))
+        points = lows + halton(batch, 3, index)*(highs - lows)
+        keep = np.ones(batch, dtype=bool) if table is None else table.invert(*points.T).valid
+        found.append(np.column_stack((np.arange(index, index + batch)[keep], points[keep])))
+        count += int(keep.sum())
+        index += batch
+    points = np.concatenate(found)[:n]
+    return pd.DataFrame({'point': points[:, 0].astype(int), 'B': points[:, 1], 'phi': points[:, 2], 'theta': points[:, 3]})
+
+
+def tour_order(points, scale=(1., 1.)):
+    """ Greedy nearest neighbour order of the points over (phi, theta), scaled per axis """
+    xy = np.column_stack((points.phi.values/scale[0], points.theta.values/scale[1]))
+    remaining = list(range(1, len(xy)))
+    tour = [0] if len(xy) else []
+    while remaining:
+        cost = np.sum((xy[remaining] - xy[tour[-1]])**2, axis=1)
+        tour.append(remaining.pop(int(np.argmin(cost))))
+    return points.iloc[tour]
+
+
+def angle_difference(a, b):
+    return np.mod(np.subtract(a, b) + 180., 360.) - 180.
+
+
+def point_errors(data):
+    """ Bmag_percent_dev, phi_error and theta_error of measured check points against their targets """
+    errors = pd.DataFrame({'point': data.point.values})
+    errors['Bmag_percent_dev'] = percent_deviation(data.Bmag.values, np.abs(data.B.values))
+    errors['phi_error'] = np.where(np.abs(data.theta.values) < PHI_THETA_LIMIT,
+                                   angle_difference(data.act_phi.values, data.phi.values), np.nan)
+    errors['theta_error'] = data.act_theta.values - data.theta.values
+    return errors
+
+
+def bootstrap_interval(values, confidence=0.95, resamples=2000, seed=0):
+    """ Percentile bootstrap interval of the mean of each column of values, ignoring NaN """
+    values = np.asarray(values, dtype=float)
+    rng = np.random.RandomState(seed)
+    samples = values[rng.randint(0, len(values), (resamples, len(values)))]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # resamples of only NaN
+        means = np.nanmean(samples, axis=1)
+        tail = 50.*(1 - confidence)
+        return np.nanpercentile(means, tail, axis=0), np.nanpercentile(means, 100 - tail, axis=0)
+
+
+def drift_estimate(errors, reference=None, confidence=0.95, seed=0):
+    """
+    Mean drift of each quantity with its confidence interval, as a DataFrame indexed by
+    quantity with points, drift, lower, upper and rms. With a reference, the drift is
+    taken over the points both checks measured.
+    """
+    drift = errors.set_index('point')[DRIFT_QUANTITIES]
+    if reference is not None:
+        reference = reference.set_index('point')[DRIFT_QUANTITIES]
+        common = drift.index.intersection(reference.index)
+        drift = drift.loc[common] - reference.loc[common]
+    values = drift.values
+    counts = np.sum(np.isfinite(values), axis=0)
+    lower = upper = np.full(len(DRIFT_QUANTITIES), np.nan)
+    if len(values):
+        lower, upper = bootstrap_interval(values, confidence, seed=seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(values, axis=0) if len(values) else lower
+        rms = np.sqrt(np.nanmean(values**2, axis=0)) if len(values) else lower
+    estimate = pd.DataFrame({'points': counts, 'drift': mean, 'lower': lower, 'upper': upper, 'rms': rms},
+                            index=pd.Index(DRIFT_QUANTITIES, name='quantity'))
+    estimate.loc[estimate.points < MIN_POINTS, ['lower', 'upper']] = np.nan
+    return estimate
+
+
+def drift_status(estimate, thresholds):
+    """
+    Adds each quantity's threshold and status to the estimate, returning it with the
+    overall status: recalibrate if any quantity drifted, else inconclusive if any is
+    undecided, else ok.
+    """
+    estimate = estimate.copy()
+    estimate['threshold'] = [thresholds[q] for q in estimate.index]
+    status = np.where((estimate.lower > estimate.threshold) | (estimate.upper < -estimate.threshold), RECALIBRATE,
+                      np.where((estimate.lower >= -estimate.threshold) & (estimate.upper <= estimate.threshold),
+                               OK, INCONCLUSIVE))
+    estimate['status'] = status
+    for overall in (RECALIBRATE, INCONCLUSIVE):
+        if (status == overall).any():
+            return estimate, overall
+    return estimate, OK
+
+
+def health_log_filename(calib_name):
+    return calib_name + '_health_log.csv'
+
+
+def read_health_log(calib_name):
+    filename = health_log_filename(calib_name)
+    if not os.path.exists(filename):
+        return pd.DataFrame()
+    return pd.read_csv(filename)
+
+
+def reference_check(calib_name):
+    """ The results file of the first passed (ok) check of the calibration as it is now, or None """
+    checks = read_health_log(calib_name)
+    if len(checks) == 0:
+        return None
+    checks = checks[(checks.calibration == calibration_hash(calib_name)) & (checks.status == OK)]
+    checks = checks[[os.path.exists(f) for f in checks.results]]
+    return checks.results.iloc[0] if len(checks) else None
+
+
+def log_check(calib_name, results, reference, estimate, status):
+    """ Appends a check and its per-quantity drift to the health log of the calibration """
+    row = {'date': strftime('%Y-%m-%d %H:%M:%S'), 'calibration': calibration_hash(calib_name),
+           'results': results, 'reference': reference or '', 'status': status}
+    for quantity, q in estimate.iterrows():
+        for column in ('points', 'drift', 'lower', 'upper', 'status'):
+            row['%s_%s' % (quantity, column)] = q[column]
+    filename = health_log_filename(calib_name)
+    pd.DataFrame([row]).to_csv(filename, mode='a', header=not os.path.exists(filename), index=False)
+    return filename
+
+
+def recalibration_due(calib_name):
+    """ True if the last check of the calibration as it is now asked for recalibration """
+    checks = read_health_log(calib_name)
+    if len(checks) == 0:
+        return False
+    checks = checks[checks.calibration == calibration_hash(calib_name)]
+    return len(checks) > 0 and checks.status.iloc[-1] == RECALIBRATE
+
+
+def format_estimate(estimate):
+    return '; '.join('%s %+.3g [%+.3g, %+.3g] (%s)' % (q, e.drift, e.lower, e.upper, e.status)
+                     for q, e in estimate.iterrows())
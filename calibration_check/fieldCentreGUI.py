@@ -0,0 +1,210 @@
+import logging
+from time import sleep
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter, ListParameter
+from pymeasure.experiment import Procedure
+from instruments import DAQmxAdapter, senis3AxHallProbe, connect_magnet
+from centreSearch import nelder_mead, searchStopped
+from fieldMath import load_probe_zero
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
+
+from pymeasure.display.windows import ManagedWindow
+from livePlot import livePlotWindow
+from pymeasure.experiment import Results, unique_filename
+import sys
+from pymeasure.display.Qt import QtGui
+
+
+class icarusFieldCentreProcedure(Procedure):
+    """
+    Procedure for finding the field centre of Icarus by driving the stage X/Y with an
+    online Nelder-Mead search, instead of rastering the whole X-Y grid.
+
+    Every probe measures the field at magnet phi = 0 and 90 deg (alternating the order
+    so only one rotation is needed per probe) and scores it with the same combined
+    quantities the raster notebooks use:
+        'Zfield zero': Bz(phi0)^2 + Bz(phi90)^2, minimised
+        'Inplane max': By(phi0)^2 + Bx(phi90)^2, maximised
+    """
+
+    # control parameters
+    name = Parameter("Calibration Name", default='')
+    volts = FloatParameter("Volts to magnet", units="V", default=-3.)
+    objective = ListParameter("Centre objective", choices=['Zfield zero', 'Inplane max'], default='Zfield zero')
+    num_averages = IntegerParameter("Number of Averages", default=3)
+    delay = FloatParameter("Delay between averages", units="s", default=.1)
+
+    x_start = FloatParameter("stage X Start Position", units="mm", default=26.8)
+    y_start = FloatParameter("stage Y Start Position", units="mm", default=21.66)
+    initial_step = FloatParameter("Initial search step", units="mm", default=0.2)
+    tolerance = FloatParameter("Centre tolerance", units="mm", default=0.005)
+    max_probes = IntegerParameter("Maximum number of probes", default=60)
+    centre_file = Parameter("Centre calibration output file", default='')
+
+    DATA_COLUMNS = ["probe", "X", "Y", "Xfield_phi0", "Yfield_phi0", "Zfield_phi0",
+                    "Xfield_phi90", "Yfield_phi90", "Zfield_phi90", "objective"]
+
+    def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        log.info("Connecting and configuring the instruments")
+        with self.timer('connect'):
+            self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+            self.magnet = connect_magnet()
+            self.volt_tasks = self.magnet.tasks
+        self.x_zero, self.y_zero, self.z_zero = load_probe_zero() #zero point of Hall probe calibrated using LakeShore Gaussmeter
+        log.info("Setting magnet voltage to %.2f V"%self.volts)
+        self.magnet.setVolts(self.volts)
+        self.phi_order = [0., 90.]
+        self.set_phi(self.phi_order[0])
+        self.probes = 0
+
+    def wait_for_motion(self):
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+        with self.timer('errors'):
+            errors = self.magnet.errors
+        for err in errors:
+            log.warning('%s'%err)
+
+    def set_phi(self, phi):
+        if not np.isclose(self.magnet._phi, phi, atol=1e-4):
+            with self.timer('move'):
+                self.magnet.motion_inst.phi.position = phi # see phi setter function
+                self.magnet._phi = phi
+            self.wait_for_motion()
+
+    def get_B_zeroed(self):
+        fields = np.zeros(3)
+        for j in range(self.num_averages):
+            with self.timer('delay'):
+                sleep(self.delay)
+            with self.timer('probe'):
+                fields += (self.hall_probe.x_field - self.x_zero,
+                           self.hall_probe.y_field - self.y_zero,
+                           -1*(self.hall_probe.z_field - self.z_zero))
+        return fields/self.num_averages
+
+    def probe(self, xy):
+        """ Moves the stage to xy, measures at phi 0 and 90 and returns the objective to minimise """
+        if self.should_stop():
+            log.warning("Caught stop flag in procedure")
+            raise searchStopped()
+        log.info("Probing X: %.4f mm, Y: %.4f mm"%(xy[0], xy[1]))
+        self.timer.next_point((float(xy[0]), float(xy[1])))
+        with self.timer('move'):
+            self.magnet.motion_inst.x.position = xy[0]
+            self.magnet.motion_inst.y.position = xy[1]
+        self.wait_for_motion()
+
+        fields = {}
+        for phi in self.phi_order:
+            self.set_phi(phi)
+            fields[phi] = self.get_B_zeroed()
+        self.phi_order.reverse()
+
+        if self.objective == 'Zfield zero':
+            value = fields[0.][2]**2 + fields[90.][2]**2
+            cost = value
+        else:
+            value = fields[0.][1]**2 + fields[90.][0]**2
+            cost = -value
+
+        self.probes += 1
+        with self.timer('position'):
+            x = self.magnet.motion_inst.x.position
+            y = self.magnet.motion_inst.y.position
+        with self.timer('emit'):
+            self.emit("results", {
+                "probe": self.probes,
+                "X": x,
+                "Y": y,
+                "Xfield_phi0": fields[0.][0],
+                "Yfield_phi0": fields[0.][1],
+                "Zfield_phi0": fields[0.][2],
+                "Xfield_phi90": fields[90.][0],
+                "Yfield_phi90": fields[90.][1],
+                "Zfield_phi90": fields[90.][2],
+                "objective": value
+            })
+        self.emit('progress', int(100*self.probes/self.max_probes))
+        return cost
+
+    def execute(self):
+        centre, cost, probes = nelder_mead(self.probe, (self.x_start, self.y_start), self.initial_step,
+                                           xtol=self.tolerance, max_evals=self.max_probes)
+        log.info("Field centre (%s): X = %.4f mm, Y = %.4f mm after %d probes"%(self.objective, centre[0], centre[1], probes))
+        self.magnet.motion_inst.x.position = centre[0]
+        self.magnet.motion_inst.y.position = centre[1]
+        self.wait_for_motion()
+        if self.centre_file and probes > 0:
+            np.savetxt(self.centre_file, [centre], delimiter=",")
+            log.info("Saved field centre to %s"%self.centre_file)
+
+    def shutdown(self):
+        log.info("Done with centre search. Shutting down instruments")
+        self.timer.next_point('shutdown')
+        self.live.flush()
+        with self.timer('shutdown'):
+            self.magnet.voltage = 0.
+            self.volt_tasks.close()
+
+
+class icarusFieldCentreGUI(livePlotWindow, ManagedWindow):
+        def __init__(self):
+            super().__init__(
+                procedure_class=icarusFieldCentreProcedure,
+                inputs=[
+                    'name',
+                    'volts',
+                    'objective',
+                    'num_averages',
+                    'delay',
+                    'x_start',
+                    'y_start',
+                    'initial_step',
+                    'tolerance',
+                    'max_probes',
+                    'centre_file'
+                    ],
+                displays=[
+                    'volts',
+                    'objective',
+                    'x_start',
+                    'y_start',
+                    'tolerance'
+                    ],
+                x_axis='X',
+                y_axis='Y',
+                directory_input=True
+            )
+            self.setWindowTitle('Icarus Field Centre GUI')
+            self.directory = r'C:\Users\TopMob\icarus_calib'
+
+        def queue(self):
+            procedure = self.make_procedure()
+            fname = unique_filename(
+                self.directory,
+                dated_folder=True,
+                prefix=procedure.name + '_fieldCentre_',
+                suffix=''
+            )
+            results = Results(procedure, fname)
+            experiment = self.new_experiment(results)
+            self.manager.queue(experiment)
+
+        def finished(self, experiment):
+            """ Writes the phase timings once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+
+if __name__ == "__main__":
+    app = QtGui.QApplication(sys.argv)
+    window = icarusFieldCentreGUI()
+    window.show()
+    sys.exit(app.exec_())
@@ -0,0 +1,88 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+import numpy as np
+
+# Field quantities derived from the Hall probe X, Y, Z components, shared by the
+# procedures, the fitting code and post-processing. Every function works on scalars
+# and whole arrays alike.
+#
+# Conventions (as in the calibration checks):
+#   zeroed Bz is -(z - z_zero), the probe Z axis pointing into the magnet
+#   phi   = arctan2(Bx, By), the in-plane angle from the Y axis
+#   theta = arctan2(Bz, |B in-plane|), the elevation out of the X-Y plane
+# The radialPolar scans measure the polar angle from +Y (vn) or -Y (vp) in the Y-Z
+# plane instead, see radial_theta.
+
+PROBE_ZERO_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'probe_zero_calib.csv')
+
+
+def load_probe_zero(filename=PROBE_ZERO_FILE):
+    """ X, Y, Z zero point of the Hall probe (calibrated against the LakeShore gaussmeter) """
+    return np.loadtxt(filename, delimiter=',').reshape(3)
+
+
+def zeroed(x, y, z, zero=None):
+    """ Zero-corrected X, Y, Z fields, with the Bz sign flip """
+    x0, y0, z0 = load_probe_zero() if zero is None else zero
+    return np.subtract(x, x0), np.subtract(y, y0), -1*np.subtract(z, z0)
+
+
+def bmag(x, y, z):
+    return np.sqrt(np.square(x) + np.square(y) + np.square(z))
+
+
+def field_phi(x, y):
+    """ In-plane angle of the field in degrees """
+    return np.degrees(np.arctan2(x, y))
+
+
+def field_theta(x, y, z):
+    """ Elevation of the field out of the X-Y plane in degrees """
+    return np.degrees(np.arctan2(z, np.hypot(x, y)))
+
+
+def radial_theta(y, z, sign=1):
+    """ Polar angle in the Y-Z plane of a radialPolar scan, sign -1 for the vp scans """
+    return np.degrees(np.arctan2(z, sign*np.asarray(y)))
+
+
+def percent_deviation(b, target):
+    """ Deviation of the measured magnitude from the target, as a percentage of the measured """
+    return (b - target)/b*100
+
+
+def field_ratio(b, R, centre_tolerance=0.001):
+    """ Magnitude relative to the first point within centre_tolerance of R = 0 """
+    b = np.asarray(b)
+    return b/b[np.flatnonzero(np.abs(np.asarray(R)) < centre_tolerance)[0]]
+
+
+def field_columns(data):
+    """ Names of the X, Y, Z field columns of a results DataFrame, averaged or raw """
+    if 'Xfield_avg' in data:
+        return 'Xfield_avg', 'Yfield_avg', 'Zfield_avg'
+    return 'Xfield', 'Yfield', 'Zfield'
+
+
+def derive(data, target=None, zero=None):
+    """
+    Adds Bmag, act_phi and act_theta (and, given the target field, Bmag_deviation and
+    Bmag_percent_dev) to a results DataFrame in one vectorized pass. zero, if given,
+    is subtracted first for files recorded without the probe zero correction.
+    """
+    data = data.copy()
+    columns = field_columns(data)
+    x, y, z = (np.asarray(data[c].values, dtype=float) for c in columns)
+    if zero is not None:
+        x, y, z = zeroed(x, y, z, zero)
+        data[columns[0]], data[columns[1]], data[columns[2]] = x, y, z
+    data['Bmag'] = bmag(x, y, z)
+    data['act_phi'] = field_phi(x, y)
+    data['act_theta'] = field_theta(x, y, z)
+    if target is not None:
+        data['Bmag_deviation'] = data['Bmag'] - target
+        data['Bmag_percent_dev'] = percent_deviation(data['Bmag'].values, target)
+    return data
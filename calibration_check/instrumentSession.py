@@ -0,0 +1,169 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import atexit
+import threading
+import numpy as np
+from instruments import DAQmxAdapter, senis3AxHallProbe, bufferedHallProbe, connect_magnet
+from calibrationTable import calibration_hash
+from calibrationBundle import resolve_calibration
+from fieldMath import load_probe_zero
+
+# Instruments kept open across the procedures of a queue.
+#
+# The pymeasure manager runs queued procedures one after another in the same process,
+# so a field sweep can share one connection to the Hall probe, the magnet and the DAQ
+# voltage readback, load the calibration once, and leave the magnet energised between
+# field steps instead of ramping to 0 V and back. Procedures call get_session() in
+# startup and, in shutdown, either park_session() when next_procedure() is known to
+# be the following field step or close_session() otherwise. A parked session that is
+# not picked up again within IDLE_TIMEOUT is closed, as is any session left at exit.
+
+IDLE_TIMEOUT = 300. # s a parked session waits for the next procedure
+
+
+class instrumentSession(object):
+    """ The connected instruments, loaded calibration and buffered probe read of a queue """
+
+    def __init__(self):
+        self.hall_probe = None
+        self.magnet = None
+        self.volt_tasks = None
+        self.probe_buffer = None
+        self.calibration = None
+        self.probe_zero = None
+        self.procedures = 0
+
+    @property
+    def connected(self):
+        return self.magnet is not None
+
+    def connect(self):
+        """ Connects the instruments unless already connected, returning True if it did """
+        if self.connected:
+            return False
+        log.info("Connecting and configuring the instruments")
+        self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+        self.magnet = connect_magnet()
+        self.volt_tasks = self.magnet.tasks
+        return True
+
+    def load_calibration(self, calib_name):
+        """
+        Loads the magnet calibration and its probe zero unless the same files are loaded,
+        returning True if it did
+        """
+        try:
+            key = (calib_name, calibration_hash(calib_name))
+        except (IOError, OSError):
+            key = (calib_name, None) # let the driver report the missing files
+        if key == self.calibration and key[1] is not None:
+            log.info("Calibration %s already loaded" % calib_name)
+            return False
+        calib_name, zero = resolve_calibration(calib_name)
+        self.magnet.load_calibration_params(calib_name)
+        self.probe_zero = load_probe_zero() if zero is None else zero
+        self.calibration = key
+        return True
+
+    def buffer(self, sample_rate, num_samples):
+        """ The buffered Hall probe read, created and scale-matched once and retimed as needed """
+        if self.probe_buffer is None:
+            self.probe_buffer = bufferedHallProbe(self.hall_probe.adapter, sample_rate, num_samples)
+            self.probe_buffer.calibrate_scale(self.hall_probe)
+        else:
+            self.probe_buffer.set_timing(sample_rate, num_samples)
+        return self.probe_buffer
+
+    def close(self):
+        """ Ramps the magnet to zero and releases the DAQ tasks """
+        if not self.connected:
+            return
+        log.info("Closing instruments after %d procedures" % self.procedures)
+        self.magnet.voltage = 0.
+        if self.probe_buffer is not None:
+            self.probe_buffer.close()
+        self.volt_tasks.close()
+        self.hall_probe = self.magnet = self.volt_tasks = self.probe_buffer = None
+        self.calibration = self.probe_zero = None
+
+
+_session = None
+_idle_timer = None
+_queue_lookup = None
+_lock = threading.RLock()
+
+
+def get_session():
+    global _session
+    with _lock:
+        _cancel_idle_timer()
+        if _session is None:
+            _session = instrumentSession()
+        _session.procedures += 1
+        return _session
+
+
+def close_session():
+    global _session
+    with _lock:
+        _cancel_idle_timer()
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def park_session(timeout=IDLE_TIMEOUT):
+    """ Keeps the session open for the next procedure, closing it if none starts within timeout seconds """
+    global _idle_timer
+    with _lock:
+        _cancel_idle_timer()
+        if _session is None:
+            return
+        _idle_timer = threading.Timer(timeout, _close_idle, args=(_session,))
+        _idle_timer.daemon = True
+        _idle_timer.start()
+
+
+def _close_idle(session):
+    with _lock:
+        if _session is session and _idle_timer is not None:
+            log.warning("No procedure picked up the open instruments. Shutting down instruments")
+            close_session()
+
+
+def _cancel_idle_timer():
+    global _idle_timer
+    if _idle_timer is not None:
+        _idle_timer.cancel()
+    _idle_timer = None
+
+
+def set_queue_lookup(lookup):
+    """ Registers a callable returning the next queued procedure, or None when the queue is empty """
+    global _queue_lookup
+    _queue_lookup = lookup
+
+
+def next_procedure():
+    """ The procedure queued to run next, or None if unknown """
+    if _queue_lookup is None:
+        return None
+    try:
+        return _queue_lookup()
+    except Exception:
+        log.warning("Could not look up the next queued procedure", exc_info=True)
+        return None
+
+
+atexit.register(close_session)
+
+
+def ramp_order(fields):
+    """
+    The field steps of a sweep in an order the magnet ramps through monotonically:
+    increasing, or from zero down when every step is negative.
+    """
+    fields = np.unique(np.round(np.asarray(fields, dtype=float), 9))
+    return fields[::-1] if np.all(fields <= 0) else fields
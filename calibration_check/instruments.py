@@ -0,0 +1,92 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+from voltageCorrection import load_volt_correction
+
+# The instrument classes the procedures connect to. By default these are the hardware
+# drivers; with ICARUS_INSTRUMENTS=simulated in the environment they are the stand-ins
+# of simulatedInstruments, so every procedure runs unchanged without the NI card, the
+# magnet supply or the ESP300.
+
+BACKEND = os.environ.get('ICARUS_INSTRUMENTS', 'hardware')
+
+if BACKEND == 'simulated':
+    log.warning("Using simulated instruments")
+    from simulatedInstruments import simulatedAdapter as DAQmxAdapter
+    from simulatedInstruments import simulatedProjField as daedalusProjField
+    from simulatedInstruments import simulatedHallProbe as senis3AxHallProbe
+    from simulatedInstruments import simulatedBufferedHallProbe as bufferedHallProbe
+    from simulatedInstruments import simulatedTaskPool as daqTaskPool
+    from simulatedInstruments import simulatedRampTask as daqRampTask
+elif BACKEND == 'hardware':
+    from pymeasure.adapters import DAQmxAdapter
+    from daedalus.custom_instruments import daedalusProjField, senis3AxHallProbe
+    from bufferedHallProbe import bufferedHallProbe
+    from daqTasks import daqTaskPool, daqRampTask
+else:
+    raise ValueError("Unknown ICARUS_INSTRUMENTS backend '%s', expected hardware or simulated" % BACKEND)
+
+
+class pooledMagnet(object):
+    """
+    A daedalusProjField with its magnet voltage writes and readback on a daqTaskPool,
+    so they reuse its open tasks instead of creating a DAQmx task per call:
+
+        magnet = pooledMagnet(daedalusProjField(adapter, "GPIB::10"), daqTaskPool(adapter))
+        magnet.voltage = 2.   # written through the pool, with its voltage correction
+        magnet.getVolts()     # read back through the pool
+
+    The driver's voltage calls used by the procedures (setVolts, getVolts, the volts and
+    voltage setters and the set_volts / setvolts last command) go through the pool; any
+    other attribute is the driver's. set_vector_field is left to the driver, which writes
+    the voltage with its own task, so the pool releases its AO task for the call and then
+    writes the voltage the driver chose again, corrected.
+    """
+
+    _own = ('magnet', 'tasks', '_volts')
+
+    def __init__(self, magnet, tasks):
+        object.__setattr__(self, 'magnet', magnet)
+        object.__setattr__(self, 'tasks', tasks)
+        object.__setattr__(self, '_volts', tasks.read())
+
+    def __getattr__(self, name):
+        return getattr(self.magnet, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own or hasattr(type(self), name):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.magnet, name, value)
+
+    def setVolts(self, volts):
+        self.tasks.write(volts)
+        self._volts = float(volts)
+
+    def getVolts(self):
+        return self.tasks.read()
+
+    def _last_volts(self):
+        return self._volts
+
+    volts = voltage = property(_last_volts, setVolts)
+    setvolts = set_volts = property(_last_volts)
+
+    def set_vector_field(self, B, phi, theta):
+        with self.tasks.output_released():
+            self.magnet.set_vector_field(B, phi, theta)
+        self.setVolts(self.magnet.set_volts)
+
+    def close(self):
+        self.tasks.close()
+
+
+def connect_magnet():
+    """ The magnet driver with its voltage write and readback on a daqTaskPool, corrected if characterized """
+    magnet = daedalusProjField(DAQmxAdapter('Dev2', ['ao0', 'ai1']), "GPIB::10")
+    magnet = pooledMagnet(magnet, daqTaskPool(DAQmxAdapter('Dev2', ['ao0', 'ai1']), correction=load_volt_correction()))
+    for err in magnet.errors:
+        log.warning('%s' % err)
+    return magnet
@@ -0,0 +1,104 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+import pyqtgraph as pg
+from pymeasure.display.curves import ResultsCurve, ResultsImage
+from pymeasure.display.widgets import PlotWidget, ImageWidget
+from liveResults import decimatedSeries, grid_index
+
+# Plot items of the calibration GUIs that draw running procedures from procedure.live
+# (see liveResults) instead of re-reading the results file on every refresh. Results
+# without a live buffer (loaded from file, or not started yet) are drawn as before.
+
+
+def live_buffer(results):
+    live = getattr(results.procedure, 'live', None)
+    return None if live is None else live.buffer
+
+
+class liveResultsCurve(ResultsCurve):
+    """ ResultsCurve extended with the new rows of each refresh and drawn min/max decimated """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.columns = (self.x, self.y)
+        self.series = decimatedSeries()
+
+    def pixels(self):
+        view = self.getViewBox()
+        return max(int(view.width()), 100) if view is not None else 1000
+
+    def update_data(self):
+        buffer = live_buffer(self.results)
+        if buffer is None:
+            return super().update_data()
+        if (self.x, self.y) != self.columns:
+            self.reset()
+        total, (x, y) = buffer.since(self.count, self.columns)
+        if total == self.count:
+            return # nothing new to draw
+        self.count = total
+        self.series.pixels = self.pixels()
+        self.series.extend(x, y)
+        self.setData(*self.series.points())
+
+
+class liveResultsImage(ResultsImage):
+    """ ResultsImage filling its grid with the new rows of each refresh """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.columns = (self.x, self.y, self.z)
+        self.values = np.full((self.ysize, self.xsize), np.nan)
+
+    def update_data(self):
+        buffer = live_buffer(self.results)
+        if buffer is None:
+            return super().update_data()
+        if (self.x, self.y, self.z) != self.columns:
+            self.reset()
+        total, (x, y, z) = buffer.since(self.count, self.columns)
+        if total == self.count:
+            return
+        self.count = total
+        xidx = grid_index(x, self.xstart, self.xend, self.xstep, self.xsize)
+        yidx = grid_index(y, self.ystart, self.yend, self.ystep, self.ysize)
+        self.values[yidx, xidx] = z
+        filled = np.isfinite(self.values)
+        if not filled.any():
+            return
+        zmin, zmax = self.values[filled].min(), self.values[filled].max()
+        scaled = np.where(filled, (self.values - zmin)/((zmax - zmin) or 1.), 0.)
+        colours = np.asarray(self.colormap(scaled.ravel())).reshape(self.ysize, self.xsize, 4)
+        self.img_data = np.where(filled[:, :, None], colours, 0.)
+        # set image data, need to transpose since pyqtgraph assumes column-major order
+        self.setImage(image=np.transpose(self.img_data, axes=(1, 0, 2)))
+
+
+class livePlotWindow(object):
+    """ ManagedWindow mixin creating live curves and images for new experiments """
+
+    def new_curve(self, wdg, results, color=None, **kwargs):
+        if color is None:
+            color = pg.intColor(self.browser.topLevelItemCount() % 8)
+        if isinstance(wdg, ImageWidget):
+            return liveResultsImage(results, wdg=wdg, x=wdg.image_frame.x_axis, y=wdg.image_frame.y_axis,
+                                    z=wdg.image_frame.z_axis, **kwargs)
+        if isinstance(wdg, PlotWidget):
+            kwargs.setdefault('pen', pg.mkPen(color=color, width=wdg.linewidth))
+            kwargs.setdefault('antialias', False)
+            curve = liveResultsCurve(results, wdg=wdg, x=wdg.plot_frame.x_axis, y=wdg.plot_frame.y_axis, **kwargs)
+            curve.setSymbol(None)
+            curve.setSymbolBrush(None)
+            return curve
+        return super().new_curve(wdg, results, color=color, **kwargs)
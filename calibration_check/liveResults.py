@@ -0,0 +1,213 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import threading
+from time import perf_counter
+import numpy as np
+
+# Live results of a running procedure, for plotting without reading the results file back.
+#
+# forward_results(procedure) in startup routes the procedure's emit through a
+# resultsForwarder: every 'results' row is copied into a fixed size ringBuffer before it
+# goes on to the worker, and the worker's results file is written in batches of lines
+# instead of a write and flush per row. The live plot classes in livePlot read only the
+# rows added since their last refresh from procedure.live.buffer, keep a min/max
+# decimated copy of the curve (decimatedSeries) and a fixed size image grid, so the GUI
+# cost of a refresh does not grow with the length of the scan.
+
+DEFAULT_CAPACITY = 2**16
+BATCH_SIZE = 64
+FLUSH_INTERVAL = 1. # s
+
+
+class ringBuffer(object):
+    """ The last capacity rows of a set of float columns, appended from the acquisition thread """
+
+    def __init__(self, columns, capacity=DEFAULT_CAPACITY):
+        self.columns = list(columns)
+        self.index = dict((c, i) for i, c in enumerate(self.columns))
+        self.capacity = int(capacity)
+        self.data = np.full((self.capacity, len(self.columns)), np.nan)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def append(self, row):
+        values = [as_float(row.get(c, np.nan)) for c in self.columns]
+        with self.lock:
+            self.data[self.total % self.capacity] = values
+            self.total += 1
+
+    def since(self, count, columns=None):
+        """
+        The rows appended after the first count rows, as (total, [column arrays]).
+        Rows already overwritten by the ring are skipped.
+        """
+        cols = [self.index[c] for c in (self.columns if columns is None else columns)]
+        with self.lock:
+            total = self.total
+            start = max(count, total - self.capacity)
+            first, last = start % self.capacity, total % self.capacity
+            if start == total:
+                rows = self.data[:0, cols]
+            elif first < last:
+                rows = self.data[first:last, cols]
+            else:
+                rows = np.concatenate([self.data[first:, cols], self.data[:last, cols]])
+        return total, [rows[:, i] for i in range(len(cols))]
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+
+def as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def minmax_decimate(x, y, width):
+    """
+    The points of minimum and maximum y (in index order) of every full bin of width
+    points, and the number of points the bins used. Lines through the result have the
+    same envelope as lines through all the points.
+    """
+    bins = len(y)//width
+    used = bins*width
+    if bins == 0 or width <= 2:
+        return x[:used], y[:used], used
+    yb = y[:used].reshape(bins, width)
+    finite = np.isfinite(yb)
+    lo = np.where(finite, yb, np.inf).argmin(axis=1)
+    hi = np.where(finite, yb, -np.inf).argmax(axis=1)
+    idx = np.sort(np.stack([lo, hi], axis=1), axis=1) + (np.arange(bins)*width)[:, None]
+    idx = idx.ravel()
+    return x[idx], y[idx], used
+
+
+class decimatedSeries(object):
+    """
+    An x, y series extended with new points and kept to a few points per pixel.
+
+    Points are reduced to min/max pairs in bins of width points as bins fill. Once there
+    are more than four pairs per pixel, neighbouring pairs are merged and the width
+    doubles, so extending costs the new points only.
+    """
+
+    def __init__(self, pixels=1000):
+        self.pixels = pixels
+        self.width = 2
+        self.x = self.y = np.empty(0)
+        self.tail_x = self.tail_y = np.empty(0)
+
+    def extend(self, x, y):
+        tail_x = np.concatenate([self.tail_x, x])
+        tail_y = np.concatenate([self.tail_y, y])
+        dx, dy, used = minmax_decimate(tail_x, tail_y, self.width)
+        self.x = np.concatenate([self.x, dx])
+        self.y = np.concatenate([self.y, dy])
+        self.tail_x, self.tail_y = tail_x[used:], tail_y[used:]
+        while len(self.y) > 8*max(self.pixels, 1):
+            dx, dy, used = minmax_decimate(self.x, self.y, 4)
+            self.x = np.concatenate([dx, self.x[used:]])
+            self.y = np.concatenate([dy, self.y[used:]])
+            self.width *= 2
+
+    def points(self):
+        return np.concatenate([self.x, self.tail_x]), np.concatenate([self.y, self.tail_y])
+
+
+def grid_index(values, start, end, step, size):
+    """ Nearest image index of each value, with values outside [start, end] on the last pixel (as ResultsImage) """
+    values = np.asarray(values, dtype=float)
+    idx = np.floor((values - start)/step + 0.5)
+    inside = (values >= start) & (values <= end)
+    return np.where(inside, np.clip(idx, 0, size - 1), size - 1).astype(int)
+
+
+class batchedFileHandler(logging.FileHandler):
+    """ FileHandler writing its formatted records every batch_size records or flush_interval seconds """
+
+    def __init__(self, filename, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_write = perf_counter()
+
+    def emit(self, record):
+        try:
+            self.pending.append(self.format(record))
+            if len(self.pending) >= self.batch_size or perf_counter() - self.last_write >= self.flush_interval:
+                self.write_pending()
+        except Exception:
+            self.handleError(record)
+
+    def write_pending(self):
+        if self.pending:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.terminator.join(self.pending) + self.terminator)
+            self.stream.flush()
+            self.pending = []
+        self.last_write = perf_counter()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.write_pending()
+        finally:
+            self.release()
+        super().flush()
+
+
+def batch_recorder(recorder, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+    """ Replaces the results file handlers of a pymeasure Recorder with batchedFileHandlers """
+    handlers = []
+    for handler in getattr(recorder, 'handlers', ()):
+        if isinstance(handler, logging.FileHandler) and not isinstance(handler, batchedFileHandler):
+            batched = batchedFileHandler(handler.baseFilename, batch_size, flush_interval,
+                                         mode='a', encoding=handler.encoding)
+            batched.setFormatter(handler.formatter)
+            batched.setLevel(handler.level)
+            handler.close()
+            handler = batched
+        handlers.append(handler)
+    if recorder is not None:
+        recorder.handlers = tuple(handlers)
+    return [h for h in handlers if isinstance(h, batchedFileHandler)]
+
+
+class resultsForwarder(object):
+    """ Emit function of a procedure that keeps its latest results in a ringBuffer """
+
+    def __init__(self, procedure, capacity=DEFAULT_CAPACITY, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.buffer = ringBuffer(procedure.DATA_COLUMNS, capacity)
+        self.emit = procedure.emit
+        worker = getattr(self.emit, '__self__', None) # the Worker running the procedure
+        self.recorder = getattr(worker, 'recorder', None)
+        self.data_filename = getattr(getattr(worker, 'results', None), 'data_filename', None)
+        self.handlers = batch_recorder(self.recorder, batch_size, flush_interval)
+
+    def __call__(self, topic, record):
+        if topic == 'results':
+            self.buffer.append(record)
+        self.emit(topic, record)
+
+    def flush(self):
+        """ Writes the pending lines of the results file, once the recorder has handled every row """
+        queue = getattr(self.recorder, 'queue', None)
+        if queue is not None and hasattr(queue, 'join') and self.recorder.is_alive():
+            queue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+
+def forward_results(procedure, **kwargs):
+    """ Routes the results of a running procedure through a resultsForwarder, returned for procedure.live """
+    forwarder = resultsForwarder(procedure, **kwargs)
+    procedure.emit = forwarder
+    log.debug("Forwarding results to a live buffer of %d rows and %d file handlers"
+              % (forwarder.buffer.capacity, len(forwarder.handlers)))
+    return forwarder
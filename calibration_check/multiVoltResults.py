@@ -0,0 +1,91 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+import numpy as np
+import xarray as xr
+from resultsStore import load_results, read_csv_header, parse_header
+from runCatalog import FILENAME_REGEX, parameter_value
+from rasterLoader import grid_indices, axis_size
+
+# Results of the interleaved multi-voltage radialPolar acquisition
+# (radialPolarMultiVoltGUI), which measures every voltage at each R position, one row
+# per (R, V) with the voltage's position in the list as volt_index.
+#
+# split_by_voltage() writes them back out in the layout of the one-voltage campaign, one
+# file per voltage named like 10vn_daedalus_radialPolar_calib_A000.0_2019-06-30_1.csv
+# (negative voltages are vn, positive vp) with the one-voltage header parameters and data
+# columns, so calibFit and the catalog read them as before. load_multivolt() returns the
+# run as one (volts, R) xarray Dataset instead.
+
+SPLIT_PROCEDURE = 'multiVoltResults.radialPolarSplit'
+SPLIT_COLUMNS = ['R', 'Xfield', 'Yfield', 'Zfield', 'theta', 'phi', 'elapsed_time']
+SPLIT_PARAMETERS = ['Center Calibration File', 'Azimuthal Angle', 'Queued Time',
+                    'Start Y position', 'Y position step', 'Stop Y position']
+
+
+def voltage_name(volts):
+    """ Campaign name of a voltage, e.g. 10vn for -10 V """
+    return '%g%s' % (abs(volts), 'vp' if volts > 0 else 'vn')
+
+
+def split_filename(directory, volts, azimuth, date):
+    """ First free per-voltage filename of the day, numbered like pymeasure's unique_filename """
+    prefix = os.path.join(directory, '%s_daedalus_radialPolar_calib_A%05.1f_%s_' % (voltage_name(volts), azimuth, date))
+    run = 1
+    while os.path.exists('%s%d.csv' % (prefix, run)):
+        run += 1
+    return '%s%d.csv' % (prefix, run)
+
+
+def split_by_voltage(filename, directory=None):
+    """ Writes one radialPolar file per voltage of a multi-voltage run, returning their names """
+    procedure, parameters = parse_header(read_csv_header(filename))
+    data = load_results(filename)
+    directory = os.path.dirname(filename) if directory is None else directory
+    match = FILENAME_REGEX.search(os.path.basename(filename))
+    date = match.group('date') if match else ''
+    azimuth = parameter_value(parameters.get('Azimuthal Angle', '0'))
+    filenames = []
+    for volts, rows in data.groupby('V', sort=True):
+        split = split_filename(directory, volts, azimuth, date)
+        lines = ['Procedure: <%s>' % SPLIT_PROCEDURE, 'Parameters:', '\tCalibration Name: %s' % voltage_name(volts)]
+        lines += ['\t%s: %s' % (p, parameters[p]) for p in SPLIT_PARAMETERS[:2] if p in parameters]
+        lines.append('\tMagnet Voltage: %g V' % volts)
+        lines += ['\t%s: %s' % (p, parameters[p]) for p in SPLIT_PARAMETERS[2:] if p in parameters]
+        lines.append('\tSource File: %s' % os.path.basename(filename))
+        lines.append('Data:')
+        with open(split, 'w', newline='') as f:
+            f.write(''.join('#%s\n' % line for line in lines))
+            rows.sort_values('R')[SPLIT_COLUMNS].to_csv(f, index=False)
+        filenames.append(split)
+    log.info("Split %s into %d voltages in %s" % (filename, len(filenames), directory))
+    return filenames
+
+
+def load_multivolt(filename):
+    """ A multi-voltage run as a Dataset on (volts, R), NaN where a point was not measured """
+    procedure, parameters = parse_header(read_csv_header(filename))
+    data = load_results(filename)
+    start, step, stop = [parameter_value(parameters[p]) for p in ('Start Y position', 'Y position step', 'Stop Y position')]
+    volts = np.unique(data.V.values)
+    r_index = grid_indices(data.R.values, start, step)
+    v_index = np.searchsorted(volts, data.V.values)
+    shape = (volts.size, max(axis_size(start, stop, step), r_index.max() + 1 if r_index.size else 0))
+    variables = [c for c in data.columns if c not in ('R', 'V', 'volt_index')]
+    block = np.full((len(variables),) + shape, np.nan)
+    for k, var in enumerate(variables):
+        block[k, v_index, r_index] = data[var].values
+    dataset = xr.Dataset({var: (['volts', 'R'], block[k]) for k, var in enumerate(variables)},
+                         coords={'volts': volts, 'R': start + step*np.arange(shape[1])}, attrs=dict(parameters))
+    dataset.attrs['procedure'] = procedure
+    return dataset
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    for filename in sys.argv[1:]:
+        for split in split_by_voltage(filename):
+            print(split)
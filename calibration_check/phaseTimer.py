@@ -0,0 +1,172 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+from collections import OrderedDict
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+# Per-point timing of the phases of a procedure (moves, in_motion polling, delay sleeps,
+# DAQ reads, emits, ...), written next to the results as <results>_timing.csv.
+#
+#     self.timer = phaseTimer()
+#     with self.timer('connect'):
+#         ...
+#     for point in points:
+#         self.timer.next_point(point)
+#         with self.timer('move'):
+#             self.move_to(point)
+#
+# Every phase costs two perf_counter calls and a dict update. Repeated phases of a point
+# (e.g. the delay of every average) add up. Startup phases are recorded on a 'startup'
+# row and shutdown on a 'shutdown' row after next_point('shutdown'). Work running on
+# another thread (the pipelined emit) passes its point as key.
+
+SETUP_ROWS = ('startup', 'shutdown')
+
+
+class phaseTiming(object):
+    __slots__ = ('row', 'phase', 'start')
+
+    def __init__(self, row, phase):
+        self.row = row
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.row[self.phase] = self.row.get(self.phase, 0.) + perf_counter() - self.start
+
+
+class phaseTimer(object):
+    """ Phase durations in seconds, one row per point """
+
+    def __init__(self):
+        self.rows = OrderedDict()
+        self.start = perf_counter()
+        self.current = 'startup'
+        self.rows['startup'] = {}
+
+    def next_point(self, key):
+        """ Starts timing the point key, e.g. a scanPoint or a stage position """
+        self.current = key
+        self.rows.setdefault(key, {})
+
+    def __call__(self, phase, key=None):
+        row = self.rows.setdefault(self.current if key is None else key, {})
+        return phaseTiming(row, phase)
+
+    def to_dataframe(self):
+        """ One row per point with the point key and a column per phase """
+        records = []
+        for i, (key, phases) in enumerate(self.rows.items()):
+            record = {'point': i - 1, 'key': key if isinstance(key, str) else repr(key)}
+            record.update(phases)
+            records.append(record)
+        timing = pd.DataFrame(records).set_index('point')
+        timing['total'] = timing[self.phases()].sum(axis=1)
+        return timing
+
+    def phases(self):
+        phases = []
+        for row in self.rows.values():
+            phases.extend(p for p in row if p not in phases)
+        return phases
+
+    def save(self, filename):
+        timing = self.to_dataframe()
+        timing.to_csv(filename)
+        log.info("Saved phase timings of %d points to %s (%.1f s total)"
+                 % (len(timing) - 1, filename, perf_counter() - self.start))
+        return filename
+
+
+def timing_filename(data_filename):
+    return os.path.splitext(data_filename)[0] + '_timing.csv'
+
+
+def save_timing(experiment):
+    """ Writes the phase timings of a finished experiment next to its results """
+    timer = getattr(experiment.procedure, 'timer', None)
+    if timer is None:
+        return None
+    return timer.save(timing_filename(experiment.results.data_filename))
+
+
+def load_timing(filename):
+    return pd.read_csv(filename, index_col='point')
+
+
+def scan_points(timing):
+    return timing[~timing.key.isin(SETUP_ROWS)]
+
+
+def phase_columns(timing):
+    """ The phases timed on the scan points """
+    points = scan_points(timing)
+    return [c for c in timing.columns if c not in ('key', 'total') and points[c].notnull().any()]
+
+
+def phase_summary(timing):
+    """ Per-phase totals and per-point statistics (ms) of the scan points """
+    points = scan_points(timing)
+    rows = []
+    for phase in phase_columns(timing):
+        t = points[phase].fillna(0.)*1e3
+        rows.append((phase, t.sum()/1e3, t.mean(), t.median(), np.percentile(t, 95) if len(t) else np.nan,
+                     t.max() if len(t) else np.nan))
+    summary = pd.DataFrame(rows, columns=['phase', 'total (s)', 'mean (ms)', 'median (ms)', 'p95 (ms)', 'max (ms)'])
+    summary = summary.set_index('phase').sort_values('total (s)', ascending=False)
+    summary['share (%)'] = summary['total (s)']/summary['total (s)'].sum()*100
+    return summary
+
+
+def text_histogram(values, bins=10, width=40):
+    """ Histogram of values as lines of '#' bars, for reports in a terminal or log """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return []
+    counts, edges = np.histogram(values, bins=bins)
+    scale = float(width)/max(counts.max(), 1)
+    return ['%10.2f - %10.2f | %s %d' % (edges[i], edges[i + 1], '#'*int(round(c*scale)), c)
+            for i, c in enumerate(counts)]
+
+
+def report(timing, slowest=10, bins=10):
+    """ Text profile of a run: startup phases, per-phase summary, histograms and slowest points """
+    lines = []
+    points = scan_points(timing)
+    phases = phase_columns(timing)
+    lines.append("%d points, %.1f s in timed phases" % (len(points), points.total.sum()))
+    for key in SETUP_ROWS:
+        setup = timing[timing.key == key]
+        if len(setup):
+            row = setup.iloc[0].drop(['key', 'total']).dropna()
+            lines.append("%s: %.2f s (%s)" % (key.capitalize(), setup.total.iloc[0],
+                                              ', '.join('%s %.2f s' % (p, t) for p, t in row.items())))
+    lines.append('')
+    lines.append(phase_summary(timing).round(2).to_string())
+    for phase in phases:
+        lines.append('')
+        lines.append("%s per point (ms):" % phase)
+        lines.extend(text_histogram(points[phase].dropna()*1e3, bins))
+    lines.append('')
+    lines.append("Slowest %d points (ms):" % slowest)
+    slow = points.sort_values('total', ascending=False).head(slowest)
+    slow = pd.concat([slow.key, slow[phases + ['total']]*1e3], axis=1)
+    lines.append(slow.to_string(float_format=lambda v: '%.1f' % v))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    import sys
+    pd.set_option('display.width', 200)
+    for filename in sys.argv[1:]:
+        print(filename)
+        print(report(load_timing(filename)))
+        print('')
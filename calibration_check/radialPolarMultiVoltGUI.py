@@ -0,0 +1,202 @@
+import logging
+from time import sleep, time
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter, BooleanParameter
+from pymeasure.experiment import Procedure
+from instruments import DAQmxAdapter, senis3AxHallProbe, connect_magnet
+from fieldMath import load_probe_zero, zeroed, field_phi, field_theta
+from runningStats import runningStats
+from scanTrajectory import grid_axis
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
+from multiVoltResults import split_by_voltage
+
+from pymeasure.display.windows import ManagedWindow
+from livePlot import livePlotWindow
+from pymeasure.experiment import Results, unique_filename
+import sys
+from pymeasure.display.Qt import QtGui
+
+
+def parse_voltages(text, both_polarities=True):
+    """ The voltages of a comma separated list, with their negatives for both polarities, in ramp order """
+    volts = [float(v) for v in text.replace(';', ',').split(',') if v.strip()]
+    if both_polarities:
+        volts += [-v for v in volts]
+    return sorted(set(volts))
+
+
+class icarusRadialPolarMultiVoltProcedure(Procedure):
+    """
+    Radial polar calibration of Icarus at several magnet voltages in one pass of the stage.
+
+    The stage steps R along Y through the magnet centre at a fixed magnet azimuth, as in
+    the one-voltage radialPolar runs, but at each position the magnet is stepped through
+    every voltage (vn and vp) and the field recorded for each before the stage moves on.
+    Voltages are visited in the same ascending order at every R, so every point of a
+    voltage is approached the same way; the first voltage of the next position is set
+    while the stage moves. The run is split into the per-voltage radialPolar files when
+    it finishes (see multiVoltResults).
+    """
+
+    # control parameters
+    name = Parameter("Calibration Name", default='')
+    center_file = Parameter("Center Calibration File", default='./icarus_center_calib.csv')
+    azimuth = FloatParameter("Azimuthal Angle", units="deg", default=0.)
+    voltages = Parameter("Magnet Voltages", default='1,2,3,4,5,6,7,8,9,10')
+    both_polarities = BooleanParameter("Measure vp and vn", default=True)
+    settle = FloatParameter("Settling time after a voltage step", units="s", default=.2)
+    num_averages = IntegerParameter("Number of Averages", default=3)
+    delay = FloatParameter("Delay between averages", units="s", default=.1)
+
+    r_start = FloatParameter("Start Y position", units="mm", default=-15.)
+    r_stop = FloatParameter("Stop Y position", units="mm", default=15.)
+    r_step = FloatParameter("Y position step", units="mm", default=0.1)
+    split_files = BooleanParameter("Split into per-voltage files", default=True)
+
+    DATA_COLUMNS = ["R", "V", "Xfield", "Yfield", "Zfield", "theta", "phi", "elapsed_time", "volt_index"]
+
+    def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        self.volts = parse_voltages(self.voltages, self.both_polarities)
+        if not self.volts:
+            raise ValueError("No magnet voltages in '%s'" % self.voltages)
+        log.info("Connecting and configuring the instruments")
+        with self.timer('connect'):
+            self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+            self.magnet = connect_magnet()
+            self.volt_tasks = self.magnet.tasks
+        self.zero = load_probe_zero()
+        self.x_centre, self.y_centre = np.loadtxt(self.center_file, delimiter=',').reshape(2)
+        log.info("Measuring %d voltages (%g to %g V) at azimuth %g deg"%(len(self.volts), self.volts[0], self.volts[-1], self.azimuth))
+        with self.timer('move'):
+            self.magnet.motion_inst.phi.position = self.azimuth # see phi setter function
+            self.magnet._phi = self.azimuth
+            self.magnet.motion_inst.x.position = self.x_centre
+        self.wait_for_motion()
+        self.start_time = time()
+
+    def wait_for_motion(self):
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+        with self.timer('errors'):
+            errors = self.magnet.errors
+        for err in errors:
+            log.warning('%s'%err)
+
+    def measure(self, R, V):
+        fields = runningStats()
+        for j in range(self.num_averages):
+            with self.timer('delay'):
+                sleep(self.delay)
+            with self.timer('probe'):
+                fields.add(zeroed(self.hall_probe.x_field, self.hall_probe.y_field, self.hall_probe.z_field, self.zero))
+        x, y, z = fields.mean
+        return {
+            "R": R,
+            "V": V,
+            "Xfield": x,
+            "Yfield": y,
+            "Zfield": z,
+            "theta": field_theta(x, y, z),
+            "phi": field_phi(x, y),
+            "elapsed_time": time() - self.start_time,
+        }
+
+    def execute(self):
+        positions = grid_axis(self.r_start, self.r_stop, self.r_step)
+        num_points = float(len(positions)*len(self.volts))
+        log.info("Measuring %d positions x %d voltages"%(len(positions), len(self.volts)))
+        for i, R in enumerate(positions):
+            self.timer.next_point(float(R))
+            with self.timer('move'):
+                self.magnet.motion_inst.y.position = self.y_centre + R
+            with self.timer('set_volts'):
+                self.magnet.setVolts(self.volts[0]) # settles while the stage moves
+            set_time = time()
+            self.wait_for_motion()
+            for k, V in enumerate(self.volts):
+                if k:
+                    with self.timer('set_volts'):
+                        self.magnet.setVolts(V)
+                    set_time = time()
+                with self.timer('settle'):
+                    sleep(max(self.settle - (time() - set_time), 0.))
+                row = self.measure(R, V)
+                row["volt_index"] = k
+                with self.timer('emit'):
+                    self.emit("results", row)
+                if self.should_stop():
+                    log.warning("Caught stop flag in procedure")
+                    return
+            self.emit('progress', int(100*(i + 1)*len(self.volts)/num_points))
+
+    def shutdown(self):
+        log.info("Done with multi-voltage radial sweep. Shutting down instruments")
+        self.timer.next_point('shutdown')
+        self.live.flush()
+        with self.timer('shutdown'):
+            self.magnet.voltage = 0.
+            self.volt_tasks.close()
+
+
+class icarusRadialPolarMultiVoltGUI(livePlotWindow, ManagedWindow):
+        def __init__(self):
+            super().__init__(
+                procedure_class=icarusRadialPolarMultiVoltProcedure,
+                inputs=[
+                    'name',
+                    'center_file',
+                    'azimuth',
+                    'voltages',
+                    'both_polarities',
+                    'settle',
+                    'num_averages',
+                    'delay',
+                    'r_start',
+                    'r_stop',
+                    'r_step',
+                    'split_files'
+                    ],
+                displays=[
+                    'azimuth',
+                    'voltages',
+                    'both_polarities',
+                    'r_step'
+                    ],
+                x_axis='R',
+                y_axis='Yfield',
+                directory_input=True
+            )
+            self.setWindowTitle('Icarus Multi-Voltage Radial Polar GUI')
+            self.directory = r'C:\Users\TopMob\icarus_calib'
+
+        def queue(self):
+            procedure = self.make_procedure()
+            fname = unique_filename(
+                self.directory,
+                dated_folder=True,
+                prefix=procedure.name + '_daedalus_radialPolarMultiVolt_calib_A%05.1f_' % procedure.azimuth,
+                suffix=''
+            )
+            results = Results(procedure, fname)
+            experiment = self.new_experiment(results)
+            self.manager.queue(experiment)
+
+        def finished(self, experiment):
+            """ Writes the phase timings and the per-voltage files once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+            if experiment.procedure.split_files:
+                split_by_voltage(experiment.results.data_filename)
+
+if __name__ == "__main__":
+    app = QtGui.QApplication(sys.argv)
+    window = icarusRadialPolarMultiVoltGUI()
+    window.show()
+    sys.exit(app.exec_())
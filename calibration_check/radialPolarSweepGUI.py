@@ -0,0 +1,256 @@
+import logging
+from time import sleep, time
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter
+from pymeasure.experiment import Procedure
+from instruments import DAQmxAdapter, senis3AxHallProbe, connect_magnet
+from adaptiveSweep import adaptiveSweep, fitSpec
+from calibFit import FIELD_RATIO_DEGREE, RADIAL_POLAR_DEGREE
+from fieldMath import PROBE_ZERO_FILE, load_probe_zero, zeroed, bmag, field_phi, field_theta, radial_theta
+from runningStats import runningStats
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
+from scanCheckpoint import scanCheckpoint, file_hash, RUNNING, FINISHED, ABORTED, FAILED
+
+from pymeasure.display.windows import ManagedWindow
+from livePlot import livePlotWindow
+from pymeasure.experiment import Results, unique_filename
+import sys
+from pymeasure.display.Qt import QtGui
+
+
+class icarusRadialPolarSweepProcedure(Procedure):
+    """
+    Radial polar calibration sweep of Icarus that fits as it measures.
+
+    The stage steps R along Y through the magnet centre at a fixed voltage and magnet
+    azimuth. Instead of a fixed 0.01 mm grid the sweep starts coarse, refines around
+    R = 0, the ends of the range and wherever Bmag or theta bend, and refits the field
+    magnitude and R(theta) polynomials (vn/vp x R>0/R<0, as in calibFit) after every
+    pass, stopping once they have converged. Rows are recorded in the columns of the
+    original radialPolar files (theta is the field elevation), so the same fitting code
+    applies; R(theta) is fitted on the polar angle in the Y-Z plane, as calibFit does.
+    """
+
+    # control parameters
+    name = Parameter("Calibration Name", default='')
+    center_file = Parameter("Center Calibration File", default='./icarus_center_calib.csv')
+    azimuth = FloatParameter("Azimuthal Angle", units="deg", default=0.)
+    volts = FloatParameter("Magnet Voltage", units="V", default=1.)
+    num_averages = IntegerParameter("Number of Averages", default=3)
+    delay = FloatParameter("Delay between averages", units="s", default=.1)
+
+    r_start = FloatParameter("Start Y position", units="mm", default=-15.)
+    r_stop = FloatParameter("Stop Y position", units="mm", default=15.)
+    coarse_step = FloatParameter("Coarse Y position step", units="mm", default=0.5)
+    r_step = FloatParameter("Y position step", units="mm", default=0.01)
+    dense_width = FloatParameter("Dense region width", units="mm", default=0.5)
+    field_tolerance = FloatParameter("Field interpolation tolerance", units="T", default=2e-5)
+    theta_tolerance = FloatParameter("Theta interpolation tolerance", units="deg", default=0.05)
+    fit_tolerance = FloatParameter("Fit convergence tolerance", default=2e-3)
+    resume_file = Parameter("Resume Results File", default='')
+
+    DATA_COLUMNS = ["R", "Xfield", "Yfield", "Zfield", "theta", "phi", "elapsed_time", "pass"]
+
+    def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        self.checkpoint = self.sweep = None
+        log.info("Connecting and configuring the instruments")
+        with self.timer('connect'):
+            self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+            self.magnet = connect_magnet()
+            self.volt_tasks = self.magnet.tasks
+        self.zero = load_probe_zero()
+        self.x_centre, self.y_centre = np.loadtxt(self.center_file, delimiter=',').reshape(2)
+        self.sign = -1 if self.volts > 0 else 1 # vp scans measure theta from -Yfield
+        self.setup_checkpoint()
+        log.info("Setting magnet voltage to %.2f V and azimuth to %g deg"%(self.volts, self.azimuth))
+        with self.timer('move'):
+            self.magnet.setVolts(self.volts)
+            self.magnet.motion_inst.phi.position = self.azimuth # see phi setter function
+            self.magnet._phi = self.azimuth
+            self.magnet.motion_inst.x.position = self.x_centre
+        self.wait_for_motion()
+        self.start_time = time()
+
+    def grid_index(self, R):
+        return int(round((R - self.r_start)/self.r_step))
+
+    def setup_checkpoint(self):
+        """ Checkpoints the run next to its results, resuming it if the results file already has rows """
+        self.resumed = None
+        if self.live.data_filename is None:
+            return
+        self.checkpoint = scanCheckpoint(self.live.data_filename, self,
+                                         {'center_file': file_hash(self.center_file), 'probe_zero': file_hash(PROBE_ZERO_FILE)})
+        rows = self.checkpoint.resume(lambda rows: [self.grid_index(R) for R in rows.R])
+        if rows is not None:
+            self.resumed = rows.to_dict('records')
+            for row in self.resumed:
+                self.live.buffer.append(row) # plot the points measured before
+        self.checkpoint.save()
+
+    def save_checkpoint(self, status=RUNNING):
+        self.live.flush() # every checkpointed point is in the results file
+        self.checkpoint.save(status)
+
+    def checkpoint_status(self):
+        if self.sweep is not None and self.sweep.done:
+            return FINISHED
+        return ABORTED if self.should_stop() else FAILED
+
+    def wait_for_motion(self):
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+        with self.timer('errors'):
+            errors = self.magnet.errors
+        for err in errors:
+            log.warning('%s'%err)
+
+    def measure(self, R):
+        with self.timer('move'):
+            self.magnet.motion_inst.y.position = self.y_centre + R
+        self.wait_for_motion()
+        fields = runningStats()
+        for j in range(self.num_averages):
+            with self.timer('delay'):
+                sleep(self.delay)
+            with self.timer('probe'):
+                fields.add(zeroed(self.hall_probe.x_field, self.hall_probe.y_field, self.hall_probe.z_field, self.zero))
+        x, y, z = fields.mean
+        return {
+            "R": R,
+            "Xfield": x,
+            "Yfield": y,
+            "Zfield": z,
+            "theta": field_theta(x, y, z),
+            "phi": field_phi(x, y),
+            "Bmag": bmag(0., y, z),
+            "radial_theta": radial_theta(y, z, self.sign),
+            "elapsed_time": time() - self.start_time,
+        }
+
+    def make_sweep(self):
+        positive = dict(where='R', low=1e-9, high=np.inf)
+        negative = dict(where='R', low=-np.inf, high=-1e-9)
+        fits = [fitSpec('Bmag_rp', 'R', 'Bmag', FIELD_RATIO_DEGREE, **positive),
+                fitSpec('Bmag_rn', 'R', 'Bmag', FIELD_RATIO_DEGREE, **negative),
+                fitSpec('R_theta_rp', 'radial_theta', 'R', RADIAL_POLAR_DEGREE, **positive),
+                fitSpec('R_theta_rn', 'radial_theta', 'R', RADIAL_POLAR_DEGREE, **negative)]
+        w = self.dense_width
+        dense = [(-w, w), (self.r_start, self.r_start + w), (self.r_stop - w, self.r_stop)]
+        return adaptiveSweep(self.r_start, self.r_stop, self.coarse_step, self.r_step, fits,
+                             {'Bmag': self.field_tolerance, 'radial_theta': self.theta_tolerance},
+                             self.fit_tolerance, dense, key_points=[0.])
+
+    def execute(self):
+        sweep = self.sweep = self.make_sweep()
+        if self.resumed:
+            for row in self.resumed:
+                row["Bmag"] = bmag(0., row["Yfield"], row["Zfield"]) # not data columns
+                row["radial_theta"] = radial_theta(row["Yfield"], row["Zfield"], self.sign)
+                sweep.add(row["R"], row)
+            log.info("Resuming with %d points already measured"%len(self.resumed))
+        full_points = int(round(abs(self.r_stop - self.r_start)/self.r_step)) + 1
+        while not sweep.done:
+            points = sweep.next_pass()
+            log.info("Pass %d: measuring %d points"%(sweep.passes + 1, len(points)))
+            for R in points:
+                self.timer.next_point(R)
+                row = self.measure(R)
+                sweep.add(R, row)
+                row["pass"] = sweep.passes + 1
+                with self.timer('emit'):
+                    self.emit("results", row)
+                state = {'volts': self.volts, 'azimuth': self.azimuth, 'X': float(self.x_centre), 'Y': float(self.y_centre + R)}
+                if self.checkpoint is not None and self.checkpoint.add(self.grid_index(R), state):
+                    with self.timer('checkpoint'):
+                        self.save_checkpoint()
+                self.emit('progress', int(100*min(len(sweep.rows)/float(full_points), 1.)))
+                if self.should_stop():
+                    log.warning("Caught stop flag in procedure")
+                    return
+            with self.timer('fit'):
+                sweep.finish_pass(points)
+        log.info("Measured %d of %d fixed-step points"%(len(sweep.rows), full_points))
+
+    def shutdown(self):
+        log.info("Done with radial sweep. Shutting down instruments")
+        self.timer.next_point('shutdown')
+        if self.checkpoint is not None:
+            self.save_checkpoint(self.checkpoint_status())
+        else:
+            self.live.flush()
+        with self.timer('shutdown'):
+            self.magnet.voltage = 0.
+            self.volt_tasks.close()
+
+
+class icarusRadialPolarSweepGUI(livePlotWindow, ManagedWindow):
+        def __init__(self):
+            super().__init__(
+                procedure_class=icarusRadialPolarSweepProcedure,
+                inputs=[
+                    'name',
+                    'center_file',
+                    'azimuth',
+                    'volts',
+                    'num_averages',
+                    'delay',
+                    'r_start',
+                    'r_stop',
+                    'coarse_step',
+                    'r_step',
+                    'dense_width',
+                    'field_tolerance',
+                    'theta_tolerance',
+                    'fit_tolerance',
+                    'resume_file'
+                    ],
+                displays=[
+                    'volts',
+                    'azimuth',
+                    'coarse_step',
+                    'r_step',
+                    'fit_tolerance'
+                    ],
+                x_axis='R',
+                y_axis='Yfield',
+                directory_input=True
+            )
+            self.setWindowTitle('Icarus Radial Polar Sweep GUI')
+            self.directory = r'C:\Users\TopMob\icarus_calib'
+
+        def queue(self):
+            procedure = self.make_procedure()
+            if procedure.resume_file:
+                # append to the earlier run, with its own parameters, from its checkpoint
+                results = Results.load(procedure.resume_file, icarusRadialPolarSweepProcedure)
+                results.procedure.status = Procedure.QUEUED
+                log.info("Resuming %s" % procedure.resume_file)
+            else:
+                fname = unique_filename(
+                    self.directory,
+                    dated_folder=True,
+                    prefix=procedure.name + '_daedalus_radialPolar_calib_A%05.1f_' % procedure.azimuth,
+                    suffix=''
+                )
+                results = Results(procedure, fname)
+            experiment = self.new_experiment(results)
+            self.manager.queue(experiment)
+
+        def finished(self, experiment):
+            """ Writes the phase timings once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+
+if __name__ == "__main__":
+    app = QtGui.QApplication(sys.argv)
+    window = icarusRadialPolarSweepGUI()
+    window.show()
+    sys.exit(app.exec_())
@@ -0,0 +1,339 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from rasterLoader import load_raster, GRID_SPECS
+from runCatalog import parameter_value
+from fieldMath import bmag, field_phi, field_theta, field_columns
+from driftCheck import angle_difference
+
+# Comparison of field rasters taken on different days, grids and stage offsets, e.g. the
+# shim and alignment rasters of 2019-06/2019-07, in place of the pairwise notebook work.
+#
+# The rasters are registered on one common grid: the overlap of their extents (or the
+# union, NaN where a raster has no data) at the finest of their steps, each raster
+# shifted by its stage offset if given, and interpolated bilinearly onto it. Points
+# outside a raster, or next to one it never measured, are NaN. The runs are stacked into
+# one (run, slow, fast) Dataset of fields, Bmag, act_phi and act_theta, so every
+# comparison below is a single array expression over all runs (or all pairs of runs)
+# instead of a loop:
+#
+#   centre_objectives  the fieldCentreGUI objectives of phi 0/90 run pairs:
+#                      Bz0^2 + Bz90^2 (minimum at the centre) and By0^2 + Bx90^2
+#                      (the in-plane field, maximum at the centre)
+#   extremum_centres   position of the minimum or maximum of each map, refined between
+#                      grid points by a parabola through its neighbours
+#   uniformity         mean, spread and peak-to-peak of each map within a radius
+#   difference_maps    map of every run minus every other, (run, reference, slow, fast)
+#   compare_pairs      rms and largest difference and centre shift of every pair, from
+#                      the difference maps of the pairs taken once each
+#
+# Stage offsets shift the coordinates of a raster, so passing minus the centre of each
+# run compares the maps relative to their centres rather than to the stage.
+#
+# The fields are compared as recorded unless told otherwise. Calibration check rasters
+# store fields already zeroed with Z flipped, and always pass through unchanged. The
+# fieldRaster procedure records them raw: given zero=, the probe zero is subtracted as
+# in the notebooks (Zfield_avg - z_zero), and flip_z=True also flips Z as the
+# calibration procedures do.
+
+RUN_DIM = 'run'
+REFERENCE_DIM = 'reference'
+ANGLE_VARIABLES = ['act_phi']
+RAW_DIMS = ['%scoord' % column for column, prefix in GRID_SPECS[0]] # fieldRaster grid
+
+
+def axis_values(start, end, step):
+    """ Grid points from start to end (inclusive, to within a thousandth of a step) """
+    return start + step*np.arange(int(np.floor((end - start)/step + 1e-3)) + 1)
+
+
+def common_grid(datasets, step=None, extent='intersection', offsets=None):
+    """
+    Coordinates of the grid the datasets are compared on: their overlap (extent
+    'intersection') or their combined extent ('union'), at step, by default the finest
+    step of each axis among them.
+    """
+    dims = list(datasets[0].dims)
+    for dataset in datasets[1:]:
+        if list(dataset.dims) != dims:
+            raise ValueError("Rasters on %s and %s cannot be compared" % (', '.join(dims), ', '.join(dataset.dims)))
+    offsets = np.zeros((len(datasets), len(dims))) if offsets is None else np.asarray(offsets, dtype=float)
+    coords = {}
+    for k, dim in enumerate(dims):
+        values = [ds[dim].values + offset[k] for ds, offset in zip(datasets, offsets)]
+        lows, highs = np.array([(v.min(), v.max()) for v in values]).T
+        steps = [np.min(np.abs(np.diff(v))) for v in values if v.size > 1]
+        axis_step = step[k] if np.ndim(step) else step
+        if axis_step is None:
+            axis_step = min(steps) if steps else 1.
+        low, high = (lows.max(), highs.min()) if extent == 'intersection' else (lows.min(), highs.max())
+        if high < low - 1e-9:
+            raise ValueError("The rasters do not overlap along %s" % dim)
+        coords[dim] = axis_values(low, high, axis_step)
+    return coords
+
+
+def axis_weights(source, target):
+    """
+    Lower and upper source indices and the weight of the upper one for linear
+    interpolation of an axis onto target, with a mask of the targets inside the source.
+    """
+    order = np.argsort(source)
+    source = source[order]
+    position = np.interp(target, source, np.arange(source.size))
+    lower = np.minimum(np.floor(position).astype(int), source.size - 1)
+    weight = position - lower
+    upper = np.minimum(lower + 1, source.size - 1)
+    tolerance = 1e-6*(np.ptp(source) or 1.)
+    inside = (target >= source[0] - tolerance) & (target <= source[-1] + tolerance)
+    return order[lower], order[upper], weight, inside
+
+
+def interpolate_axis(block, axis, lower, upper, weight, inside):
+    """ Linear interpolation of block along axis; a point exactly on the grid ignores its neighbour """
+    shape = [1]*block.ndim
+    shape[axis] = weight.size
+    weight = weight.reshape(shape)
+    low, high = np.take(block, lower, axis=axis), np.take(block, upper, axis=axis)
+    with np.errstate(invalid='ignore'):
+        values = np.where(weight == 0, low, low*(1 - weight) + high*weight)
+    return np.where(inside.reshape(shape), values, np.nan)
+
+
+def regrid(dataset, coords, variables, offset=None):
+    """ The variables of a raster bilinearly interpolated onto coords, as a (variable, slow, fast) block """
+    block = np.stack([dataset[v].values.astype(float) for v in variables])
+    offset = np.zeros(len(coords)) if offset is None else offset
+    for k, dim in enumerate(coords):
+        block = interpolate_axis(block, k + 1, *axis_weights(dataset[dim].values + offset[k], coords[dim]))
+    return block
+
+
+def recorded_raw(dataset):
+    """ True for rasters recorded without the probe zero correction (fieldRaster) """
+    return list(dataset.dims) == RAW_DIMS
+
+
+def run_label(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def stack_rasters(rasters, labels=None, step=None, extent='intersection', offsets=None, zero=None, flip_z=False):
+    """
+    Registers raster files (or Datasets from load_raster) on a common grid and stacks
+    them into one (run, slow, fast) Dataset of fields, Bmag, act_phi and act_theta.
+    offsets are per raster (slow, fast) stage offsets added to its coordinates. zero,
+    if given, is subtracted from the rasters recorded raw, whose Z flip_z also flips;
+    calibration check rasters are already zeroed and are left as recorded.
+    """
+    datasets = [load_raster(r) if isinstance(r, str) else r for r in rasters]
+    if labels is None:
+        labels = [run_label(r) if isinstance(r, str) else 'run%d' % j for j, r in enumerate(rasters)]
+    offsets = np.zeros((len(datasets), 2)) if offsets is None else np.asarray(offsets, dtype=float)
+    coords = common_grid(datasets, step, extent, offsets)
+    columns = field_columns(datasets[0])
+    block = np.stack([regrid(ds, coords, columns, offset) for ds, offset in zip(datasets, offsets)], axis=1)
+    raw = np.array([recorded_raw(ds) for ds in datasets])
+    if raw.any() and zero is not None:
+        block[:, raw] -= np.reshape(zero, (3, 1, 1, 1))
+    if raw.any() and flip_z:
+        block[2, raw] *= -1
+    if not raw.all() and (zero is not None or flip_z):
+        log.info("Leaving the already zeroed calibration check rasters as recorded")
+    x, y, z = block[0], block[1], block[2]
+    variables = {columns[0]: x, columns[1]: y, columns[2]: z, 'Bmag': bmag(x, y, z),
+                 'act_phi': field_phi(x, y), 'act_theta': field_theta(x, y, z)}
+    dims = [RUN_DIM] + list(coords)
+    stack = xr.Dataset({name: (dims, values) for name, values in variables.items()}, coords=coords)
+    stack.coords[RUN_DIM] = labels
+    stack.coords['magnet_phi'] = (RUN_DIM, [parameter_value(ds.attrs.get('Magnet Phi', '')) for ds in datasets])
+    stack.coords['offset'] = ((RUN_DIM, 'axis'), offsets)
+    stack.coords['coverage'] = (RUN_DIM, np.mean(np.isfinite(z), axis=(1, 2)))
+    for label, coverage in zip(labels, stack.coverage.values):
+        if coverage < 1:
+            log.info("%s covers %.0f%% of the common grid" % (label, 100*coverage))
+    return stack
+
+
+def centre_objectives(stack, phi0_runs, phi90_runs, labels=None):
+    """
+    The fieldCentreGUI objectives of each (phi 0, phi 90) pair of runs, as a (site,
+    slow, fast) Dataset: 'Zfield zero', Bz0^2 + Bz90^2, and 'Inplane field', By0^2 + Bx90^2.
+    """
+    x, y, z = field_columns(stack)
+    phi0, phi90 = list(phi0_runs), list(phi90_runs)
+    labels = list(stack[RUN_DIM].values[phi0]) if labels is None else labels
+    slow_dim, fast_dim = stack[z].dims[1:]
+    dims = ['site', slow_dim, fast_dim]
+    return xr.Dataset({'Zfield zero': (dims, stack[z].values[phi0]**2 + stack[z].values[phi90]**2),
+                       'Inplane field': (dims, stack[y].values[phi0]**2 + stack[x].values[phi90]**2)},
+                      coords={'site': labels, slow_dim: stack[slow_dim].values, fast_dim: stack[fast_dim].values})
+
+
+def parabola_vertex(low, centre, high):
+    """ Offset in grid steps of the vertex of the parabola through three equally spaced values, within +-0.5 """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = 0.5*(low - high)/(low - 2*centre + high)
+    return np.clip(np.where(np.isfinite(offset), offset, 0.), -0.5, 0.5)
+
+
+def extremum_centres(maps, kind='min'):
+    """
+    Position of the minimum (or maximum) of each map of a (run, slow, fast) DataArray,
+    as a DataFrame indexed by run with the fast and slow coordinates (e.g. X and Y) and
+    the value there, NaN for a map without data.
+    """
+    run_dim, slow_dim, fast_dim = maps.dims
+    values = maps.values
+    flat = values.reshape(values.shape[0], -1)
+    empty = np.all(np.isnan(flat), axis=1)
+    for label in maps[run_dim].values[empty]:
+        log.warning("%s has no data on the common grid" % label)
+    searched = np.where(empty[:, None], 0., flat)
+    index = np.nanargmin(searched, axis=1) if kind == 'min' else np.nanargmax(searched, axis=1)
+    runs = np.arange(values.shape[0])
+    at = np.unravel_index(index, values.shape[1:])
+    position = []
+    for k, dim in enumerate((slow_dim, fast_dim)):
+        n = values.shape[k + 1]
+        around = []
+        for d in (-1, 0, 1):
+            shifted = list(at)
+            shifted[k] = np.clip(at[k] + d, 0, n - 1)
+            around.append(values[runs, shifted[0], shifted[1]])
+        offset = np.where((at[k] > 0) & (at[k] < n - 1), parabola_vertex(*around), 0.)
+        coords = maps[dim].values
+        position.append(np.where(empty, np.nan, coords[at[k]] + offset*(coords[1] - coords[0] if n > 1 else 0.)))
+    return pd.DataFrame({fast_dim.replace('coord', ''): position[1], slow_dim.replace('coord', ''): position[0],
+                         'value': flat[runs, index]}, index=pd.Index(maps[run_dim].values, name=run_dim))
+
+
+def region_mask(maps, centres=None, radius=None):
+    """ (run, slow, fast) mask of the grid points within radius of each run's centre (all points without a radius) """
+    run_dim, slow_dim, fast_dim = maps.dims
+    if radius is None:
+        return np.ones(maps.shape, dtype=bool)
+    columns = [fast_dim.replace('coord', ''), slow_dim.replace('coord', '')]
+    cx, cy = (centres[columns].values.T if centres is not None else
+              [np.full(maps.shape[0], maps[d].values.mean()) for d in (fast_dim, slow_dim)])
+    dx = maps[fast_dim].values[None, None, :] - cx[:, None, None]
+    dy = maps[slow_dim].values[None, :, None] - cy[:, None, None]
+    return dx**2 + dy**2 <= radius**2
+
+
+def uniformity(maps, centres=None, radius=None):
+    """
+    Figures of merit of each map within radius of its centre: mean, std and
+    peak-to-peak, the last two also in percent of the mean, with min, max and the
+    number of points used.
+    """
+    values = np.where(region_mask(maps, centres, radius), maps.values, np.nan)
+    flat = values.reshape(values.shape[0], -1)
+    points = np.sum(np.isfinite(flat), axis=1)
+    flat = np.where(points[:, None] > 0, flat, 0.) # no all-NaN rows, those are set to NaN below
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean, std = np.nanmean(flat, axis=1), np.nanstd(flat, axis=1)
+        low, high = np.nanmin(flat, axis=1), np.nanmax(flat, axis=1)
+        merit = pd.DataFrame({'points': points, 'mean': mean, 'std': std, 'std_percent': 100*std/np.abs(mean),
+                              'peak_to_peak': high - low, 'peak_to_peak_percent': 100*(high - low)/np.abs(mean),
+                              'min': low, 'max': high}, index=pd.Index(maps[maps.dims[0]].values, name=maps.dims[0]))
+    merit.loc[points == 0, merit.columns[1:]] = np.nan
+    return merit
+
+
+def differences(maps, values, references):
+    """ values - references of the variable of maps, wrapped to +-180 for angles """
+    if maps.name in ANGLE_VARIABLES:
+        return angle_difference(values, references)
+    return values - references
+
+
+def difference_maps(maps):
+    """ Every map minus every other, as a (run, reference, slow, fast) DataArray """
+    run_dim, slow_dim, fast_dim = maps.dims
+    values = maps.values
+    return xr.DataArray(differences(maps, values[:, None], values[None, :]), name=maps.name,
+                        dims=[run_dim, REFERENCE_DIM, slow_dim, fast_dim],
+                        coords={run_dim: maps[run_dim].values, REFERENCE_DIM: maps[run_dim].values,
+                                slow_dim: maps[slow_dim].values, fast_dim: maps[fast_dim].values})
+
+
+def compare_pairs(maps, centres=None, radius=None):
+    """
+    Every pair of maps (run against reference, each pair once) within radius of the
+    reference centre: the mean, rms and largest difference, the rms in percent of the
+    reference mean, the number of points both cover and, given the centres, the shift of
+    the run centre from the reference centre.
+    """
+    values = maps.values
+    n = values.shape[0]
+    reference, run = np.triu_indices(n, 1)
+    mask = region_mask(maps, centres, radius)
+    flat = np.where(mask[reference], differences(maps, values[run], values[reference]), np.nan).reshape(len(run), -1)
+    points = np.sum(np.isfinite(flat), axis=1)
+    within = np.where(mask, values, np.nan).reshape(n, -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        filled = np.where(points[:, None] > 0, flat, 0.)
+        reference_mean = np.nanmean(np.where(np.isfinite(within).any(axis=1)[:, None], within, 0.), axis=1)
+        rms = np.sqrt(np.nanmean(filled**2, axis=1))
+        labels = maps[maps.dims[0]].values
+        pairs = pd.DataFrame({RUN_DIM: labels[run], REFERENCE_DIM: labels[reference], 'points': points,
+                              'mean_difference': np.nanmean(filled, axis=1), 'rms_difference': rms,
+                              'rms_percent': 100*rms/np.abs(reference_mean[reference]),
+                              'max_difference': np.nanmax(np.abs(filled), axis=1)})
+    pairs.loc[pairs.points == 0, pairs.columns[3:]] = np.nan
+    if centres is not None:
+        columns = [c for c in centres.columns if c != 'value']
+        position = centres[columns].values
+        shift = position[:, None] - position[None, :]
+        for k, column in enumerate(columns):
+            pairs['d%s' % column] = shift[run, reference, k]
+        pairs['shift'] = np.hypot(shift[run, reference, 0], shift[run, reference, 1])
+    return pairs
+
+
+def compare_rasters(rasters, variable='Bmag', kind='max', radius=None, **stack_options):
+    """ Stacks the rasters and returns the stack, each run's centre and uniformity of variable, and every pair """
+    stack = stack_rasters(rasters, **stack_options)
+    maps = stack[variable]
+    centres = extremum_centres(maps, kind)
+    return stack, centres.join(uniformity(maps, centres, radius)), compare_pairs(maps, centres, radius)
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    options = {'variable': 'Bmag', 'kind': 'max', 'radius': None, 'step': None, 'extent': 'intersection', 'zero': None,
+               'flip_z': False, 'output': None}
+    files = []
+    for arg in sys.argv[1:]:
+        if '=' in arg:
+            key, value = arg.split('=', 1)
+            if key == 'zero':
+                value = [float(v) for v in value.split(',')]
+            elif key == 'flip_z':
+                value = value.lower() in ('1', 'true', 'yes')
+            options[key] = float(value) if key in ('radius', 'step') else value
+        else:
+            files.append(arg)
+    if len(files) < 2:
+        print("Usage: python rasterCompare.py raster.csv raster.csv [...] [variable=Bmag] [kind=max|min] "
+              "[radius=mm] [step=mm] [extent=intersection|union] [zero=x,y,z] [flip_z=0|1] [output=prefix]")
+        sys.exit(1)
+    stack, runs, pairs = compare_rasters(files, options['variable'], options['kind'], options['radius'],
+                                         step=options['step'], extent=options['extent'], zero=options['zero'],
+                                         flip_z=options['flip_z'])
+    pd.set_option('display.width', 200)
+    print('%s on %s grid of %s' % (options['variable'], options['extent'],
+                                    ' x '.join('%d %s' % (stack[d].size, d) for d in stack[options['variable']].dims[1:])))
+    print(runs.to_string())
+    print(pairs.to_string(index=False))
+    if options['output']:
+        runs.to_csv(options['output'] + '_runs.csv')
+        pairs.to_csv(options['output'] + '_pairs.csv', index=False)
+        stack.to_netcdf(options['output'] + '_stack.nc')
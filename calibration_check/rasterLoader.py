@@ -0,0 +1,110 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+import xarray as xr
+from resultsStore import load_results, read_csv_header, parse_header
+from runCatalog import parameter_value
+
+# Raster scans as xarray Datasets, with the grid taken from the '#Parameters' header.
+#
+# Every row is placed on the grid by snapping its coordinates to the nearest grid
+# index, so float drift in the file (26.720000000000002) and the scan ordering do not
+# matter, and points never measured (an aborted scan) are left as NaN. All variables
+# are views into one contiguous (variable, slow, fast) array.
+
+# (data column, header parameter prefix) of the slow and fast axes of each raster kind
+GRID_SPECS = [
+    (('Y', 'stage Y %s'), ('X', 'stage X %s')),                # fieldRaster
+    (('theta', 'Theta %s'), ('phi', 'Phi %s')),                # calibration checks
+]
+GRID_PARAMETERS = ('Start Position', 'End Position', 'Scan Step Size')
+
+
+def grid_spec(parameters):
+    """ Returns [(column, start, end, step)] for the slow and fast axes of a raster header """
+    for spec in GRID_SPECS:
+        names = [prefix % p for column, prefix in spec for p in GRID_PARAMETERS]
+        if all(n in parameters for n in names):
+            return [(column,) + tuple(parameter_value(parameters[prefix % p]) for p in GRID_PARAMETERS)
+                    for column, prefix in spec]
+    raise ValueError("No raster grid in parameters: %s" % ', '.join(parameters))
+
+
+def grid_indices(values, start, step):
+    return np.rint((np.asarray(values, dtype=float) - start)/step).astype(int)
+
+
+def axis_size(start, end, step):
+    return int(round((end - start)/step)) + 1 if step else 1
+
+
+class rasterGrid(object):
+    """ The slow x fast grid of a raster file and the grid position of every data row """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.procedure, self.parameters = parse_header(read_csv_header(filename))
+        self.data = load_results(filename)
+        self.axes = grid_spec(self.parameters)
+        self.dims = ['%scoord' % column for column, start, end, step in self.axes]
+        self.indices = []
+        self.coords = {}
+        for dim, (column, start, end, step) in zip(self.dims, self.axes):
+            if '%s_index' % column in self.data:
+                index = self.data['%s_index' % column].values.astype(int)
+            else:
+                index = grid_indices(self.data[column].values, start, step) if step else np.zeros(len(self.data), dtype=int)
+            n = max(axis_size(start, end, step), index.max() + 1 if index.size else 0)
+            self.indices.append(index)
+            self.coords[dim] = start + step*np.arange(n)
+        self.shape = tuple(c.size for c in self.coords.values())
+        self.variables = [c for c in self.data.columns if not c.endswith('_index')]
+
+    def fill(self, block):
+        """ Writes the data rows into a (variable, slow, fast) block of NaNs """
+        valid = np.all([(i >= 0) & (i < n) for i, n in zip(self.indices, self.shape)], axis=0)
+        if not valid.all():
+            log.warning("%d rows of %s are off the grid" % (np.sum(~valid), self.filename))
+        slow, fast = self.indices[0][valid], self.indices[1][valid]
+        for k, var in enumerate(self.variables):
+            block[k, slow, fast] = self.data[var].values[valid]
+        return np.count_nonzero(valid)
+
+
+def load_raster(filename):
+    """ Returns a raster file as an xarray Dataset on its header grid """
+    grid = rasterGrid(filename)
+    block = np.full((len(grid.variables),) + grid.shape, np.nan)
+    filled = grid.fill(block)
+    dataset = xr.Dataset({var: (grid.dims, block[k]) for k, var in enumerate(grid.variables)},
+                         coords=grid.coords, attrs=dict(grid.parameters))
+    dataset.attrs['procedure'] = grid.procedure
+    dataset.attrs['filled'] = filled/float(np.prod(grid.shape))
+    if filled < np.prod(grid.shape):
+        log.info("%s covers %d of %d grid points" % (filename, filled, np.prod(grid.shape)))
+    return dataset
+
+
+def load_rasters(filenames, dim='magnet_phi', labels=None, parameter='Magnet Phi'):
+    """
+    Stacks rasters on the same grid, e.g. the phi 0/90/45 field rasters, into one
+    Dataset along dim. labels default to the numeric value of parameter in each header.
+    """
+    grids = [rasterGrid(f) for f in filenames]
+    first = grids[0]
+    for grid in grids[1:]:
+        if grid.shape != first.shape or not all(np.allclose(grid.coords[d], first.coords[d]) for d in first.dims):
+            raise ValueError("%s is not on the grid of %s" % (grid.filename, first.filename))
+    variables = [v for v in first.variables if all(v in g.variables for g in grids)]
+    if labels is None:
+        labels = [parameter_value(g.parameters.get(parameter, '')) for g in grids]
+    block = np.full((len(variables), len(grids)) + first.shape, np.nan)
+    for j, grid in enumerate(grids):
+        grid.variables = variables
+        grid.fill(block[:, j])
+    coords = dict(first.coords)
+    coords[dim] = labels
+    dims = [dim] + first.dims
+    return xr.Dataset({var: (dims, block[k]) for k, var in enumerate(variables)}, coords=coords)
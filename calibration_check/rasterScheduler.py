@@ -0,0 +1,111 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import queue
+import threading
+from phaseTimer import phaseTimer
+
+
+class resultsWorker(threading.Thread):
+    """
+    Reduces and emits finished points on a background thread so the acquisition
+    thread can command the next move straight after sampling.
+    """
+
+    def __init__(self, emit_point):
+        super().__init__(daemon=True)
+        self.emit_point = emit_point
+        self.points = queue.Queue()
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.points.get()
+            if item is None:
+                break
+            try:
+                self.emit_point(*item)
+            except Exception as e:
+                log.exception("Failed to emit point %s" % (item[0],))
+                self.error = e
+
+    def put(self, *item):
+        self.points.put(item)
+
+    def finish(self):
+        self.points.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+class rasterScheduler(object):
+    """
+    Motion-overlapped scan engine for the Icarus calibration procedures.
+
+    For each point the scheduler waits for the ESP300 to report the move complete,
+    samples, then immediately issues the move to the next point while the previous
+    point's statistics and results are produced on a resultsWorker thread.
+
+    Motion completion is event driven: the ESP300 WS (wait for stop) command holds
+    the controller's command queue until every axis has stopped, so the following
+    position queries are only answered once the stage has settled. This replaces
+    polling in_motion every 50 ms and returns the settled X, Y positions for free.
+
+    move(point) issues a move to a scanTrajectory.scanPoint without waiting, sample()
+    returns the sampled fields at the current position and emit_point(point, x, y,
+    sample) builds and emits the results of that point. A phaseTimer, if given, gets
+    a row per point with the wait for motion timed as in_motion.
+    """
+
+    def __init__(self, magnet, move, sample, emit_point, should_stop, settle_timeout=120., timer=None):
+        self.magnet = magnet
+        self.move = move
+        self.sample = sample
+        self.emit_point = emit_point
+        self.should_stop = should_stop
+        self.settle_timeout = settle_timeout
+        self.timer = phaseTimer() if timer is None else timer
+
+    def wait_for_motion(self):
+        """ Blocks until every axis has stopped, returning the settled X, Y positions """
+        motion = self.magnet.motion_inst
+        connection = motion.adapter.connection
+        timeout = connection.timeout
+        connection.timeout = self.settle_timeout*1e3
+        try:
+            motion.write("1WS;2WS;3WS")
+            x = motion.x.position
+            y = motion.y.position
+        finally:
+            connection.timeout = timeout
+        for err in self.magnet.errors:
+            log.warning('%s'%err)
+        return x, y
+
+    def run(self, points):
+        """ Scans the points in order, returning the number completed """
+        if len(points) == 0:
+            return 0
+        worker = resultsWorker(self.emit_point)
+        worker.start()
+        completed = 0
+        try:
+            self.move(points[0])
+            for i, point in enumerate(points):
+                self.timer.next_point(point)
+                with self.timer('in_motion'):
+                    x, y = self.wait_for_motion()
+                sample = self.sample()
+                stop = self.should_stop()
+                if i + 1 < len(points) and not stop:
+                    self.move(points[i + 1])
+                worker.put(point, x, y, sample)
+                completed += 1
+                if stop:
+                    log.warning("Caught stop flag in procedure")
+                    break
+        finally:
+            worker.finish()
+        return completed
@@ -0,0 +1,100 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from runCatalog import runCatalog
+from resultsStore import load_results, read_csv_header, write_npz, columnarResults
+from fieldMath import derive
+
+# Batch reprocessing of the dated scan archive across a process pool.
+#
+# Runs are discovered with runCatalog, then each worker loads one run (from its
+# columnar copy when there is one), derives Bmag/act_phi/act_theta (and the deviation
+# from the target field of calibration checks) with fieldMath, writes the derived run
+# to <output>/<date>/<run>.npz and returns a one-row summary. A derived file newer than
+# its source is reused, so re-runs only redo new or changed runs. The summaries of all
+# runs are consolidated in <output>/summary.csv.
+
+PIPELINE_VERSION = 1
+OUTPUT_DIR = 'reprocessed'
+
+
+def derived_filename(output, path):
+    return os.path.join(output, os.path.splitext(path)[0] + '.npz')
+
+
+def summarize(run, data):
+    """ One summary row of a derived run """
+    summary = dict(run)
+    summary['points'] = len(data)
+    if 'Bmag' in data:
+        summary['Bmag_mean'] = data['Bmag'].mean()
+        summary['Bmag_std'] = data['Bmag'].std()
+    if 'Bmag_percent_dev' in data:
+        summary['percent_dev_mean'] = data['Bmag_percent_dev'].mean()
+        summary['percent_dev_max'] = data['Bmag_percent_dev'].abs().max()
+    return summary
+
+
+def process_run(root, output, run, force=False):
+    """ Derives and caches one catalogued run, returning its summary (runs in a worker process) """
+    source = os.path.join(root, run['path'])
+    target = derived_filename(output, run['path'])
+    if not force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        with columnarResults(target) as cached:
+            return summarize(run, cached.to_dataframe()), False
+
+    data = load_results(source)
+    data = data.apply(pd.to_numeric, errors='coerce')
+    if {'Xfield', 'Yfield', 'Zfield'} <= set(data.columns) or 'Xfield_avg' in data:
+        field = run.get('field', np.nan)
+        data = derive(data, target=None if pd.isnull(field) else field)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    header = read_csv_header(source) + ['Reprocessed: version %d' % PIPELINE_VERSION]
+    write_npz(target, data, header)
+    return summarize(run, data), True
+
+
+def reprocess(root, output=None, workers=None, force=False, **query):
+    """
+    Reprocesses every catalogued run matching query (see runCatalog.find) on a pool of
+    workers, defaulting to one per core, and returns the consolidated summary.
+    """
+    output = output or os.path.join(root, OUTPUT_DIR, 'v%d' % PIPELINE_VERSION)
+    runs = runCatalog(root).find(newest_first=False, **query)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_run, root, output, run, force) for run in runs.to_dict('records')]
+        summaries = []
+        processed = 0
+        for future, path in zip(futures, runs['path']):
+            try:
+                summary, fresh = future.result()
+            except Exception as e:
+                log.warning("Could not reprocess %s: %s" % (path, e))
+                continue
+            summaries.append(summary)
+            processed += fresh
+    log.info("Reprocessed %d of %d runs (%d cached) in %.1f s" % (processed, len(runs), len(summaries) - processed, time.time() - start))
+    summary = pd.DataFrame(summaries)
+    os.makedirs(output, exist_ok=True)
+    summary.to_csv(os.path.join(output, 'summary.csv'), index=False)
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Reprocess the scan archive in parallel")
+    parser.add_argument('root', nargs='?', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--kind', default=None, help="only runs of this procedure kind, e.g. calibCheck")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help="ignore the per-run cache")
+    args = parser.parse_args()
+    reprocess(args.root, args.output, args.workers, args.force, kind=args.kind)
@@ -0,0 +1,162 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import glob
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Columnar results store for the dated scan archive.
+#
+# Each run is one uncompressed .npz file next to its .csv: one float64 member per data
+# column (so the values are exactly those of the CSV, without the 17 digit text) plus a
+# '__header__' member holding the pymeasure '#Procedure'/'#Parameters' header verbatim.
+# np.load opens the archive without reading any column; columns are read on first
+# access, so pulling X, Y and Bz out of a 3000 row radialPolar run costs three reads.
+
+SUFFIX = '.npz'
+HEADER_KEY = '__header__'
+PARAMETER_REGEX = re.compile(r"^\t(?P<name>[^:]+):\s*(?P<value>.*)$")
+
+
+def npz_filename(filename):
+    """ The columnar file that goes with a results CSV """
+    return os.path.splitext(filename)[0] + SUFFIX
+
+
+def read_csv_header(filename):
+    """ Returns the '#' header lines of a results CSV, without the comment character """
+    header = []
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header.append(line[1:].rstrip('\r\n'))
+    return header
+
+
+def parse_header(header):
+    """ Returns the procedure name and a {parameter name: value string} dict from header lines """
+    procedure = ''
+    parameters = {}
+    for line in header:
+        if line.startswith('Procedure:'):
+            procedure = line[len('Procedure:'):].strip().strip('<>')
+            continue
+        match = PARAMETER_REGEX.match(line)
+        if match:
+            parameters[match.group('name').strip()] = match.group('value').strip()
+    return procedure, parameters
+
+
+def write_npz(filename, data, header):
+    """
+    Writes a run to filename. data is a DataFrame (or dict of equal length columns) and
+    header the pymeasure header lines, with or without their leading '#'.
+    """
+    header = [line[1:] if line.startswith('#') else line for line in header]
+    columns = {str(c): np.asarray(data[c], dtype=float) for c in data}
+    if HEADER_KEY in columns:
+        raise ValueError("Column name %s is reserved" % HEADER_KEY)
+    columns[HEADER_KEY] = np.array('\n'.join(header))
+    with open(filename, 'wb') as f:
+        np.savez(f, **columns)
+    return filename
+
+
+def csv_to_npz(filename, npz=None):
+    """ Converts one results CSV, returning the name of the columnar file """
+    npz = npz or npz_filename(filename)
+    header = read_csv_header(filename)
+    data = pd.read_csv(filename, comment='#', dtype=float)
+    return write_npz(npz, data, header)
+
+
+def convert_archive(root, pattern='2019-*/*.csv', force=False):
+    """
+    Converts every results CSV under root matching pattern. Files whose columnar copy is
+    newer than the CSV are skipped unless force is set. Returns the converted filenames.
+    """
+    converted = []
+    for filename in sorted(glob.glob(os.path.join(root, pattern))):
+        npz = npz_filename(filename)
+        if not force and os.path.exists(npz) and os.path.getmtime(npz) >= os.path.getmtime(filename):
+            continue
+        try:
+            converted.append(csv_to_npz(filename, npz))
+        except (ValueError, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+            log.warning("Could not convert %s: %s" % (filename, e))
+    log.info("Converted %d results files under %s" % (len(converted), root))
+    return converted
+
+
+def save_results(results, filename=None):
+    """ Writes the columnar copy of a pymeasure Results object, e.g. when an experiment finishes """
+    filename = filename or npz_filename(results.data_filename)
+    return write_npz(filename, results.data, results.header().splitlines())
+
+
+class columnarResults(object):
+    """
+    Lazy reader for a columnar results file. Nothing is read from disk until a column
+    is indexed, and every column is read once:
+
+        run = columnarResults('2019-07-05/alignedLeftvp_..._1.npz')
+        run.parameters['Volts to magnet']
+        run['Zfield']
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._npz = np.load(filename, allow_pickle=False)
+        self._cache = {}
+        self.columns = [c for c in self._npz.files if c != HEADER_KEY]
+        self.header = str(self._npz[HEADER_KEY]).split('\n')
+        self.procedure, self.parameters = parse_header(self.header)
+
+    def __getitem__(self, column):
+        if column not in self._cache:
+            if column not in self.columns:
+                raise KeyError(column)
+            self._cache[column] = self._npz[column]
+        return self._cache[column]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __len__(self):
+        return len(self[self.columns[0]]) if self.columns else 0
+
+    def to_dataframe(self, columns=None):
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame({c: self[c] for c in columns}, columns=columns)
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_results(filename, columns=None):
+    """
+    Drop-in for pd.read_csv(filename, comment='#'): reads the columnar copy when it is
+    up to date, otherwise parses the CSV. Only the requested columns are read.
+    """
+    npz = npz_filename(filename)
+    if os.path.exists(npz) and (not os.path.exists(filename) or os.path.getmtime(npz) >= os.path.getmtime(filename)):
+        with columnarResults(npz) as run:
+            return run.to_dataframe(columns)
+    return pd.read_csv(filename, comment='#', usecols=columns)
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+    convert_archive(root, force='--force' in sys.argv)
@@ -0,0 +1,169 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import glob
+import os
+import re
+import numpy as np
+import pandas as pd
+from resultsStore import read_csv_header, parse_header
+
+# Short names of the procedures found in the archive, for querying by kind
+PROCEDURE_KINDS = {
+    'daedalusCenterCalibrationProcedure': 'center',
+    'daedalusFieldRasterProcedure': 'fieldRaster',
+    'daedalusRadialPoloarCalibrationProcedure': 'radialPolar',
+    'daedalusRadialVoltCalibrationProcedure': 'radialVolt',
+    'daedalusVoltCenterCalibrationProcedure': 'voltCenter',
+    'icarusCalibCheckProcedure': 'calibCheck',
+    'icarusCalibCheckFieldSweepProcedure': 'calibCheckFieldSweep',
+    'icarusFieldCentreProcedure': 'fieldCentre',
+    'icarusRadialPolarSweepProcedure': 'radialPolar',
+    'icarusCalibHealthCheckProcedure': 'healthCheck',
+    'icarusRadialPolarMultiVoltProcedure': 'radialPolarMultiVolt',
+    'radialPolarSplit': 'radialPolar',
+    'icarusVoltCenterSweepProcedure': 'voltCenter',
+}
+
+# Catalog columns filled from whichever of these parameters a procedure has
+NORMALISED_PARAMETERS = {
+    'name': ['Calibration Name', 'name', 'Sample Name'],
+    'volts': ['Volts to magnet', 'Magnet Voltage'],
+    'azimuth': ['Azimuthal Angle', 'Magnet Azimuthal Angle', 'Magnet Phi'],
+    'field': ['Magnetic field strength', 'Field Strength'],
+    'radius': ['Radial Distance'],
+    'step': ['Y position step', 'Magnet voltage step', 'stage X Scan Step Size', 'Phi Scan Step Size'],
+    'start': ['Start Y position', 'Start magnet voltage', 'stage X Start Position', 'Phi Start Position'],
+    'stop': ['Stop Y position', 'Stop magnet voltage', 'stage X End Position', 'Phi End Position'],
+}
+NUMERIC = ['volts', 'azimuth', 'field', 'radius', 'step', 'start', 'stop']
+COLUMNS = ['path', 'mtime', 'date', 'run', 'procedure', 'kind'] + list(NORMALISED_PARAMETERS)
+
+FILENAME_REGEX = re.compile(r"_(?P<date>\d{4}-\d{2}-\d{2})_(?P<run>\d+)\.csv$")
+NUMBER_REGEX = re.compile(r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+MTIME_TOLERANCE = 1e-3 # s, mtimes lose their last digits in the CSV index
+
+
+def parameter_value(value):
+    """ Leading number of a pymeasure parameter string such as '3 V' or '0.01 mm', else NaN """
+    match = NUMBER_REGEX.match(value)
+    return float(match.group(0)) if match else np.nan
+
+
+def index_run(root, path):
+    """ Returns the catalog row of one results file, path being relative to root """
+    procedure, parameters = parse_header(read_csv_header(os.path.join(root, path)))
+    procedure = procedure.split('.')[-1]
+    match = FILENAME_REGEX.search(path)
+    row = {
+        'path': path,
+        'mtime': os.path.getmtime(os.path.join(root, path)),
+        'date': match.group('date') if match else '',
+        'run': int(match.group('run')) if match else 0,
+        'procedure': procedure,
+        'kind': PROCEDURE_KINDS.get(procedure, procedure),
+    }
+    for column, names in NORMALISED_PARAMETERS.items():
+        value = next((parameters[n] for n in names if n in parameters), '')
+        row[column] = parameter_value(value) if column in NUMERIC else value
+    return row
+
+
+class runCatalog(object):
+    """
+    Index of every results file in the dated folders under root, keyed on the
+    '#Procedure' and '#Parameters' headers.
+
+    The index is kept in root/run_catalog.csv. update() only opens files that are new or
+    have changed since they were indexed, so after the first scan refreshing the catalog
+    costs one stat per file:
+
+        catalog = runCatalog('..')
+        catalog.find(kind='radialPolar', azimuth=0, volts=(1, 10))
+    """
+
+    def __init__(self, root, pattern='20??-??-??/*.csv', index_file='run_catalog.csv'):
+        self.root = root
+        self.pattern = pattern
+        self.index_file = os.path.join(root, index_file)
+        if os.path.exists(self.index_file):
+            self.runs = pd.read_csv(self.index_file, keep_default_na=False, na_values=[''],
+                                    dtype={'path': str, 'date': str, 'procedure': str, 'kind': str, 'name': str})
+            self.runs['name'] = self.runs['name'].fillna('')
+        else:
+            self.runs = pd.DataFrame(columns=COLUMNS)
+        self.update()
+
+    def update(self, save=True):
+        """ Indexes new and modified files and drops deleted ones, returning the number indexed """
+        paths = sorted(os.path.relpath(f, self.root).replace(os.sep, '/')
+                       for f in glob.glob(os.path.join(self.root, self.pattern)))
+        known = dict(zip(self.runs['path'], self.runs['mtime']))
+        stale = [p for p in paths if p not in known or
+                 os.path.getmtime(os.path.join(self.root, p)) > known[p] + MTIME_TOLERANCE]
+        keep = self.runs['path'].isin(set(paths) - set(stale))
+        rows = []
+        for path in stale:
+            try:
+                rows.append(index_run(self.root, path))
+            except (OSError, UnicodeDecodeError) as e:
+                log.warning("Could not index %s: %s" % (path, e))
+        changed = len(rows) > 0 or not keep.all()
+        if rows:
+            self.runs = pd.concat([self.runs[keep], pd.DataFrame(rows, columns=COLUMNS)], ignore_index=True)
+        else:
+            self.runs = self.runs[keep].reset_index(drop=True)
+        if changed:
+            log.info("Indexed %d results files, catalog has %d runs" % (len(rows), len(self.runs)))
+            if save:
+                self.save()
+        return len(rows)
+
+    def save(self):
+        self.runs.to_csv(self.index_file, index=False)
+
+    def find(self, kind=None, name=None, newest_first=True, **values):
+        """
+        Returns the matching catalog rows. kind and name match exactly (name may also be
+        a compiled regex); every other keyword is a catalog column matched either to a
+        value or to an inclusive (low, high) range, e.g. volts=(1, 10).
+        """
+        runs = self.runs
+        mask = np.ones(len(runs), dtype=bool)
+        if kind is not None:
+            mask &= runs['kind'] == kind
+        if name is not None:
+            if hasattr(name, 'search'):
+                mask &= runs['name'].map(lambda n: name.search(n) is not None)
+            else:
+                mask &= runs['name'] == name
+        for column, value in values.items():
+            column_values = runs[column].astype(float)
+            if isinstance(value, (tuple, list)):
+                mask &= (column_values >= value[0]) & (column_values <= value[1])
+            else:
+                mask &= np.isclose(column_values, value)
+        found = runs[np.asarray(mask, dtype=bool)]
+        return found.sort_values(['date', 'run'], ascending=not newest_first)
+
+    def paths(self, *args, **kwargs):
+        """ Full filenames of the runs matching find(*args, **kwargs) """
+        return [os.path.join(self.root, p) for p in self.find(*args, **kwargs)['path']]
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    args = [a for a in sys.argv[1:] if '=' not in a]
+    root = args[0] if args else os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+    query = {}
+    for arg in sys.argv[1:]:
+        if '=' in arg:
+            key, value = arg.split('=', 1)
+            if key in NUMERIC:
+                value = tuple(float(v) for v in value.split(':')) if ':' in value else float(value)
+            query[key] = value
+    catalog = runCatalog(root)
+    pd.set_option('display.width', 200)
+    print(catalog.find(**query)[['path', 'kind', 'name', 'volts', 'azimuth', 'field']].to_string(index=False))
@@ -0,0 +1,102 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+from fieldMath import bmag, field_phi, field_theta
+
+
+class runningStats(object):
+    """
+    Streaming mean and standard deviation of multi-channel samples (Welford), so the
+    averaging loops never store or re-reduce the samples.
+
+    Blocks of samples, e.g. from bufferedHallProbe, are merged in one step with Chan's
+    pairwise update. With track_extrema the per-channel min and max are kept too. With
+    reject_sigma set, a sample more than reject_sigma standard deviations from the
+    running mean on any channel is counted in rejected and left out; rejection starts
+    once min_samples samples have been accepted, and only on channels with a spread.
+    min_std floors the spread, e.g. at the reading resolution, so a few quantized
+    readings a step apart do not reject the next step.
+    """
+
+    def __init__(self, channels=3, track_extrema=False, reject_sigma=None, min_samples=5, min_std=0.):
+        self.count = 0
+        self.rejected = 0
+        self.mean = np.zeros(channels)
+        self._m2 = np.zeros(channels)
+        self.track_extrema = track_extrema
+        self.minimum = np.full(channels, np.inf)
+        self.maximum = np.full(channels, -np.inf)
+        self.reject_sigma = reject_sigma
+        self.min_samples = min_samples
+        self.min_std = min_std
+
+    @property
+    def variance(self):
+        """ Population variance, as np.var """
+        return self._m2/self.count if self.count else np.full(self.mean.shape, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def _outliers(self, samples):
+        if self.reject_sigma is None or self.count < self.min_samples:
+            return np.zeros(len(samples), dtype=bool)
+        std = np.maximum(self.std, self.min_std)
+        # a channel whose accepted samples are all equal (e.g. quantized readings) has no
+        # spread to judge against, so nothing is rejected on it until it has one
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.where(std > 0, np.abs(samples - self.mean)/std, 0.)
+        return np.any(z > self.reject_sigma, axis=1)
+
+    def add(self, sample):
+        """ Adds one sample, one value per channel """
+        sample = np.asarray(sample, dtype=float)
+        if self._outliers(sample[None, :])[0]:
+            self.rejected += 1
+            return
+        self.count += 1
+        delta = sample - self.mean
+        self.mean += delta/self.count
+        self._m2 += delta*(sample - self.mean)
+        if self.track_extrema:
+            np.minimum(self.minimum, sample, out=self.minimum)
+            np.maximum(self.maximum, sample, out=self.maximum)
+
+    def add_block(self, samples):
+        """ Adds an (N, channels) block of samples at once """
+        samples = np.asarray(samples, dtype=float)
+        outliers = self._outliers(samples)
+        if outliers.any():
+            self.rejected += int(outliers.sum())
+            samples = samples[~outliers]
+        n = len(samples)
+        if n == 0:
+            return
+        block_mean = samples.mean(axis=0)
+        block_m2 = np.sum((samples - block_mean)**2, axis=0)
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta*n/total
+        self._m2 = self._m2 + block_m2 + delta**2*self.count*n/total
+        self.count = total
+        if self.track_extrema:
+            np.minimum(self.minimum, samples.min(axis=0), out=self.minimum)
+            np.maximum(self.maximum, samples.max(axis=0), out=self.maximum)
+
+    def field_row(self):
+        """ Field averages, spreads, angles and magnitude of X, Y, Z samples as a results row """
+        (x, y, z), (sx, sy, sz) = self.mean, self.std
+        return {
+        "act_phi": field_phi(x, y),
+        "act_theta": field_theta(x, y, z),
+        "Xfield_avg": x,
+        "Xfield_std": sx,
+        "Yfield_avg": y,
+        "Yfield_std": sy,
+        "Zfield_avg": z,
+        "Zfield_std": sz,
+        "Bmag": bmag(x, y, z),
+        }
@@ -0,0 +1,136 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import hashlib
+import json
+import os
+from time import perf_counter, strftime
+import pandas as pd
+
+# Checkpoint of a long scan, kept next to its results as <results>_checkpoint.json.
+#
+# The procedure records each completed grid index and the instrument state at that
+# point (stage position, set field and voltage - values it already has, so no extra
+# instrument queries). Every CHECKPOINT_INTERVAL seconds, and at shutdown, the results
+# file is flushed and the checkpoint rewritten (atomically), so every index in the
+# checkpoint is in the file. The checkpoint also holds the procedure parameters and the
+# hashes of the calibration files the run depends on.
+#
+# Queueing an existing results file again resumes it: the procedure finds the
+# checkpoint, refuses to continue if the parameters or calibration changed, and skips
+# every point already in the file while the worker appends to it.
+
+CHECKPOINT_INTERVAL = 30. # s
+RUNNING, FINISHED, ABORTED, FAILED = 'running', 'finished', 'aborted', 'failed'
+
+
+def checkpoint_filename(data_filename):
+    return os.path.splitext(data_filename)[0] + '_checkpoint.json'
+
+
+def file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def repair_results(data_filename):
+    """ Cuts a results file back to its last complete line, returning the number of bytes removed """
+    with open(data_filename, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    return len(data) - end
+
+
+def read_results(data_filename):
+    """ The data rows of a pymeasure results file """
+    return pd.read_csv(data_filename, comment='#')
+
+
+class scanCheckpoint(object):
+    """ Completed grid indices, instrument state and calibration hashes of a run """
+
+    def __init__(self, data_filename, procedure, calibration, interval=CHECKPOINT_INTERVAL):
+        self.data_filename = data_filename
+        self.filename = checkpoint_filename(data_filename)
+        self.procedure = procedure.__class__.__name__
+        self.parameters = dict((k, str(v)) for k, v in procedure.parameter_values().items())
+        self.calibration = calibration
+        self.interval = interval
+        self.completed = []
+        self.state = {}
+        self.resumes = 0
+        self.last_save = perf_counter()
+
+    def load(self):
+        """ The saved checkpoint of the results file, or None """
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def check(self, previous):
+        """ Raises ValueError if the run cannot continue from the previous checkpoint """
+        if previous['procedure'] != self.procedure:
+            raise ValueError("Checkpoint %s is of a %s run, not %s" % (self.filename, previous['procedure'], self.procedure))
+        changed = sorted(k for k in self.parameters if previous['parameters'].get(k, self.parameters[k]) != self.parameters[k])
+        if changed:
+            raise ValueError("Parameters changed since the checkpoint: %s" % ', '.join(changed))
+        changed = sorted(k for k in self.calibration if previous['calibration'].get(k) != self.calibration[k])
+        if changed:
+            raise ValueError("Calibration changed since the checkpoint: %s" % ', '.join(changed))
+
+    def resume(self, index):
+        """
+        Prepares the results file for appending and returns the rows already in it, or None
+        for a new run. Checks the previous checkpoint, if any, first; index(rows) gives the
+        grid indices of the rows.
+        """
+        previous = self.load()
+        if previous is not None:
+            self.check(previous)
+            self.resumes = previous.get('resumes', 0) + 1
+            self.state = previous.get('state', {})
+        removed = repair_results(self.data_filename)
+        if removed:
+            log.warning("Removed %d bytes of an incomplete line from %s" % (removed, self.data_filename))
+        rows = read_results(self.data_filename)
+        if previous is None and len(rows) == 0:
+            return None
+        self.completed = index(rows)
+        if previous is None:
+            log.warning("No checkpoint for %s, continuing from its %d rows" % (self.data_filename, len(rows)))
+        else:
+            log.info("Resuming %s (%s at %s): %d points checkpointed, %d rows in the file, last state %s"
+                     % (self.data_filename, previous['status'], previous['updated'], len(previous['completed']),
+                        len(rows), previous.get('state')))
+        return rows
+
+    def add(self, index, state=None):
+        """ Records a completed grid index; returns True when a checkpoint is due """
+        self.completed.append(index)
+        if state:
+            self.state = state
+        return perf_counter() - self.last_save >= self.interval
+
+    def save(self, status=RUNNING):
+        """ Rewrites the checkpoint; flush the results file first """
+        checkpoint = {
+            'procedure': self.procedure,
+            'parameters': self.parameters,
+            'calibration': self.calibration,
+            'completed': self.completed,
+            'state': self.state,
+            'status': status,
+            'resumes': self.resumes,
+            'updated': strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(self.filename + '.tmp', self.filename)
+        self.last_save = perf_counter()
+        return self.filename
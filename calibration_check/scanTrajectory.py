@@ -0,0 +1,110 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+from collections import namedtuple
+import numpy as np
+
+# One point of a 2D scan. fast is the inner (row) axis and slow the outer axis, e.g.
+# phi and theta in the calibration checks or stage X and Y in a field raster. i_fast and
+# i_slow are the logical grid indices, so results can be reshaped whatever the order.
+scanPoint = namedtuple('scanPoint', ['fast', 'slow', 'i_fast', 'i_slow'])
+
+# Nominal axis speeds (units/s), accelerations (units/s^2) and per-move settle time (s)
+# used to compare orderings. Override them with the values of the stage in use.
+NOMINAL_SPEED = (10., 10.)
+NOMINAL_ACCELERATION = (40., 40.)
+NOMINAL_SETTLE = 0.1
+
+
+def grid_axis(start, end, step):
+    """ Axis points as the procedures have always built them """
+    return np.arange(start, end + step, step)
+
+
+def raster_order(n_fast, n_slow):
+    """ Row by row, every row in the same direction (flyback after each row) """
+    i_slow, i_fast = np.divmod(np.arange(n_fast*n_slow), n_fast)
+    return np.column_stack((i_fast, i_slow))
+
+
+def serpentine_order(n_fast, n_slow):
+    """ Boustrophedon: alternate rows are scanned in reverse so there is no flyback """
+    order = raster_order(n_fast, n_slow)
+    odd = order[:, 1] % 2 == 1
+    order[odd, 0] = n_fast - 1 - order[odd, 0]
+    return order
+
+
+def spiral_order(n_fast, n_slow):
+    """ Square rings outward from the grid centre, each ring walked by angle """
+    order = raster_order(n_fast, n_slow)
+    d_fast = order[:, 0] - (n_fast - 1)/2.
+    d_slow = order[:, 1] - (n_slow - 1)/2.
+    ring = np.maximum(np.abs(d_fast), np.abs(d_slow))
+    angle = np.mod(np.arctan2(d_slow, d_fast), 2*np.pi)
+    return order[np.lexsort((angle, ring))]
+
+
+def nearest_neighbour_order(n_fast, n_slow):
+    """ Greedy tour from the first grid point, always stepping to the closest unvisited point """
+    order = raster_order(n_fast, n_slow)
+    remaining = np.ones(len(order), dtype=bool)
+    tour = np.zeros(len(order), dtype=int)
+    current = 0
+    remaining[0] = False
+    for k in range(1, len(order)):
+        candidates = np.flatnonzero(remaining)
+        cost = np.sum((order[candidates] - order[current])**2, axis=1)
+        current = candidates[np.argmin(cost)]
+        remaining[current] = False
+        tour[k] = current
+    return order[tour]
+
+
+ORDERINGS = {
+    'raster': raster_order,
+    'serpentine': serpentine_order,
+    'spiral': spiral_order,
+    'nearest': nearest_neighbour_order,
+}
+
+
+def make_trajectory(fast, slow, ordering='raster'):
+    """ Returns the list of scanPoints over the fast x slow grid in the given ordering """
+    order = ORDERINGS[ordering](len(fast), len(slow))
+    return [scanPoint(float(fast[i]), float(slow[j]), int(i), int(j)) for i, j in order]
+
+
+def move_times(points, speed=NOMINAL_SPEED, acceleration=NOMINAL_ACCELERATION, settle=NOMINAL_SETTLE):
+    """
+    Time of every move between consecutive points using a trapezoidal velocity profile
+    per axis; the axes move together, so each move takes as long as its slowest axis.
+    """
+    coords = np.array([(p.fast, p.slow) for p in points], dtype=float)
+    dist = np.abs(np.diff(coords, axis=0))
+    return np.max(axis_move_time(dist, speed, acceleration), axis=1) + settle
+
+
+def axis_move_time(dist, speed, acceleration):
+    """ Time to move one axis by dist with a trapezoidal (or triangular) velocity profile """
+    dist = np.abs(dist)
+    speed = np.asarray(speed, dtype=float)
+    acceleration = np.asarray(acceleration, dtype=float)
+    ramp_dist = speed**2/acceleration
+    return np.where(dist < ramp_dist, 2*np.sqrt(dist/acceleration), dist/speed + speed/acceleration)
+
+
+def travel_time(points, **kwargs):
+    """ Total estimated motion time of a trajectory in seconds """
+    if len(points) < 2:
+        return 0.
+    return float(np.sum(move_times(points, **kwargs)))
+
+
+def compare_orderings(fast, slow, **kwargs):
+    """ Estimated travel time of every ordering, for choosing one before queueing a run """
+    times = {}
+    for ordering in ORDERINGS:
+        times[ordering] = travel_time(make_trajectory(fast, slow, ordering), **kwargs)
+    return times
@@ -0,0 +1,429 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import glob
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from resultsStore import load_results, read_csv_header, parse_header
+from runCatalog import NORMALISED_PARAMETERS, parameter_value
+from rasterLoader import load_raster
+from fieldMath import load_probe_zero
+from calibrationTable import calibrationTable
+from scanTrajectory import axis_move_time
+
+# Hardware-free stand-ins for the Icarus instruments: the Senis Hall probe, the
+# daedalusProjField magnet with its ESP300 stage, the buffered probe read and the
+# magnet voltage DAQ tasks, with the same attributes the procedures use.
+#
+# All instruments share one simulatedRig, the state of the physical setup: stage and
+# magnet rotation positions, the magnet voltage and the field model. The field at the
+# probe is interpolated from archived radialPolar scans (field against R at each magnet
+# voltage) and scaled off axis by an archived field raster. Moves take the time of a
+# trapezoidal velocity profile plus a settle time, and every GPIB query and DAQ read
+# sleeps for its latency, so procedures run at rig-like speed. Select the simulation
+# for the procedures with ICARUS_INSTRUMENTS=simulated (see instruments.py) and tune
+# it with configure().
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+RADIAL_FILES = os.path.join(ROOT, '2019-06-30', '*_daedalus_radialPolar_calib_A000.0_*.csv')
+RASTER_FILE = os.path.join(ROOT, '2019-06-27', 'test_fieldRaster_2019-06-27_12.csv')
+CENTRE_FILE = os.path.join(ROOT, 'icarusCalibCsv', 'icarus_center_calib.csv')
+
+SIMULATION_DEFAULTS = {
+    'stage_speed': 2.,          # mm/s
+    'stage_acceleration': 10.,  # mm/s^2
+    'phi_speed': 10.,           # deg/s
+    'phi_acceleration': 40.,    # deg/s^2
+    'settle': 0.05,             # s after every move
+    'gpib_latency': 0.01,       # s per ESP300 / magnet query
+    'daq_latency': 0.002,       # s per scalar DAQ read or write
+    'noise': 2e-5,              # T rms per probe read
+    'volts_noise': 1e-3,        # V rms on the voltage readback
+    'volts_offset': 1.5e-3,     # V, readback at 0 V command
+    'volts_gain': 0.9995,       # readback/command
+    'volts_cubic': 2e-6,        # V/V^3 nonlinearity of the readback
+    'volts_tau': 2e-3,          # s, settling time constant of the voltage path
+    'seed': None,
+}
+
+
+def bilinear(xs, ys, values, x, y):
+    """ Bilinear interpolation of values[iy, ix] at (x, y), clamped to the grid """
+    x = np.clip(x, xs[0], xs[-1])
+    y = np.clip(y, ys[0], ys[-1])
+    i = min(max(np.searchsorted(xs, x) - 1, 0), len(xs) - 2)
+    j = min(max(np.searchsorted(ys, y) - 1, 0), len(ys) - 2)
+    tx = (x - xs[i])/(xs[i + 1] - xs[i])
+    ty = (y - ys[j])/(ys[j + 1] - ys[j])
+    return ((1 - tx)*(1 - ty)*values[j, i] + tx*(1 - ty)*values[j, i + 1] +
+            (1 - tx)*ty*values[j + 1, i] + tx*ty*values[j + 1, i + 1])
+
+
+class fieldModel(object):
+    """
+    Zeroed X, Y, Z field at a probe offset (dx, dy) from the magnet centre, for a magnet
+    voltage and rotation.
+
+    The field along R = dy is interpolated linearly between the radialPolar scans of the
+    bracketing voltages (zero field at 0 V, clamped beyond the largest scan), then scaled
+    by |B(dx, dy)|/|B(0, dy)| of the raster, and its in-plane part rotated by the magnet
+    phi.
+    """
+
+    def __init__(self, radial_files=RADIAL_FILES, raster_file=RASTER_FILE, centre=None, zero=None,
+                 radial_step=0.1):
+        self.zero = load_probe_zero() if zero is None else zero
+        self.radius = np.arange(-15., 15. + radial_step/2, radial_step)
+        scans = {}
+        for filename in sorted(glob.glob(radial_files)):
+            procedure, parameters = parse_header(read_csv_header(filename))
+            volts = next(parameter_value(parameters[n]) for n in NORMALISED_PARAMETERS['volts'] if n in parameters)
+            scan = load_results(filename).sort_values('R')
+            fields = (scan.Xfield.values, scan.Yfield.values, scan.Zfield.values) # recorded zeroed
+            scans[volts] = np.column_stack([np.interp(self.radius, scan.R.values, f) for f in fields])
+        if not scans:
+            raise ValueError("No radialPolar scans match %s" % radial_files)
+        scans[0.] = np.zeros((self.radius.size, 3))
+        self.volts = np.array(sorted(scans))
+        self.fields = np.array([scans[v] for v in self.volts])
+        log.info("Field model from %d radialPolar scans, %g to %g V" % (len(self.volts) - 1, self.volts[0], self.volts[-1]))
+
+        self.raster = None
+        if raster_file is not None:
+            raster = load_raster(raster_file)
+            x0, y0, z0 = self.zero
+            b = np.sqrt((raster.Xfield_avg.values - x0)**2 + (raster.Yfield_avg.values - y0)**2 +
+                        (raster.Zfield_avg.values - z0)**2)
+            xs, ys = raster.Xcoord.values, raster.Ycoord.values
+            centre = np.loadtxt(CENTRE_FILE, delimiter=',').reshape(2) if centre is None else centre
+            on_axis = np.array([np.interp(centre[0], xs, row) for row in b])
+            self.raster = (xs - centre[0], ys - centre[1], b/on_axis[:, None])
+
+    def field(self, dx, dy, volts, phi):
+        volts = np.clip(volts, self.volts[0], self.volts[-1])
+        k = min(max(np.searchsorted(self.volts, volts) - 1, 0), len(self.volts) - 2)
+        t = (volts - self.volts[k])/(self.volts[k + 1] - self.volts[k])
+        below = [np.interp(dy, self.radius, self.fields[k, :, c]) for c in range(3)]
+        above = [np.interp(dy, self.radius, self.fields[k + 1, :, c]) for c in range(3)]
+        bx, by, bz = (1 - t)*np.array(below) + t*np.array(above)
+        if self.raster is not None:
+            scale = bilinear(self.raster[0], self.raster[1], self.raster[2], dx, dy)
+            bx, by, bz = scale*bx, scale*by, scale*bz
+        c, s = np.cos(np.radians(phi)), np.sin(np.radians(phi))
+        return np.array([bx*c + by*s, by*c - bx*s, bz])
+
+
+class simulatedAxis(object):
+    """ One ESP300 axis; setting position starts a move that completes in real time """
+
+    def __init__(self, rig, name, position, speed, acceleration):
+        self.rig = rig
+        self.name = name
+        self.speed = speed
+        self.acceleration = acceleration
+        self._start = self._target = position
+        self._t0 = self._t1 = 0.
+
+    def current(self, now=None):
+        now = time.time() if now is None else now
+        if now >= self._t1:
+            return self._target
+        # constant speed is close enough for the position read back mid-move
+        return self._start + (self._target - self._start)*(now - self._t0)/(self._t1 - self._t0)
+
+    @property
+    def moving(self):
+        return time.time() < self._t1 + self.rig.settings['settle']
+
+    @property
+    def position(self):
+        self.rig.query()
+        return self.current()
+
+    @position.setter
+    def position(self, target):
+        self.rig.query()
+        now = time.time()
+        start = self.current(now)
+        self._start, self._target = start, float(target)
+        self._t0 = now
+        self._t1 = now + float(axis_move_time(target - start, self.speed, self.acceleration))
+
+
+class simulatedConnection(object):
+    timeout = 2000.
+
+
+class simulatedAdapter(object):
+    """ Stands in for DAQmxAdapter and the GPIB adapter of the motion controller """
+
+    def __init__(self, resource_name='Dev2', channels=()):
+        self.resource_name = resource_name
+        self.channels = channels
+        self.connection = simulatedConnection()
+
+
+class simulatedMotionController(object):
+    def __init__(self, rig):
+        self.rig = rig
+        self.adapter = simulatedAdapter('GPIB::1')
+        self.x, self.y, self.phi = rig.x, rig.y, rig.phi
+
+    def write(self, command):
+        """ Only the wait-for-stop commands ('1WS;2WS;3WS') are simulated """
+        self.rig.query()
+        if 'WS' in command:
+            while self.rig.in_motion:
+                time.sleep(0.001)
+
+
+class simulatedRig(object):
+    """ Shared state of the simulated stage, magnet and probe """
+
+    def __init__(self, model=None, centre=None, **settings):
+        self.settings = dict(SIMULATION_DEFAULTS)
+        self.settings.update(settings)
+        self.centre = np.loadtxt(CENTRE_FILE, delimiter=',').reshape(2) if centre is None else np.asarray(centre)
+        self._model = model
+        self.random = np.random.RandomState(self.settings['seed'])
+        self.lock = threading.Lock()
+        s = self.settings
+        self.x = simulatedAxis(self, 'x', self.centre[0], s['stage_speed'], s['stage_acceleration'])
+        self.y = simulatedAxis(self, 'y', self.centre[1], s['stage_speed'], s['stage_acceleration'])
+        self.phi = simulatedAxis(self, 'phi', 0., s['phi_speed'], s['phi_acceleration'])
+        self.volts = 0.
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = fieldModel(centre=self.centre)
+        return self._model
+
+    @property
+    def in_motion(self):
+        return any(axis.moving for axis in (self.x, self.y, self.phi))
+
+    def query(self):
+        time.sleep(self.settings['gpib_latency'])
+
+    def daq_wait(self):
+        time.sleep(self.settings['daq_latency'])
+
+    def readback_volts(self, volts):
+        """ Settled magnet voltage readback of a command, without noise """
+        s = self.settings
+        return s['volts_offset'] + s['volts_gain']*volts + s['volts_cubic']*np.power(volts, 3)
+
+    def probe_reading(self, num_samples=None):
+        """ Raw probe X, Y, Z readings (tesla, zero offsets and Z sign as the real probe) """
+        now = time.time()
+        b = self.model.field(self.x.current(now) - self.centre[0], self.y.current(now) - self.centre[1],
+                             self.volts, self.phi.current(now))
+        shape = (3,) if num_samples is None else (num_samples, 3)
+        with self.lock:
+            noise = self.random.normal(0., self.settings['noise'], shape)
+        x0, y0, z0 = self.model.zero
+        return np.array([b[0] + x0, b[1] + y0, z0 - b[2]]) + noise
+
+
+_rig = None
+
+
+def get_rig():
+    global _rig
+    if _rig is None:
+        _rig = simulatedRig()
+    return _rig
+
+
+def configure(model=None, centre=None, **settings):
+    """ Replaces the shared rig, e.g. configure(stage_speed=5., noise=0.) """
+    global _rig
+    unknown = set(settings) - set(SIMULATION_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown simulation settings: %s" % ', '.join(sorted(unknown)))
+    _rig = simulatedRig(model, centre, **settings)
+    return _rig
+
+
+class simulatedHallProbe(object):
+    """ senis3AxHallProbe: one DAQ read per field component """
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.rig = get_rig()
+
+    def _read(self, axis):
+        self.rig.daq_wait()
+        return float(self.rig.probe_reading()[axis])
+
+    @property
+    def x_field(self):
+        return self._read(0)
+
+    @property
+    def y_field(self):
+        return self._read(1)
+
+    @property
+    def z_field(self):
+        return self._read(2)
+
+
+class simulatedProjField(object):
+    """ daedalusProjField: magnet voltage, rotation and stage, driven by the calibration """
+
+    def __init__(self, adapter, address=None):
+        self.adapter = adapter
+        self.rig = get_rig()
+        self.motion_inst = simulatedMotionController(self.rig)
+        self._errors = []
+        self._phi = 0.
+        self.table = None
+        self.calib_centre = self.rig.centre
+
+    @property
+    def errors(self):
+        self.rig.query()
+        errors, self._errors = self._errors, []
+        return errors
+
+    @property
+    def in_motion(self):
+        self.rig.query()
+        return self.rig.in_motion
+
+    def load_calibration_params(self, calib_name):
+        self.table = calibrationTable(calib_name)
+        centre_file = calib_name + '_center_calib.csv'
+        if os.path.exists(centre_file):
+            self.calib_centre = np.loadtxt(centre_file, delimiter=',').reshape(2)
+
+    def setVolts(self, volts):
+        self.rig.daq_wait()
+        self.rig.volts = float(volts)
+
+    @property
+    def volts(self):
+        return self.rig.volts
+
+    @volts.setter
+    def volts(self, volts):
+        self.setVolts(volts)
+
+    voltage = volts
+
+    @property
+    def setvolts(self):
+        return self.rig.volts
+
+    set_volts = setvolts
+
+    @property
+    def phi(self):
+        return self._phi
+
+    @phi.setter
+    def phi(self, phi):
+        self.motion_inst.phi.position = phi
+        self._phi = phi
+
+    def set_vector_field(self, B, phi, theta):
+        targets = self.table.invert(B, phi, theta)
+        if not targets.valid:
+            self._errors.append("Field %g T at phi %g, theta %g is outside the calibration" % (B, phi, theta))
+            return
+        self.setVolts(float(targets.volts))
+        self.phi = phi
+        self.motion_inst.x.position = self.calib_centre[0]
+        self.motion_inst.y.position = self.calib_centre[1] + float(targets.R)
+
+
+class simulatedBufferedHallProbe(object):
+    """ bufferedHallProbe: a block of num_samples reads taking num_samples/sample_rate """
+
+    def __init__(self, adapter, sample_rate=1000., num_samples=100, volt_range=10.0):
+        self.rig = get_rig()
+        self.sample_rate = sample_rate
+        self.num_samples = num_samples
+        self.scale = np.ones(3)
+
+    def set_timing(self, sample_rate, num_samples):
+        self.sample_rate = sample_rate
+        self.num_samples = max(int(num_samples), 1)
+
+    @property
+    def window(self):
+        return self.num_samples / self.sample_rate
+
+    def acquire(self):
+        self.rig.daq_wait()
+        time.sleep(self.window)
+        return self.rig.probe_reading(self.num_samples)
+
+    def calibrate_scale(self, hall_probe, num_reads=5):
+        return self.scale
+
+    def close(self):
+        pass
+
+
+class simulatedTaskPool(object):
+    """ daqTaskPool: magnet voltage write and readback """
+
+    def __init__(self, adapter, ao=True, ai=True, commit_read=False, volt_range=10.0, timeout=10.0, correction=None):
+        self.rig = get_rig()
+        self.correction = correction
+
+    def write(self, volts):
+        if self.correction is not None:
+            volts = float(self.correction.command(volts))
+        self.rig.daq_wait()
+        self.rig.volts = float(volts)
+
+    def read(self):
+        self.rig.daq_wait()
+        with self.rig.lock:
+            noise = self.rig.random.normal(0., self.rig.settings['volts_noise'])
+        return self.rig.readback_volts(self.rig.volts) + noise
+
+    @contextmanager
+    def output_released(self):
+        yield
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class simulatedRampTask(object):
+    """ daqRampTask: the readback of a waveform through the first order lag of the voltage path """
+
+    def __init__(self, adapter, sample_rate=5000., volt_range=10.0, timeout=10.0):
+        self.rig = get_rig()
+        self.sample_rate = sample_rate
+        self.volt_range = volt_range
+
+    def run(self, waveform):
+        waveform = np.clip(np.asarray(waveform, dtype=float), -self.volt_range, self.volt_range)
+        settled = self.rig.readback_volts(np.concatenate(([self.rig.volts], waveform[:-1])))
+        decay = np.exp(-1./(self.sample_rate*self.rig.settings['volts_tau']))
+        readback = np.zeros(waveform.size)
+        level = self.rig.readback_volts(self.rig.volts)
+        for k, target in enumerate(settled): # sample k sees update k - 1 settling
+            readback[k] = level
+            level = target + (level - target)*decay
+        time.sleep(waveform.size/self.sample_rate)
+        self.rig.volts = float(waveform[-1])
+        with self.rig.lock:
+            noise = self.rig.random.normal(0., self.rig.settings['volts_noise'], waveform.size)
+        return readback + noise
@@ -0,0 +1,175 @@
+import logging
+from time import sleep, time
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import numpy as np
+from pymeasure.experiment import FloatParameter, IntegerParameter, Parameter
+from pymeasure.experiment import Procedure
+from instruments import DAQmxAdapter, senis3AxHallProbe, connect_magnet
+from adaptiveSweep import adaptiveSweep, fitSpec
+from calibFit import VOLT_CENTER_DEGREE
+from fieldMath import load_probe_zero, zeroed
+from runningStats import runningStats
+from phaseTimer import phaseTimer, save_timing
+from liveResults import forward_results
+
+from pymeasure.display.windows import ManagedWindow
+from livePlot import livePlotWindow
+from pymeasure.experiment import Results, unique_filename
+import sys
+from pymeasure.display.Qt import QtGui
+
+
+class icarusVoltCenterSweepProcedure(Procedure):
+    """
+    Centre field against magnet voltage, fitted as it is measured.
+
+    With the probe at the magnet centre the voltage is swept coarsely first, then refined
+    around 0 V and wherever Yfield bends, refitting the voltage against the centre Yfield
+    (Yfield > 0 for vn, Yfield < 0 for vp, as in calibFit) after every pass until the
+    fits converge. Rows are recorded in the columns of the original voltCenter files.
+    """
+
+    # control parameters
+    name = Parameter("Calibration Name", default='')
+    center_file = Parameter("Center Calibration File", default='./icarus_center_calib.csv')
+    num_averages = IntegerParameter("Number of Averages", default=3)
+    delay = FloatParameter("Delay between averages", units="s", default=.1)
+
+    v_start = FloatParameter("Start magnet voltage", units="V", default=-10.)
+    v_stop = FloatParameter("Stop magnet voltage", units="V", default=10.)
+    coarse_step = FloatParameter("Coarse magnet voltage step", units="V", default=1.)
+    v_step = FloatParameter("Magnet voltage step", units="V", default=0.1)
+    dense_width = FloatParameter("Dense region width", units="V", default=0.5)
+    field_tolerance = FloatParameter("Field interpolation tolerance", units="T", default=2e-4)
+    fit_tolerance = FloatParameter("Fit convergence tolerance", default=2e-3)
+
+    DATA_COLUMNS = ["V", "Xfield", "Yfield", "Zfield", "elapsed_time", "pass"]
+
+    def startup(self):
+        self.timer = phaseTimer()
+        self.live = forward_results(self)
+        log.info("Connecting and configuring the instruments")
+        with self.timer('connect'):
+            self.hall_probe = senis3AxHallProbe(DAQmxAdapter('Dev2', ['ai0','ai2','ai4']))
+            self.magnet = connect_magnet()
+            self.volt_tasks = self.magnet.tasks
+        self.zero = load_probe_zero()
+        x_centre, y_centre = np.loadtxt(self.center_file, delimiter=',').reshape(2)
+        log.info("Moving the probe to the magnet centre (%g, %g)"%(x_centre, y_centre))
+        with self.timer('move'):
+            self.magnet.motion_inst.x.position = x_centre
+            self.magnet.motion_inst.y.position = y_centre
+        with self.timer('in_motion'):
+            while self.magnet.in_motion:
+                sleep(0.05)
+        self.start_time = time()
+
+    def measure(self, V):
+        with self.timer('set_volts'):
+            self.magnet.setVolts(V)
+        fields = runningStats()
+        for j in range(self.num_averages):
+            with self.timer('delay'):
+                sleep(self.delay)
+            with self.timer('probe'):
+                fields.add(zeroed(self.hall_probe.x_field, self.hall_probe.y_field, self.hall_probe.z_field, self.zero))
+        x, y, z = fields.mean
+        return {
+            "V": V,
+            "Xfield": x,
+            "Yfield": y,
+            "Zfield": z,
+            "elapsed_time": time() - self.start_time,
+        }
+
+    def make_sweep(self):
+        fits = [fitSpec('vn', 'Yfield', 'V', VOLT_CENTER_DEGREE, 'V', -np.inf, -1e-9),
+                fitSpec('vp', 'Yfield', 'V', VOLT_CENTER_DEGREE, 'V', 1e-9, np.inf)]
+        w = self.dense_width
+        return adaptiveSweep(self.v_start, self.v_stop, self.coarse_step, self.v_step, fits,
+                             {'Yfield': self.field_tolerance}, self.fit_tolerance,
+                             [(-w, w)], key_points=[0.])
+
+    def execute(self):
+        sweep = self.make_sweep()
+        full_points = int(round(abs(self.v_stop - self.v_start)/self.v_step)) + 1
+        while not sweep.done:
+            points = sweep.next_pass()
+            log.info("Pass %d: measuring %d points"%(sweep.passes + 1, len(points)))
+            for V in points:
+                self.timer.next_point(V)
+                row = self.measure(V)
+                sweep.add(V, row)
+                row["pass"] = sweep.passes + 1
+                with self.timer('emit'):
+                    self.emit("results", row)
+                self.emit('progress', int(100*min(len(sweep.rows)/float(full_points), 1.)))
+                if self.should_stop():
+                    log.warning("Caught stop flag in procedure")
+                    return
+            with self.timer('fit'):
+                sweep.finish_pass(points)
+        log.info("Measured %d of %d fixed-step points"%(len(sweep.rows), full_points))
+
+    def shutdown(self):
+        log.info("Done with voltage sweep. Shutting down instruments")
+        self.timer.next_point('shutdown')
+        self.live.flush()
+        with self.timer('shutdown'):
+            self.magnet.voltage = 0.
+            self.volt_tasks.close()
+
+
+class icarusVoltCenterSweepGUI(livePlotWindow, ManagedWindow):
+        def __init__(self):
+            super().__init__(
+                procedure_class=icarusVoltCenterSweepProcedure,
+                inputs=[
+                    'name',
+                    'center_file',
+                    'num_averages',
+                    'delay',
+                    'v_start',
+                    'v_stop',
+                    'coarse_step',
+                    'v_step',
+                    'dense_width',
+                    'field_tolerance',
+                    'fit_tolerance'
+                    ],
+                displays=[
+                    'coarse_step',
+                    'v_step',
+                    'fit_tolerance'
+                    ],
+                x_axis='V',
+                y_axis='Yfield',
+                directory_input=True
+            )
+            self.setWindowTitle('Icarus Volt Center Sweep GUI')
+            self.directory = r'C:\Users\TopMob\icarus_calib'
+
+        def queue(self):
+            procedure = self.make_procedure()
+            fname = unique_filename(
+                self.directory,
+                dated_folder=True,
+                prefix=procedure.name + '_daedalus_voltCenter_calib_',
+                suffix=''
+            )
+            results = Results(procedure, fname)
+            experiment = self.new_experiment(results)
+            self.manager.queue(experiment)
+
+        def finished(self, experiment):
+            """ Writes the phase timings once the run has finished """
+            super().finished(experiment)
+            log.info("Saved phase timings to %s" % save_timing(experiment))
+
+if __name__ == "__main__":
+    app = QtGui.QApplication(sys.argv)
+    window = icarusVoltCenterSweepGUI()
+    window.show()
+    sys.exit(app.exec_())
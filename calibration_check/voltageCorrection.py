@@ -0,0 +1,174 @@
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# Characterization of the magnet voltage path (ao0 command -> ai1 readback, the V and
+# act_V of the calibration checks) from one hardware-timed ramp (daqRampTask), and the
+# correction table made from it.
+#
+# The ramp waveform steps from 0 V to the bottom of the range, ramps linearly to the
+# top, holds, ramps back down and steps back to 0 V, holding after every step:
+#
+#   step_down | up | top | down | step_back
+#
+# The readback of a linear ramp lags the command by the settling time constant tau, so
+# the up and down ramps have offsets of opposite sign; their mean at each command
+# voltage is the static transfer act_V(V), and their difference gives tau. A straight
+# line fitted to act_V(V) gives the offset and gain, what is left the nonlinearity. The
+# steps give the settling time directly: how long the readback takes to stay within a
+# tolerance of its final value.
+#
+# The table of act_V against V is saved as a results-style CSV (fit summary in '#'
+# header lines). voltageCorrection interpolates it both ways: actual() is the readback
+# expected for a command and command() the command giving a wanted readback. The
+# procedures connect the magnet with instruments.connect_magnet(), whose daqTaskPool
+# applies command() to every write, so the magnet voltage V they set is the readback
+# they ask for and act_V reads back V without the offset and gain of the path.
+
+VOLT_CORRECTION_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'daq_volt_correction.csv')
+SEGMENTS = ['step_down', 'up', 'top', 'down', 'step_back']
+
+rampCharacterization = namedtuple('rampCharacterization',
+                                  ['offset', 'gain', 'nonlinearity', 'nonlinearity_rms', 'lag_tau', 'settle_time',
+                                   'settle_tau', 'noise', 'table'])
+
+
+def ramp_waveform(v_min=-10., v_max=10., ramp_samples=5000, hold_samples=2500):
+    """ The characterization waveform and the index slices of its segments """
+    parts = [np.full(hold_samples, v_min), np.linspace(v_min, v_max, ramp_samples), np.full(hold_samples, v_max),
+             np.linspace(v_max, v_min, ramp_samples), np.full(hold_samples, 0.)]
+    bounds = np.cumsum([0] + [len(p) for p in parts])
+    segments = dict((name, slice(bounds[i], bounds[i + 1])) for i, name in enumerate(SEGMENTS))
+    return np.concatenate(parts), segments
+
+
+def paired(command, readback, segment, lag=1):
+    """ Commands of a segment with the readback samples that see them, lag samples later """
+    index = np.arange(segment.start, min(segment.stop, len(readback) - lag))
+    return command[index], readback[index + lag]
+
+
+def binned(v, y, grid):
+    """
+    y at the grid points from the samples in bins of v centred on them, NaN in empty
+    bins. The bins average y - v, so samples off the bin centre (or a half-filled bin at
+    the end of the range) do not shift the result.
+    """
+    step = grid[1] - grid[0]
+    bins = np.clip(np.round((v - grid[0])/step).astype(int), 0, len(grid) - 1)
+    counts = np.bincount(bins, minlength=len(grid))
+    sums = np.bincount(bins, weights=y - v, minlength=len(grid))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, grid + sums/counts, np.nan)
+
+
+def step_settling(readback, segment, before, sample_rate, tolerance, lag=1):
+    """
+    Settling time (s) of the step at the start of a hold segment from the level before,
+    to within tolerance (a fraction of the step), and the time constant of its
+    exponential part. The final level is the mean of the last fifth of the hold.
+    """
+    y = readback[segment.start + lag:segment.stop]
+    final = y[-max(len(y)//5, 1):].mean()
+    step = final - before
+    if abs(step) < 1e-6 or len(y) < 10:
+        return np.nan, np.nan
+    error = (y - final)/step
+    outside = np.flatnonzero(np.abs(error) > tolerance)
+    settle = (outside[-1] + 1 + lag)/sample_rate if outside.size else lag/sample_rate
+    fit = np.flatnonzero((np.abs(error) > 2*tolerance) & (np.abs(error) < 0.8))
+    tau = np.nan
+    if fit.size >= 3:
+        slope = np.polyfit(fit/sample_rate, np.log(np.abs(error[fit])), 1)[0]
+        tau = -1./slope if slope < 0 else np.nan
+    return settle, tau
+
+
+def characterize(command, readback, segments, sample_rate, table_step=0.05, tolerance=1e-3, lag=1):
+    """ Fits offset, gain, nonlinearity and settling of a ramp run, with its act_V(V) table """
+    hold = readback[segments['top'].start + lag:segments['top'].stop]
+    noise = hold[len(hold)//2:].std()
+    # the first sample reads the output before the waveform starts, the level the run started from
+    settle = [step_settling(readback, segments[name], before, sample_rate, tolerance, lag)
+              for name, before in (('step_down', readback[0]), ('step_back', hold[-len(hold)//5:].mean()))]
+    settle_time = np.nanmax([s for s, t in settle])
+
+    # leave out the start of each ramp, where the lag is still building up from a hold
+    skip = int(np.ceil(settle_time*sample_rate)) if np.isfinite(settle_time) else 0
+    ramps = [slice(segments[name].start + skip, segments[name].stop) for name in ('up', 'down')]
+    v_min, v_max = command[segments['up']][[0, -1]]
+    grid = np.arange(v_min, v_max + table_step/2, table_step)
+    act_up, act_down = [binned(*paired(command, readback, ramp, lag) + (grid,)) for ramp in ramps]
+    # a linear ramp at rate r read through a lag tau: the up ramp reads g*r*tau low, the down ramp as much high
+    shift = 0.5*np.nanmean(act_down - act_up)
+    act = np.where(np.isnan(act_up), act_down - shift, np.where(np.isnan(act_down), act_up + shift, 0.5*(act_up + act_down)))
+    valid = np.isfinite(act)
+    gain, offset = np.polyfit(grid[valid], act[valid], 1)
+    residual = act - (offset + gain*grid)
+    rate = (v_max - v_min)*sample_rate/(segments['up'].stop - segments['up'].start - 1)
+    lag_tau = shift/(gain*rate)
+    table = pd.DataFrame({'set_V': grid, 'act_V': act, 'act_up': act_up, 'act_down': act_down,
+                          'nonlinearity': residual})[valid]
+    return rampCharacterization(offset, gain, float(np.nanmax(np.abs(residual))), float(np.sqrt(np.nanmean(residual**2))),
+                                lag_tau, settle_time, np.nanmean([t for s, t in settle]), noise, table)
+
+
+def format_characterization(result):
+    return ("offset %.4g V, gain %.6f, nonlinearity %.3g V max (%.3g V rms), lag tau %.3g s, "
+            "settling %.3g s (tau %.3g s), noise %.3g V rms"
+            % (result.offset, result.gain, result.nonlinearity, result.nonlinearity_rms, result.lag_tau,
+               result.settle_time, result.settle_tau, result.noise))
+
+
+def save_correction(result, filename=VOLT_CORRECTION_FILE, source=''):
+    """ Writes the act_V(V) table with the fit summary in its header """
+    summary = [('Offset', result.offset, 'V'), ('Gain', result.gain, ''), ('Nonlinearity', result.nonlinearity, 'V'),
+               ('Nonlinearity rms', result.nonlinearity_rms, 'V'), ('Lag time constant', result.lag_tau, 's'),
+               ('Settling time', result.settle_time, 's'), ('Settling time constant', result.settle_tau, 's'),
+               ('Noise', result.noise, 'V')]
+    with open(filename, 'w', newline='') as f:
+        f.write('#Voltage path characterization%s\n' % (': %s' % source if source else ''))
+        f.write(''.join('#\t%s: %.6g %s\n' % line for line in summary))
+        result.table.to_csv(f, index=False)
+    log.info("Saved voltage correction table to %s" % filename)
+    return filename
+
+
+class voltageCorrection(object):
+    """ Expected readback of a command voltage and the command for a wanted readback, from a correction table """
+
+    def __init__(self, filename=VOLT_CORRECTION_FILE):
+        self.filename = filename
+        table = pd.read_csv(filename, comment='#').dropna(subset=['act_V'])
+        self.set_v = table.set_V.values
+        self.act_v = table.act_V.values
+        if np.any(np.diff(self.act_v) <= 0):
+            raise ValueError("Voltage correction %s is not monotonic" % filename)
+
+    def actual(self, volts):
+        return extrapolated_interp(volts, self.set_v, self.act_v)
+
+    def command(self, volts):
+        return extrapolated_interp(volts, self.act_v, self.set_v)
+
+
+def extrapolated_interp(x, xp, fp):
+    """ np.interp continued beyond the table along its end segments """
+    x = np.asarray(x, dtype=float)
+    y = np.interp(x, xp, fp)
+    low, high = x < xp[0], x > xp[-1]
+    y = np.where(low, fp[0] + (x - xp[0])*(fp[1] - fp[0])/(xp[1] - xp[0]), y)
+    return np.where(high, fp[-1] + (x - xp[-1])*(fp[-1] - fp[-2])/(xp[-1] - xp[-2]), y)
+
+
+def load_volt_correction(filename=VOLT_CORRECTION_FILE):
+    """ The voltage correction of the station, or None if it has not been characterized """
+    if not os.path.exists(filename):
+        return None
+    log.info("Correcting magnet voltage writes with %s" % filename)
+    return voltageCorrection(filename)
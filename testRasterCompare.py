@@ -0,0 +1,43 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibration_check'))
+from rasterCompare import stack_rasters, centre_objectives, extremum_centres
+
+# Regression checks of rasterCompare on archived rasters of each kind: calibration check
+# rasters are stored zeroed and must come out of the stack as recorded, fieldRaster ones
+# are raw and are zeroed as in the notebooks (Zfield_avg - z_zero) only when asked.
+
+root = os.path.dirname(os.path.realpath(__file__))
+NOTEBOOK_ZERO = (0.0437063, 0.0434812, -0.0437816)
+CALIB_CHECK = os.path.join(root, '2019-07-02', 'test_calibCheck_F0.050_2019-07-02_1.csv')
+PHI0_RASTER = os.path.join(root, '2019-06-28', 'fine0_fieldRaster_2019-06-28_4.csv')
+PHI90_RASTER = os.path.join(root, '2019-06-28', 'fine90_fieldRaster_2019-06-28_3.csv')
+
+
+def recorded(filename, column):
+	return pd.read_csv(filename, comment='#')[column].mean()
+
+
+def test_calibration_check_as_recorded():
+	for zero in (None, NOTEBOOK_ZERO):
+		stack = stack_rasters([CALIB_CHECK, CALIB_CHECK], zero=zero, flip_z=True)
+		for column in ('Zfield_avg', 'act_theta', 'Bmag'):
+			assert np.isclose(float(stack[column][0].mean()), recorded(CALIB_CHECK, column), rtol=1e-9, atol=1e-12)
+
+
+def test_field_raster_notebook_zero():
+	stack = stack_rasters([PHI0_RASTER, PHI90_RASTER])
+	assert np.isclose(float(stack.Zfield_avg[0].mean()), recorded(PHI0_RASTER, 'Zfield_avg'))
+	stack = stack_rasters([PHI0_RASTER, PHI90_RASTER], zero=NOTEBOOK_ZERO)
+	assert np.isclose(float(stack.Zfield_avg[0].mean()), recorded(PHI0_RASTER, 'Zfield_avg') - NOTEBOOK_ZERO[2])
+	# the notebook found the Zfield-zero grid minimum of this pair at (26.32, 21.40) mm
+	centre = extremum_centres(centre_objectives(stack, [0], [1])['Zfield zero'], 'min').iloc[0]
+	assert abs(centre.X - 26.32) < 0.01 and abs(centre.Y - 21.40) < 0.01
+
+
+if __name__ == "__main__":
+	test_calibration_check_as_recorded()
+	test_field_raster_notebook_zero()
+	print('rasterCompare checks passed')
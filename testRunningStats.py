@@ -0,0 +1,57 @@
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibration_check'))
+from runningStats import runningStats
+
+# Behaviour checks of the streaming statistics accumulator against np.mean / np.std of
+# the same samples, added one at a time, in blocks, and with outlier rejection.
+
+rng = np.random.RandomState(0)
+SAMPLES = rng.normal([0.04, -0.17, -0.01], [1e-5, 2e-5, 1e-5], (1000, 3))
+
+
+def test_add_matches_numpy():
+	stats = runningStats(track_extrema=True)
+	for sample in SAMPLES:
+		stats.add(sample)
+	assert stats.count == len(SAMPLES)
+	assert np.allclose(stats.mean, SAMPLES.mean(axis=0), rtol=0, atol=1e-15)
+	assert np.allclose(stats.std, SAMPLES.std(axis=0), rtol=1e-9)
+	assert np.array_equal(stats.minimum, SAMPLES.min(axis=0))
+	assert np.array_equal(stats.maximum, SAMPLES.max(axis=0))
+
+
+def test_blocks_match_numpy():
+	stats = runningStats()
+	for block in np.array_split(SAMPLES, [1, 7, 100, 450]):
+		stats.add_block(block)
+	assert np.allclose(stats.mean, SAMPLES.mean(axis=0), rtol=0, atol=1e-15)
+	assert np.allclose(stats.std, SAMPLES.std(axis=0), rtol=1e-9)
+
+
+def test_rejects_outlier():
+	samples = SAMPLES[:50].copy()
+	samples[30, 1] += 1e-3
+	stats = runningStats(reject_sigma=5.)
+	for sample in samples:
+		stats.add(sample)
+	kept = np.delete(samples, 30, axis=0)
+	assert stats.rejected == 1
+	assert np.allclose(stats.mean, kept.mean(axis=0), rtol=0, atol=1e-15)
+	assert np.allclose(stats.std, kept.std(axis=0), rtol=1e-9)
+
+
+def test_quantized_readings_not_rejected():
+	stats = runningStats(reject_sigma=3., min_std=1e-5)
+	for value in [0.1]*10 + [0.10001]*5:
+		stats.add([value, value, value])
+	assert stats.rejected == 0
+
+
+if __name__ == "__main__":
+	test_add_matches_numpy()
+	test_blocks_match_numpy()
+	test_rejects_outlier()
+	test_quantized_readings_not_rejected()
+	print('runningStats checks passed')